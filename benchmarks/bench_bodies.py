@@ -0,0 +1,105 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, insert, select, text
+from benchmarks.bench_keywords import make_words
+from config.models import Base, Email, EmailRecord, email_column
+from handlers.db_handler import EmailWriter
+from handlers.rules_handler import RulesHandler
+
+"""
+Benchmark storing the bodies compressed and deduplicated in the bodies
+table, against storing them inline in emails.message as before. The corpus
+mixes newsletters sent many times with unique personal mail. Reports the
+size of the DB on disk, and the time to run rules reading or not reading
+the bodies over every email.
+
+Run from the repository root:
+    python -m benchmarks.bench_bodies --emails 100000
+"""
+
+RULES = {
+    'subject': {'rules': [{'field': 'subject', 'predicate': 'contains', 'value': 'weekly'}],
+                'predicate': 'all', 'actions': []},
+    'message': {'rules': [{'field': 'message', 'predicate': 'contains', 'value': 'unsubscribe'}],
+                'predicate': 'all', 'actions': []}
+}
+
+
+def make_corpus(random_generator, count, templates, unique_share, body_size):
+    words = make_words(random_generator, 20000)
+
+    def body():
+        return ' '.join(random_generator.choice(words) for _ in range(body_size // 6))[:body_size]
+
+    newsletters = [body() + ' unsubscribe' for _ in range(templates)]
+    start = datetime(2024, 1, 1)
+    for i in range(count):
+        unique = random_generator.random() < unique_share
+        yield 'id-' + str(i), {
+            'From': ('friend' if unique else 'news') + str(i % 50) + '@example.com',
+            'Subject': ('Hello ' if unique else 'Weekly digest ') + str(i),
+            'Date': start - timedelta(minutes=i),
+            'Message': body() if unique else random_generator.choice(newsletters)
+        }
+
+
+def write_inline(engine, corpus):
+    rows = [{'id': message_id, 'from_mail': details['From'], 'subject': details['Subject'],
+             'date': details['Date'], 'message': details['Message']} for message_id, details in corpus]
+    with engine.begin() as connection:
+        for i in range(0, len(rows), 5000):
+            connection.execute(insert(Email.__table__), rows[i:i + 5000])
+
+
+def write_compressed(engine, corpus):
+    with EmailWriter(engine, chunk_size=5000) as writer:
+        for message_id, details in corpus:
+            writer.add(message_id, details)
+
+
+def scan(engine, rules_handler):
+    columns = rules_handler.columns()
+    build = EmailRecord.builder(columns)
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        rows = connection.execute(select(*[email_column(column) for column in columns]).execution_options(yield_per=1000))
+        matches = sum(1 for row in rows if rules_handler.evaluate_rules(build(row)))
+    return time.perf_counter() - start, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compressed, deduplicated body storage.')
+    parser.add_argument('--emails', type=int, default=50000)
+    parser.add_argument('--templates', type=int, default=200)
+    parser.add_argument('--unique-share', type=float, default=0.2)
+    parser.add_argument('--body-size', type=int, default=4000)
+    args = parser.parse_args()
+
+    corpus = list(make_corpus(random.Random(42), args.emails, args.templates, args.unique_share, args.body_size))
+    rules_handler = RulesHandler('config/rules.json')
+
+    print(f"{'layout':<12} {'DB MB':>8} {'subject scan (s)':>18} {'message scan (s)':>18} {'matches':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, write in (('inline', write_inline), ('compressed', write_compressed)):
+            path = os.path.join(directory, name + '.db')
+            engine = create_engine('sqlite:///' + path)
+            Base.metadata.create_all(engine)
+            write(engine, corpus)
+            with engine.connect() as connection:
+                connection.execute(text('VACUUM'))
+
+            timings = []
+            for rules in RULES.values():
+                rules_handler.rules = rules
+                timings.append(scan(engine, rules_handler))
+            size = os.path.getsize(path) / 1e6
+            print(f"{name:<12} {size:>8.1f} {timings[0][0]:>18.2f} {timings[1][0]:>18.2f} {timings[1][1]:>10}")
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
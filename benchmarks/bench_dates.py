@@ -0,0 +1,80 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from utils.date_parser import parse_date
+
+"""
+Benchmark parsing Date headers, comparing the strptime call the loader used
+to make, email.utils, and utils.date_parser with and without its cache.
+
+The corpus mixes the Date header shapes seen in real mail: Gmail's own,
+mailing lists, Outlook, old MTAs with zone names and two digit years.
+
+Run from the repository root:
+    python -m benchmarks.bench_dates --headers 100000 --distinct 20000
+"""
+
+# strftime formats of real-world Date headers
+FORMATS = [
+    '%a, %d %b %Y %H:%M:%S +0000',
+    '%a, %d %b %Y %H:%M:%S +0000 (UTC)',
+    '%a, %d %b %Y %H:%M:%S -0700 (PDT)',
+    '%a, %-d %b %Y %H:%M:%S +0530',
+    '%d %b %Y %H:%M:%S -0000',
+    '%a, %d %b %Y %H:%M:%S GMT',
+    '%a, %d %b %y %H:%M:%S EST',
+    '%a, %d %b %Y %H:%M +0100',
+    '%a,  %-d %b %Y %H:%M:%S.%f +0200',
+    '%a, %d %b %Y %H:%M:%S +01:00'
+]
+
+
+def baseline(value):
+    return datetime.strptime(value.replace(' (UTC)', ''), '%a, %d %b %Y %H:%M:%S %z')
+
+
+def uncached(value):
+    return parse_date.__wrapped__(value)
+
+
+def make_headers(count, distinct):
+    random_generator = random.Random(42)
+    start = datetime(2015, 1, 1)
+    pool = [(start + timedelta(seconds=random_generator.randint(0, 10 ** 9))).strftime(random_generator.choice(FORMATS))
+            for _ in range(distinct)]
+    return [random_generator.choice(pool) for _ in range(count)]
+
+
+def run(name, parse, headers):
+    failures = 0
+    start = time.perf_counter()
+    for value in headers:
+        try:
+            if parse(value) is None:
+                failures += 1
+        except (ValueError, TypeError):
+            failures += 1
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed:>10.3f} {len(headers) / elapsed:>14.0f} {failures:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing Date headers.')
+    parser.add_argument('--headers', type=int, default=100000)
+    parser.add_argument('--distinct', type=int, default=20000, help='distinct header values in the corpus')
+    args = parser.parse_args()
+
+    headers = make_headers(args.headers, args.distinct)
+
+    print(f"{'parser':<28} {'seconds':>10} {'headers/sec':>14} {'failures':>10}")
+    run('strptime (old loader)', baseline, headers)
+    run('email.utils', parsedate_to_datetime, headers)
+    run('parse_date, no cache', uncached, headers)
+    parse_date.cache_clear()
+    run('parse_date, cached', parse_date, headers)
+
+
+if __name__ == '__main__':
+    main()
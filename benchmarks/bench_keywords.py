@@ -0,0 +1,69 @@
+import argparse
+import functools
+import random
+import string
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+from handlers.rules_handler import RulesHandler
+from utils.keyword_matcher import KeywordMatcher
+
+"""
+Benchmark contains rules on the message body as the number of rules grows,
+comparing separate `in` scans per rule with the single trie-regex pass.
+
+Run from the repository root:
+    python -m benchmarks.bench_keywords --emails 200 --body-size 20000
+"""
+
+
+def make_words(random_generator, count):
+    return [''.join(random_generator.choice(string.ascii_lowercase) for _ in range(random_generator.randint(4, 10)))
+            for _ in range(count)]
+
+
+def make_emails(random_generator, words, count, body_size):
+    emails = []
+    for i in range(count):
+        body = ' '.join(random_generator.choice(words) for _ in range(body_size // 6))[:body_size]
+        emails.append(SimpleNamespace(id='id-' + str(i), from_mail='news@example.com', to_mail='me@example.com',
+                                      subject='Newsletter ' + str(i), date=datetime.now(), message=body))
+    return emails
+
+
+def time_rules(rules_handler, rules, emails, regex_min_keywords):
+    matcher = functools.partial(KeywordMatcher, regex_min_keywords=regex_min_keywords)
+    with patch('handlers.rules_handler.KeywordMatcher', matcher):
+        rules_handler.rules = {'rules': rules, 'predicate': 'any', 'actions': []}
+
+    start = time.perf_counter()
+    matches = sum(1 for email in emails if rules_handler.evaluate_rules(email))
+    return time.perf_counter() - start, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark contains rules against the rule count.')
+    parser.add_argument('--emails', type=int, default=200)
+    parser.add_argument('--body-size', type=int, default=20000)
+    args = parser.parse_args()
+
+    random_generator = random.Random(42)
+    words = make_words(random_generator, 20000)
+    emails = make_emails(random_generator, words, args.emails, args.body_size)
+    rules_handler = RulesHandler('config/rules.json')
+
+    print(f"{'rules':>6} {'in scans (s)':>14} {'regex pass (s)':>15} {'default (s)':>12}")
+    for count in (1, 10, 50, 100, 200, 500, 1000):
+        # Mostly absent keywords, so the any-rule can't stop early
+        rules = [{'field': 'message', 'predicate': 'contains', 'value': keyword}
+                 for keyword in make_words(random_generator, count)]
+        scans, scan_matches = time_rules(rules_handler, rules, emails, float('inf'))
+        regex, regex_matches = time_rules(rules_handler, rules, emails, 0)
+        default, _ = time_rules(rules_handler, rules, emails, KeywordMatcher.__init__.__defaults__[0])
+        assert scan_matches == regex_matches
+        print(f"{count:>6} {scans:>14.3f} {regex:>15.3f} {default:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import tempfile
+import time
+from unittest.mock import patch
+from sqlalchemy import create_engine
+from config.models import Base
+from handlers.db_handler import EmailWriter
+from handlers.gmail_handler import GmailHandler
+from handlers.pipeline import LoadPipeline
+from tests.fake_gmail import FakeGmailService, fake_gmail_handler, make_message
+
+"""
+Benchmark loading a mailbox from a local stub of the Gmail service, which
+adds a fixed latency to every round trip.
+
+Run from the repository root:
+    python -m benchmarks.bench_load --messages 2000 --latency 0.05 --body-size 20000
+"""
+
+
+def load_one_by_one(gmail_handler, writer, message_ids):
+    for message_id in message_ids:
+        message = gmail_handler.fetch_message_by_id(message_id)
+        writer.add(message_id, gmail_handler.get_email_details(message))
+    return len(message_ids)
+
+
+def load_with_pipeline(fetch_workers, parse_workers, message_format='full'):
+    def load(gmail_handler, writer, message_ids):
+        return LoadPipeline(gmail_handler, writer, fetch_workers=fetch_workers, parse_workers=parse_workers,
+                            message_format=message_format).run(message_ids)
+    return load
+
+
+def run(name, load, message_ids, latency, body_size):
+    body = ('Lorem ipsum dolor sit amet. ' * (body_size // 28 + 1))[:body_size]
+    service = FakeGmailService([make_message(i, body=body) for i in message_ids], latency=latency)
+
+    gmail_handler = fake_gmail_handler(service)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'emails.db'))
+        Base.metadata.create_all(engine)
+
+        with patch.object(GmailHandler, 'build_service', return_value=service):
+            start = time.perf_counter()
+            with EmailWriter(engine) as writer:
+                count = load(gmail_handler, writer, message_ids)
+            elapsed = time.perf_counter() - start
+
+        engine.dispose()
+
+    print(f"{name:<28} {count:>8} {service.round_trips:>12} {service.bytes_sent / 1e6:>10.2f} {elapsed:>10.2f} {count / elapsed:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark loading a mailbox from a stub Gmail service.')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per round trip')
+    parser.add_argument('--body-size', type=int, default=20000, help='bytes per Mail body')
+    args = parser.parse_args()
+
+    message_ids = ['id-' + str(i) for i in range(args.messages)]
+
+    print(f"{'mode':<28} {'emails':>8} {'round trips':>12} {'MB':>10} {'seconds':>10} {'emails/sec':>12}")
+    # The per-message baseline is too slow to run over a big mailbox
+    run('one request per message', load_one_by_one, message_ids[:200], args.latency, args.body_size)
+    run('batched, 1 fetch worker', load_with_pipeline(1, 1), message_ids, args.latency, args.body_size)
+    run('batched, 4 fetch workers', load_with_pipeline(4, 2), message_ids, args.latency, args.body_size)
+    run('batched, 8 fetch workers', load_with_pipeline(8, 2), message_ids, args.latency, args.body_size)
+    run('batched, 4 workers, metadata', load_with_pipeline(4, 2, 'metadata'), message_ids, args.latency, args.body_size)
+
+
+if __name__ == '__main__':
+    main()
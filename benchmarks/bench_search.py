@@ -0,0 +1,64 @@
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+from sqlalchemy import create_engine
+from handlers.db_handler import DatabaseHandler
+
+"""
+Benchmark ad-hoc mailbox search over a synthetic store, through the full
+text index and through a LIKE table scan.
+
+Run from the repository root:
+    python -m benchmarks.bench_search --emails 100000
+"""
+
+
+def random_text(random_generator, words, count):
+    return ' '.join(random_generator.choice(words) for _ in range(count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mailbox search with and without the full text index.')
+    parser.add_argument('--emails', type=int, default=100000)
+    parser.add_argument('--body-words', type=int, default=150)
+    args = parser.parse_args()
+
+    random_generator = random.Random(42)
+    words = [''.join(random_generator.choice(string.ascii_lowercase) for _ in range(random_generator.randint(3, 9)))
+             for _ in range(20000)]
+    queries = random_generator.sample(words, 20)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'emails.db'))
+        with patch('handlers.db_handler.create_engine', return_value=engine):
+            db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=Mock())
+
+        start = time.perf_counter()
+        with db_handler.email_writer(chunk_size=5000) as writer:
+            for i in range(args.emails):
+                writer.add('id-' + str(i), {
+                    'From': random_generator.choice(words) + '@example.com',
+                    'To': 'me@example.com',
+                    'Subject': random_text(random_generator, words, 6),
+                    'Date': datetime(2024, 1, 1) - timedelta(minutes=i),
+                    'Message': random_text(random_generator, words, args.body_words)
+                })
+        print(f"Stored {args.emails} emails in {time.perf_counter() - start:.1f}s")
+
+        for name, enabled in (('full text index', True), ('table scan', False)):
+            db_handler.fts_enabled = enabled
+            start = time.perf_counter()
+            results = sum(len(db_handler.search_emails(query)) for query in queries)
+            elapsed = (time.perf_counter() - start) / len(queries)
+            print(f"{name:<16} {elapsed * 1000:>9.1f} ms/query ({results} results)")
+
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
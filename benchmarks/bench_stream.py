@@ -0,0 +1,83 @@
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+from sqlalchemy import create_engine
+from handlers.db_handler import DatabaseHandler
+from handlers.rules_handler import RulesHandler
+
+"""
+Benchmark reading the mailbox into the rules: loading every Email as an ORM
+object with fetch_emails_from_db, against streaming light rows of the rule
+columns with iter_emails, or EmailRecords with iter_records. Reports the
+wall time and the peak memory allocated by Python while evaluating the rules.
+
+Run from the repository root:
+    python -m benchmarks.bench_stream --emails 500000
+"""
+
+RULES = {
+    'rules': [{'field': 'from_mail', 'predicate': 'contains', 'value': 'news'},
+              {'field': 'subject', 'predicate': 'contains', 'value': 'weekly'}],
+    'predicate': 'any',
+    'actions': []
+}
+
+
+def run(name, rules_handler, read):
+    tracemalloc.start()
+    start = time.perf_counter()
+    matches = sum(1 for email in read() if rules_handler.evaluate_rules(email))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<34} {elapsed:>10.2f} {peak / 1e6:>12.1f} {matches:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading the mailbox into the rules.')
+    parser.add_argument('--emails', type=int, default=100000)
+    parser.add_argument('--body-size', type=int, default=2000)
+    args = parser.parse_args()
+
+    random_generator = random.Random(42)
+    words = [''.join(random_generator.choice(string.ascii_lowercase) for _ in range(random_generator.randint(3, 9)))
+             for _ in range(5000)]
+    body = ' '.join(random_generator.choice(words) for _ in range(args.body_size // 6))[:args.body_size]
+
+    rules_handler = RulesHandler('config/rules.json')
+    rules_handler.rules = RULES
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'emails.db'))
+        # The full text index only slows the setup down here
+        with patch('handlers.db_handler.create_engine', return_value=engine), \
+             patch('handlers.db_handler.FTS_ENABLED', False):
+            db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=Mock())
+
+        with db_handler.email_writer(chunk_size=5000) as writer:
+            for i in range(args.emails):
+                writer.add('id-' + str(i), {
+                    'From': random_generator.choice(words + ['news']) + '@example.com',
+                    'To': 'me@example.com',
+                    'Subject': random_generator.choice(['Weekly digest', 'Invoice', 'Hello']) + ' ' + str(i),
+                    'Date': datetime(2024, 1, 1) - timedelta(minutes=i),
+                    'Message': body
+                })
+
+        print(f"{'mode':<34} {'seconds':>10} {'peak MB':>12} {'matches':>10}")
+        run('fetch_emails_from_db (ORM, .all())', rules_handler, db_handler.fetch_emails_from_db)
+        run('iter_emails, all columns', rules_handler, db_handler.iter_emails)
+        run('iter_emails, rule columns', rules_handler, lambda: db_handler.iter_emails(columns=rules_handler.columns()))
+        run('iter_records, rule columns', rules_handler, lambda: db_handler.iter_records(columns=rules_handler.columns()))
+
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from multiprocessing import get_context
+from unittest.mock import patch
+from sqlalchemy import create_engine
+from handlers.db_handler import DatabaseHandler
+from handlers.gmail_handler import GmailHandler
+from handlers.rules_handler import RulesHandler
+from tests.fake_gmail import FakeGmailService, fake_gmail_handler, make_message
+from utils.date_parser import utc_now
+
+"""
+Benchmark suite running the utility end to end against a local stub of the
+Gmail service, serving a synthetic mailbox with a fixed latency per round
+trip and, for the quota scenario, random quota errors.
+
+Every scenario runs in a fresh process, so its peak RSS isn't hidden by the
+ones before it, and reports the messages/sec, the API calls, the peak RSS
+and the wall time. The results are compared against the baselines stored
+in benchmarks/baselines.json, which --save-baseline overwrites.
+
+Run from the repository root:
+    python -m benchmarks.bench_suite --messages 2000 --latency 0.01
+    python -m benchmarks.bench_suite --scenarios update_db process_emails --tolerance 0.1
+"""
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+RULES = {
+    'rules': [{'field': 'from_mail', 'predicate': 'contains', 'value': 'news'},
+              {'field': 'subject', 'predicate': 'contains', 'value': 'weekly'}],
+    'predicate': 'any',
+    'actions': [{'name': 'mark_as_read'}, {'name': 'move', 'folder_name': 'Newsletters'}]
+}
+
+SENDERS = ['news', 'alice', 'bob', 'billing', 'team', 'newsletter', 'support', 'carol']
+
+SUBJECTS = ['Weekly digest', 'Invoice', 'Hello', 'Meeting notes', 'Your order', 'Reminder']
+
+# Metrics compared against the baseline, and whether a higher value is better
+METRICS = {'messages_per_second': True, 'seconds': False, 'api_calls': False, 'peak_rss_mb': False}
+
+
+def synthetic_message(random_generator, index, body_size):
+
+    """Build a Mail of the synthetic mailbox, the same for the same random state."""
+
+    words = ' '.join(random_generator.choice(SUBJECTS + SENDERS) for _ in range(body_size // 8 + 1))
+    return make_message('id-' + str(index),
+                        subject=random_generator.choice(SUBJECTS) + ' ' + str(index),
+                        from_mail=random_generator.choice(SENDERS) + '@example.com',
+                        date=format_datetime(datetime(2024, 1, 1, tzinfo=timezone.utc) - timedelta(minutes=index)),
+                        # Bodies are unique, so storing them isn't helped by deduplication
+                        body=(str(index) + ' ' + words)[:body_size])
+
+
+def load_db(gmail_handler, db_handler, service, args):
+
+    """Load the whole mailbox into an empty database."""
+
+    def run():
+        db_handler.load_db()
+        return len(service.messages)
+    return run
+
+
+def update_db(gmail_handler, db_handler, service, args):
+
+    """Sync a loaded database with a tenth of the mailbox added and a tenth deleted or relabeled."""
+
+    db_handler.load_db()
+    random_generator = random.Random(args.seed + 1)
+    count = len(service.messages)
+    for index in range(count, count + count // 10):
+        service.add_message(synthetic_message(random_generator, index, args.body_size))
+    for index in range(0, count // 10, 2):
+        service.delete_message('id-' + str(index))
+        service.relabel_message('id-' + str(index + 1), ['STARRED'])
+
+    def run():
+        db_handler.update_db()
+        return len(service.history)
+    return run
+
+
+def process_emails(gmail_handler, db_handler, service, args):
+
+    """Run the rules over a loaded database, as main does, applying their actions."""
+
+    db_handler.load_db()
+    rules_handler = RulesHandler.from_rules(RULES)
+
+    def run():
+        now = utc_now()
+        criterion = rules_handler.build_sql_filter(now, use_fts=db_handler.fts_enabled)
+        emails = db_handler.iter_records(criterion, rules_handler.columns())
+        rules_handler.process_emails(gmail_handler, emails, now, db_handler.action_journal())
+        return len(service.messages)
+    return run
+
+
+def apply_actions(gmail_handler, db_handler, service, args):
+
+    """Send label changes for the whole mailbox, half of it archived and half moved and read."""
+
+    db_handler.load_db()
+    rules_handler = RulesHandler.from_rules(RULES)
+    label_id = gmail_handler.get_label_id('Newsletters')
+    message_ids = list(service.message_order)
+    pending = {
+        (('INBOX', False, 'archive'),): message_ids[::2],
+        (('UNREAD', False, 'newsletters'), (label_id, True, 'newsletters')): message_ids[1::2]
+    }
+
+    def run():
+        rules_handler.apply_pending_actions(gmail_handler, pending, db_handler.action_journal())
+        return len(message_ids)
+    return run
+
+
+# Scenario name -> (setup returning the timed run, whether the stub injects quota errors)
+SCENARIOS = {
+    'load_db': (load_db, False),
+    'load_db_quota_errors': (load_db, True),
+    'update_db': (update_db, False),
+    'process_emails': (process_emails, False),
+    'apply_actions': (apply_actions, False)
+}
+
+
+def run_scenario(name, args):
+
+    """Set up and time a scenario, in the process it's called in."""
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    setup, quota_errors = SCENARIOS[name]
+    random_generator = random.Random(args.seed)
+    mailbox = [synthetic_message(random_generator, index, args.body_size) for index in range(args.messages)]
+    service = FakeGmailService(mailbox, latency=args.latency, labels=['Newsletters'],
+                               error_rate=args.error_rate if quota_errors else 0, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as directory, \
+         patch.object(GmailHandler, 'build_service', return_value=service), \
+         patch('handlers.db_handler.MAIL_COUNT_LIMIT', None):
+        gmail_handler = fake_gmail_handler(service)
+
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'emails.db'))
+        with patch('handlers.db_handler.create_engine', return_value=engine):
+            db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=gmail_handler)
+
+        run = setup(gmail_handler, db_handler, service, args)
+        # Only the timed run counts against the API
+        service.round_trips = 0
+        service.calls = {}
+        service.errors = 0
+
+        start = time.perf_counter()
+        count = run()
+        elapsed = time.perf_counter() - start
+
+        engine.dispose()
+
+    return {
+        'messages': count,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(count / elapsed, 1),
+        'api_calls': sum(service.calls.values()),
+        'round_trips': service.round_trips,
+        'quota_errors': service.errors,
+        # Kilobytes on Linux, the setup of the scenario included
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def run_in_process(name, args):
+
+    """Run a scenario in a fresh interpreter, which the peak RSS is measured for."""
+
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_scenario, name, args).result()
+
+
+def settings(args):
+    return {'messages': args.messages, 'latency': args.latency, 'body_size': args.body_size,
+            'error_rate': args.error_rate, 'seed': args.seed}
+
+
+def load_baselines(path, args):
+
+    """Load the stored baseline results, if they were measured with the same settings."""
+
+    if not os.path.exists(path):
+        print("No baselines found at " + path)
+        return {}
+
+    with open(path) as f:
+        baselines = json.load(f)
+    if baselines['settings'] != settings(args):
+        print("Baselines were measured with " + json.dumps(baselines['settings']) + ", not comparing")
+        return {}
+    return baselines['results']
+
+
+def change(result, baseline, metric):
+    if not baseline.get(metric):
+        return 0
+    return (result[metric] - baseline[metric]) / baseline[metric]
+
+
+def find_regressions(results, baselines, tolerance):
+
+    """List the (scenario, metric, change) of the metrics worse than the baseline by more than the tolerance."""
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baselines:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            relative = change(result, baselines[name], metric)
+            if (-relative if higher_is_better else relative) > tolerance:
+                regressions.append((name, metric, relative))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark load, sync, rules and actions against a stub Gmail service.')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--messages', type=int, default=2000, help='Mails in the synthetic mailbox')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per round trip')
+    parser.add_argument('--body-size', type=int, default=2000, help='bytes per Mail body')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='share of requests failing with a quota error')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline', default=BASELINES_FILE, help='JSON file of the baseline results')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression')
+    parser.add_argument('--verbose', action='store_true', help='keep the INFO logs of the handlers')
+    args = parser.parse_args()
+
+    baselines = {} if args.save_baseline else load_baselines(args.baseline, args)
+
+    print(f"{'scenario':<22} {'messages':>9} {'msgs/sec':>10} {'vs base':>8} {'API calls':>10} {'quota err':>10} "
+          f"{'peak RSS MB':>12} {'seconds':>9}")
+    results = {}
+    for name in args.scenarios:
+        result = results[name] = run_in_process(name, args)
+        versus = f"{change(result, baselines[name], 'messages_per_second'):+.0%}" if name in baselines else '-'
+        print(f"{name:<22} {result['messages']:>9} {result['messages_per_second']:>10.1f} {versus:>8} "
+              f"{result['api_calls']:>10} {result['quota_errors']:>10} {result['peak_rss_mb']:>12.1f} {result['seconds']:>9.2f}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'settings': settings(args), 'results': results}, f, indent=4)
+            f.write('\n')
+        print("Saved the baselines to " + args.baseline)
+        return
+
+    regressions = find_regressions(results, baselines, args.tolerance)
+    for name, metric, relative in regressions:
+        print(f"Regression: {name} {metric} {relative:+.0%} against the baseline")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
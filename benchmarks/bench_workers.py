@@ -0,0 +1,58 @@
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from benchmarks.bench_keywords import make_words
+from config.models import EMAIL_FIELDS, EmailRecord
+from handlers.rules_handler import RulesHandler
+
+"""
+Benchmark evaluating the rules in a pool of worker processes, against
+evaluating them in the main process, on contains rules over large bodies.
+The matches of every mode are checked against the serial ones.
+
+Run from the repository root:
+    python -m benchmarks.bench_workers --emails 20000 --body-size 20000
+"""
+
+
+def make_records(random_generator, words, count, body_size):
+    build = EmailRecord.builder(list(EMAIL_FIELDS))
+    now = datetime(2024, 6, 1)
+    for i in range(count):
+        body = ' '.join(random_generator.choice(words) for _ in range(body_size // 6))[:body_size]
+        yield build(('id-' + str(i), 'news@example.com', 'me@example.com', 'Newsletter ' + str(i),
+                     now - timedelta(hours=i), body, None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark evaluating the rules in worker processes.')
+    parser.add_argument('--emails', type=int, default=5000)
+    parser.add_argument('--body-size', type=int, default=20000)
+    parser.add_argument('--rules', type=int, default=20)
+    args = parser.parse_args()
+
+    random_generator = random.Random(42)
+    words = make_words(random_generator, 20000)
+    records = list(make_records(random_generator, words, args.emails, args.body_size))
+    rules = [{'field': 'message', 'predicate': 'contains', 'value': keyword}
+             for keyword in random_generator.sample(words, args.rules)]
+    rules_handler = RulesHandler('config/rules.json')
+    rules_handler.rules = {'rules': rules, 'predicate': 'any', 'actions': []}
+
+    print(f"{'workers':>8} {'seconds':>10} {'emails/s':>12} {'matches':>10}")
+    serial = None
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        rules_handler.workers = workers
+        start = time.perf_counter()
+        matches = list(rules_handler.iter_matches(records))
+        elapsed = time.perf_counter() - start
+        if serial is None:
+            serial = matches
+        assert matches == serial
+        print(f"{workers:>8} {elapsed:>10.2f} {args.emails / elapsed:>12.0f} {len(matches):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,87 @@
-# Number of Mails to operate on for an action
+# Number of Mails to operate on for an action (None for the whole mailbox)
 MAIL_COUNT_LIMIT = 10
 
+# Gmail search query selecting the Mails to load, SYNC_LABEL_ID must select the same Mails
+MAIL_QUERY = 'category:primary'
+
+# Gmail label ID matching MAIL_QUERY, incremental syncs add the Mails gaining it
+# and drop the ones losing it (category:primary is CATEGORY_PERSONAL, label:foo is the ID of foo)
+SYNC_LABEL_ID = 'CATEGORY_PERSONAL'
+
+# Labels of the Mails messages.list leaves out unless asked, so syncs drop the Mails gaining them
+EXCLUDED_LABEL_IDS = ('TRASH', 'SPAM')
+
+# Number of message IDs requested per page when listing the mailbox (API max is 500)
+PAGE_SIZE = 500
+
 # If True, will reload the DB with Inbox
 LOAD_FLAG = True
 
 # If True, will update the DB with newer mails
-UPDATE_FLAG = False
\ No newline at end of file
+UPDATE_FLAG = False
+
+# If True, Mail bodies are only fetched from Gmail once a rule needs them
+LAZY_BODIES = True
+
+# Bytes of a Mail body kept when decoding it, the rest is cut off (None keeps it whole)
+MAX_BODY_BYTES = 1000000
+
+# zlib level (1-9) the bodies are compressed with in the DB
+BODY_COMPRESSION_LEVEL = 6
+
+# Number of decompressed bodies kept in memory, for the ones many Emails share
+BODY_CACHE_SIZE = 256
+
+# SQLite journal mode, WAL lets the rules read the DB while a sync writes to it
+SQLITE_JOURNAL_MODE = 'WAL'
+
+# SQLite synchronous level: OFF, NORMAL or FULL (NORMAL is safe with WAL, and much faster than FULL)
+SQLITE_SYNCHRONOUS = 'NORMAL'
+
+# SQLite page cache size per connection, in KiB when negative
+SQLITE_CACHE_SIZE = -64000
+
+# Bytes of the DB file SQLite reads through a memory map (0 disables it)
+SQLITE_MMAP_SIZE = 268435456
+
+# If True, keeps a full text index over the Emails for text rules and search
+FTS_ENABLED = True
+
+# Number of message fetches grouped into one Gmail batch request (API max is 100)
+BATCH_SIZE = 50
+
+# Number of times a failed Gmail request is retried before giving up
+MAX_RETRIES = 3
+
+# Initial delay (seconds) before retrying, doubled on every attempt
+RETRY_BACKOFF = 1
+
+# Number of Emails buffered before they are written to the DB in one transaction
+WRITE_CHUNK_SIZE = 500
+
+# Number of Emails read from the DB at a time when streaming them to the rules
+READ_CHUNK_SIZE = 1000
+
+# Number of threads fetching batches of Mails concurrently while loading the DB
+FETCH_WORKERS = 4
+
+# Number of threads decoding the fetched Mails
+PARSE_WORKERS = 2
+
+# Maximum number of Mails waiting between two loading stages
+QUEUE_SIZE = 1000
+
+# Number of message IDs per messages.batchModify request (API max is 1000)
+BATCH_MODIFY_SIZE = 1000
+
+# Seconds the label name to ID map is cached for before being listed again
+LABEL_CACHE_TTL = 300
+
+# Maximum number of requests in flight, and pooled connections, of the AsyncGmailHandler
+ASYNC_CONCURRENCY = 10
+
+# Gmail API quota units a user may spend per second
+QUOTA_UNITS_PER_SECOND = 250
+
+# Number of processes evaluating the rules, 1 evaluates them in the main process
+RULE_WORKERS = 1
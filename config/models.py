@@ -1,5 +1,15 @@
-from sqlalchemy import Column, String, DateTime
-from sqlalchemy.orm import  declarative_base
+import hashlib
+import sqlite3
+import zlib
+from collections import namedtuple
+from functools import lru_cache
+from sqlalchemy import (Column, Integer, Float, String, DateTime, Index, LargeBinary, MetaData, Table, and_, event, func,
+                        select)
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import  declarative_base, relationship
+from config.constants import BODY_CACHE_SIZE, BODY_COMPRESSION_LEVEL
+from utils.date_parser import parse_date
 
 Base = declarative_base()
 
@@ -10,4 +20,274 @@ class Email(Base):
     to_mail = Column(String)
     subject = Column(String)
     date = Column(DateTime)
-    message = Column(String)
\ No newline at end of file
+    # Bodies are stored compressed in the bodies table, only the ones
+    # written before that are still in the message column
+    inline_message = Column('message', String)
+    body_hash = Column(String)
+    body = relationship('Body', primaryjoin='foreign(Email.body_hash) == Body.hash', viewonly=True)
+
+    __table_args__ = (
+        # Date rules and the latest Email lookup
+        Index('ix_emails_date', 'date'),
+        # equals rules compare the lowercased senders and recipients
+        Index('ix_emails_from_mail_lower', func.lower(from_mail)),
+        Index('ix_emails_to_mail_lower', func.lower(to_mail)),
+    )
+
+    @hybrid_property
+    def message(self):
+
+        """The body of the Email, decompressed when read, None if it wasn't fetched."""
+
+        if self.body is not None:
+            return inflate_body(self.body.data)
+        return self.inline_message
+
+    @message.inplace.setter
+    def _message_setter(self, value):
+        self.inline_message = value
+
+    @message.inplace.expression
+    @classmethod
+    def _message_expression(cls):
+        return message_text()
+
+
+class Body(Base):
+
+    """A compressed body, stored once however many Emails share it."""
+
+    __tablename__ = 'bodies'
+    hash = Column(String, primary_key=True)
+    data = Column(LargeBinary)
+    # Length of the body before compression
+    size = Column(Integer)
+
+
+def body_hash(text):
+
+    """Get the key of a body in the bodies table."""
+
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def compress_body(text):
+    return zlib.compress(text.encode('utf-8'), BODY_COMPRESSION_LEVEL)
+
+
+@lru_cache(maxsize=BODY_CACHE_SIZE)
+def inflate_body(data):
+
+    """Decompress a body, the ones shared by many Emails only once."""
+
+    return zlib.decompress(data).decode('utf-8') if data is not None else None
+
+
+@event.listens_for(Engine, 'connect')
+def register_functions(dbapi_connection, connection_record):
+
+    """Let SQLite decompress the bodies, for the message queries and the full text index triggers."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('inflate', 1, inflate_body, deterministic=True)
+
+
+def message_text():
+
+    """Get the body of each email as a SQL expression, decompressed only where it is read."""
+
+    data = select(Body.data).where(Body.hash == Email.body_hash).scalar_subquery()
+    return func.coalesce(func.inflate(data), Email.inline_message)
+
+
+def body_missing():
+
+    """Get a condition matching the emails whose body wasn't fetched yet."""
+
+    return and_(Email.body_hash.is_(None), Email.inline_message.is_(None))
+
+
+class Label(Base):
+
+    """A label of the mailbox, as last listed from Gmail."""
+
+    __tablename__ = 'labels'
+    id = Column(String, primary_key=True)
+    name = Column(String)
+
+
+class MessageLabel(Base):
+
+    """A label on an email, as of the last fetch, sync or modify."""
+
+    __tablename__ = 'message_labels'
+    message_id = Column(String, primary_key=True)
+    label_id = Column(String, primary_key=True)
+
+    __table_args__ = (
+        Index('ix_message_labels_label_id', 'label_id'),
+    )
+
+
+# Separates the label IDs and names in the labels column of email_labels
+LABEL_SEPARATOR = '\x1f'
+
+
+def email_labels():
+
+    """Get a column with the IDs and names of the labels of each email, NULL if none are known."""
+
+    label = MessageLabel.label_id + LABEL_SEPARATOR + func.coalesce(Label.name, '')
+    return (select(func.group_concat(label, LABEL_SEPARATOR))
+            .select_from(MessageLabel)
+            .outerjoin(Label, Label.id == MessageLabel.label_id)
+            .where(MessageLabel.message_id == Email.id)
+            .scalar_subquery()
+            .label('labels'))
+
+
+def label_set(value):
+
+    """Turn the labels column of an email into a set of lowercased label IDs and names, None if unknown."""
+
+    if value is None or isinstance(value, frozenset):
+        return value
+    return frozenset(value.lower().split(LABEL_SEPARATOR))
+
+
+def email_column(field):
+
+    """Get the SQL expression reading an EmailRecord field, the message and labels not being plain columns."""
+
+    if field == 'message':
+        return message_text().label('message')
+    if field == 'labels':
+        return email_labels()
+    return Email.__table__.columns[field]
+
+
+# Fields of an EmailRecord, in order
+EMAIL_FIELDS = ('id', 'from_mail', 'to_mail', 'subject', 'date', 'message', 'labels')
+
+# Fields the rules compare case-insensitively
+TEXT_FIELDS = ('from_mail', 'to_mail', 'subject', 'message')
+
+
+class EmailRecord(namedtuple('EmailRecord', EMAIL_FIELDS, defaults=(None,) * len(EMAIL_FIELDS))):
+
+    """An immutable Email for the rules, lighter than an ORM object.
+
+    The text fields are lowercased and the date parsed once, when the record
+    is built, so the rules don't do it again on every read, and the labels
+    turned into a set. Columns that weren't selected are None."""
+
+    __slots__ = ()
+
+    @classmethod
+    def builder(cls, columns):
+
+        """Get a function building records from row tuples of the given columns."""
+
+        def text(value):
+            return value.lower() if value else value
+
+        def date(value):
+            return parse_date(value) if isinstance(value, str) else value
+
+        converters = {field: text for field in TEXT_FIELDS}
+        converters['date'] = date
+        converters['labels'] = label_set
+        steps = [(columns.index(field), converters.get(field)) if field in columns else None for field in EMAIL_FIELDS]
+
+        def build(row):
+            values = []
+            for step in steps:
+                if step is None:
+                    values.append(None)
+                else:
+                    index, convert = step
+                    values.append(convert(row[index]) if convert else row[index])
+            return tuple.__new__(cls, values)
+
+        return build
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    id = Column(Integer, primary_key=True)
+    history_id = Column(String)
+
+
+class JournalEntry(Base):
+
+    """A label change a ruleset already applied to an email."""
+
+    __tablename__ = 'action_journal'
+    message_id = Column(String, primary_key=True)
+    # Hash of the ruleset, so editing it applies its actions again
+    ruleset_hash = Column(String, primary_key=True)
+    # 'add:<label ID>' or 'remove:<label ID>'
+    action = Column(String, primary_key=True)
+    applied_at = Column(DateTime)
+
+# Email fields covered by the full text index
+FTS_FIELDS = ('subject', 'from_mail', 'message')
+
+# The FTS5 index over the emails table. It lives outside Base.metadata as
+# create_all can't create virtual tables, see EMAILS_FTS_DDL instead.
+# The trigram tokenizer lets MATCH find any substring of 3+ characters,
+# case-insensitively, the way contains rules do.
+EmailSearch = Table(
+    'emails_fts', MetaData(),
+    Column('rowid', Integer),
+    *[Column(field, String) for field in FTS_FIELDS],
+    # FTS5's hidden columns: the one named after the table is used on the
+    # left of MATCH, rank orders the matches by relevance
+    Column('emails_fts', String),
+    Column('rank', Float)
+)
+
+# The index reads the bodies through the email_texts view, which
+# decompresses them, and the triggers decompress the ones they index.
+# Bodies must be in the bodies table before the Emails pointing to them.
+EMAILS_FTS_DDL = [
+    """CREATE VIEW IF NOT EXISTS email_texts AS
+        SELECT emails.rowid AS rowid, subject, from_mail, coalesce(inflate(bodies.data), emails.message) AS message
+        FROM emails LEFT JOIN bodies ON bodies.hash = emails.body_hash""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject, from_mail, message, content='email_texts', content_rowid='rowid', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts(rowid, subject, from_mail, message)
+        VALUES (new.rowid, new.subject, new.from_mail,
+                coalesce(inflate((SELECT data FROM bodies WHERE hash = new.body_hash)), new.message));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts(emails_fts, rowid, subject, from_mail, message)
+        VALUES ('delete', old.rowid, old.subject, old.from_mail,
+                coalesce(inflate((SELECT data FROM bodies WHERE hash = old.body_hash)), old.message));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE ON emails BEGIN
+        INSERT INTO emails_fts(emails_fts, rowid, subject, from_mail, message)
+        VALUES ('delete', old.rowid, old.subject, old.from_mail,
+                coalesce(inflate((SELECT data FROM bodies WHERE hash = old.body_hash)), old.message));
+        INSERT INTO emails_fts(rowid, subject, from_mail, message)
+        VALUES (new.rowid, new.subject, new.from_mail,
+                coalesce(inflate((SELECT data FROM bodies WHERE hash = new.body_hash)), new.message));
+    END"""
+]
+
+# Drops an index created before the bodies were compressed, which read them from emails.message
+EMAILS_FTS_DROP = [
+    'DROP TRIGGER IF EXISTS emails_fts_insert',
+    'DROP TRIGGER IF EXISTS emails_fts_delete',
+    'DROP TRIGGER IF EXISTS emails_fts_update',
+    'DROP TABLE IF EXISTS emails_fts'
+]
+
+
+def fts_phrase(value, fields=FTS_FIELDS):
+
+    """Build an FTS5 query matching the value as a substring of any of the fields."""
+
+    return '{' + ' '.join(fields) + '} : "' + value.replace('"', '""') + '"'
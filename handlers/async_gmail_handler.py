@@ -0,0 +1,295 @@
+import asyncio
+import httpx
+from google.auth.transport.requests import Request
+from config.constants import ASYNC_CONCURRENCY, BATCH_MODIFY_SIZE, MAIL_QUERY, MAX_RETRIES, PAGE_SIZE
+from handlers.gmail_handler import GmailHandler, METADATA_HEADERS, RETRYABLE_STATUSES, is_rate_limited, label_body
+from utils.label_cache import LabelCache
+from utils.logging_config import logging
+from utils.rate_limiter import RateLimiter
+
+"""
+An asyncio counterpart of GmailHandler, calling the Gmail REST API through
+an httpx client. Requests share a pool of keep-alive connections, the
+number of requests in flight is bounded by a semaphore, and the OAuth
+token is refreshed once for all the tasks waiting on it.
+
+Authentication still goes through GmailHandler, the async handler only
+borrows its credentials:
+
+    async with AsyncGmailHandler.from_gmail_handler(gmail_handler) as async_gmail_handler:
+        await database_handler.load_db_async(async_gmail_handler)
+"""
+
+API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/'
+
+
+class AsyncGmailHandler:
+
+    # Parsing doesn't touch the connection, so it's shared with GmailHandler
+    get_email_details = GmailHandler.get_email_details
+
+    def __init__(self, creds, max_concurrency=ASYNC_CONCURRENCY, transport=None, rate_limiter=None, label_cache=None):
+        self.creds = creds
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.refresh_lock = asyncio.Lock()
+        self.label_cache = label_cache or LabelCache()
+        self.client = httpx.AsyncClient(
+            base_url=API_URL,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            timeout=httpx.Timeout(60),
+            transport=transport
+        )
+
+    @classmethod
+    def from_gmail_handler(cls, gmail_handler, **kwargs):
+
+        """Create an async handler sharing the credentials, quota and labels of an authenticated GmailHandler."""
+
+        kwargs.setdefault('rate_limiter', gmail_handler.rate_limiter)
+        kwargs.setdefault('label_cache', gmail_handler.label_cache)
+        return cls(gmail_handler.creds, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+
+        """Close the pooled connections."""
+
+        await self.client.aclose()
+
+    async def get_token(self, rejected_token=None):
+
+        """Get a valid access token, refreshing it once for all the waiting tasks."""
+
+        async with self.refresh_lock:
+            # Another task may have refreshed the rejected token already
+            if not self.creds.valid or self.creds.token == rejected_token:
+                logging.info("Refreshing the access token...")
+                await asyncio.to_thread(self.creds.refresh, Request())
+            return self.creds.token
+
+    async def request(self, method, path, quota_method, params=None, json=None):
+
+        """Send a request to the Gmail API within the quota, retrying quota and server errors.
+
+        quota_method names the API method, such as 'messages.get', for its quota units."""
+
+        async with self.semaphore:
+            token = await self.get_token()
+
+            for attempt in range(MAX_RETRIES + 1):
+                await self.rate_limiter.acquire_async(quota_method)
+                response = await self.client.request(method, path, params=params, json=json,
+                                                     headers={'Authorization': 'Bearer ' + token})
+
+                if response.status_code == 401 and attempt == 0:
+                    token = await self.get_token(rejected_token=token)
+                    continue
+
+                if response.is_success:
+                    self.rate_limiter.succeeded()
+                    break
+
+                rate_limited = is_rate_limited(response.status_code, response.content)
+                if rate_limited:
+                    self.rate_limiter.throttled()
+                if not (rate_limited or response.status_code in RETRYABLE_STATUSES) or attempt == MAX_RETRIES:
+                    break
+
+                delay = self.rate_limiter.backoff(attempt)
+                logging.info(quota_method + " failed with " + str(response.status_code) + ", retrying in "
+                             + str(round(delay, 2)) + " seconds...")
+                await asyncio.sleep(delay)
+
+            response.raise_for_status()
+            return response.json() if response.content else {}
+
+    async def iter_messages(self, max_results=None, query=MAIL_QUERY, page_size=PAGE_SIZE):
+
+        """Lazily list messages from Gmail API, following the page tokens."""
+
+        count = 0
+        page_token = None
+
+        while max_results is None or count < max_results:
+            limit = page_size if max_results is None else min(page_size, max_results - count)
+            params = {'maxResults': limit, 'q': query}
+            if page_token:
+                params['pageToken'] = page_token
+            results = await self.request('GET', 'messages', 'messages.list', params=params)
+
+            for message in results.get('messages', []):
+                yield message
+                count += 1
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    async def fetch_messages(self, max_results=10):
+
+        """Fetch messages from Gmail API."""
+
+        return [message async for message in self.iter_messages(max_results)]
+
+    async def fetch_message_by_id(self, message_id, message_format='full'):
+
+        """Fetch a message by its ID from Gmail API, in 'full' or 'metadata' format."""
+
+        params = {'format': message_format}
+        if message_format == 'metadata':
+            params['metadataHeaders'] = METADATA_HEADERS
+        return await self.request('GET', 'messages/' + message_id, 'messages.get', params=params)
+
+    async def fetch_messages_concurrently(self, message_ids, message_format='full'):
+
+        """Fetch messages by their IDs with up to max_concurrency requests in flight.
+
+        Takes a sync or async iterable of IDs and yields (message_id, message)
+        tuples as the requests complete. Messages that no longer exist are skipped."""
+
+        async def fetch(message_id):
+            try:
+                return message_id, await self.fetch_message_by_id(message_id, message_format)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                logging.warning("Email ID \"" + message_id + "\" not found, Skipping...")
+                return message_id, None
+
+        async def completed(tasks, return_when):
+            done, tasks = await asyncio.wait(tasks, return_when=return_when)
+            return [task.result() for task in done], tasks
+
+        if not hasattr(message_ids, '__aiter__'):
+            message_ids = iterate(message_ids)
+
+        tasks = set()
+        try:
+            async for message_id in message_ids:
+                tasks.add(asyncio.create_task(fetch(message_id)))
+                # Keep a few requests queued behind the semaphore, not the whole mailbox
+                if len(tasks) >= self.max_concurrency * 2:
+                    results, tasks = await completed(tasks, asyncio.FIRST_COMPLETED)
+                    for message_id, message in results:
+                        if message is not None:
+                            yield message_id, message
+
+            while tasks:
+                results, tasks = await completed(tasks, asyncio.FIRST_COMPLETED)
+                for message_id, message in results:
+                    if message is not None:
+                        yield message_id, message
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_history_id(self):
+
+        """Get the current history ID of the mailbox."""
+
+        profile = await self.request('GET', 'profile', 'users.getProfile')
+        return profile['historyId']
+
+    async def modify(self, message_id, add_label_ids=(), remove_label_ids=()):
+
+        """Add and remove labels on an email."""
+
+        body = {'addLabelIds': list(add_label_ids), 'removeLabelIds': list(remove_label_ids)}
+        return await self.request('POST', 'messages/' + message_id + '/modify', 'messages.modify', json=body)
+
+    async def batch_modify(self, message_ids, add_label_ids=(), remove_label_ids=(), chunk_size=BATCH_MODIFY_SIZE):
+
+        """Add and remove labels on many emails with messages.batchModify.
+
+        Returns one result per chunk of IDs, with the 'error' of the failed ones."""
+
+        message_ids = list(message_ids)
+
+        async def modify_chunk(chunk):
+            body = {'ids': chunk, 'addLabelIds': list(add_label_ids), 'removeLabelIds': list(remove_label_ids)}
+            try:
+                await self.request('POST', 'messages/batchModify', 'messages.batchModify', json=body)
+                logging.info("Modified " + str(len(chunk)) + " Emails, Added: " + str(list(add_label_ids))
+                             + ", Removed: " + str(list(remove_label_ids)))
+                return {'ids': chunk, 'error': None}
+            except httpx.HTTPStatusError as e:
+                logging.error("Failed to modify " + str(len(chunk)) + " Emails: " + str(e))
+                return {'ids': chunk, 'error': str(e)}
+
+        chunks = [message_ids[i:i + chunk_size] for i in range(0, len(message_ids), chunk_size)]
+        return list(await asyncio.gather(*(modify_chunk(chunk) for chunk in chunks)))
+
+    async def mark_as_read(self, message_id):
+
+        """Mark an email as read."""
+
+        await self.modify(message_id, remove_label_ids=['UNREAD'])
+        logging.info("Email ID \"" + str(message_id) + "\" is marked as READ.")
+
+    async def mark_as_unread(self, message_id):
+
+        """Mark an email as unread."""
+
+        await self.modify(message_id, add_label_ids=['UNREAD'])
+        logging.info("Email ID \"" + str(message_id) + "\" is marked as UNREAD.")
+
+    async def move_to_folder(self, message_id, folder_name, create=False):
+
+        """Move an email to a specific folder/label."""
+
+        label_id = await self.get_label_id(folder_name, create)
+        if label_id:
+            await self.modify(message_id, add_label_ids=[label_id])
+            logging.info("Assigned " + folder_name + " to the Email ID " + str(message_id))
+        else:
+            logging.warning("Folder Name: \"" + folder_name + "\" not found! Skipping ...")
+
+    async def list_labels(self):
+
+        """List the labels of the account."""
+
+        results = await self.request('GET', 'labels', 'labels.list')
+        return results.get('labels', [])
+
+    async def get_label_id(self, label_name, create=False):
+
+        """Get label ID by label name, optionally creating the label if it's missing."""
+
+        key = label_name.lower()
+
+        if self.label_cache.needs_refresh(key):
+            self.label_cache.load(await self.list_labels())
+
+        label_id = self.label_cache.lookup(key, create)
+        if label_id is None and create:
+            label_id = await self.create_label(label_name)
+        return label_id
+
+    async def create_label(self, label_name):
+
+        """Create a label, adding it to the label cache. Returns its ID."""
+
+        label = await self.request('POST', 'labels', 'labels.create', json=label_body(label_name))
+        self.label_cache.add(label_name.lower(), label['id'])
+        logging.info("Created the Folder \"" + label_name + "\"")
+        return label['id']
+
+    def invalidate_label_cache(self):
+
+        """Drop the label cache, so the labels are listed again on next use."""
+
+        self.label_cache.invalidate()
+
+async def iterate(items):
+
+    """Wrap a regular iterable as an async one."""
+
+    for item in items:
+        yield item
@@ -1,64 +1,304 @@
-from sqlalchemy import create_engine, inspect
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError
-from datetime import datetime
-from config.constants import MAIL_COUNT_LIMIT
-from config.models import Base, Email
+import asyncio
+from sqlalchemy import bindparam, create_engine, event, func, inspect, literal_column, or_, select, text, update
+from sqlalchemy.orm import selectinload, sessionmaker
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+from config.constants import (FTS_ENABLED, MAIL_COUNT_LIMIT, READ_CHUNK_SIZE, SQLITE_CACHE_SIZE, SQLITE_JOURNAL_MODE,
+                              SQLITE_MMAP_SIZE, SQLITE_SYNCHRONOUS, WRITE_CHUNK_SIZE)
+from config.models import (Base, Body, Email, EmailRecord, EmailSearch, JournalEntry, Label, MessageLabel, SyncState,
+                           EMAILS_FTS_DDL, EMAILS_FTS_DROP, FTS_FIELDS, body_hash, body_missing, compress_body,
+                           email_column, fts_phrase)
+from handlers.pipeline import LoadPipeline
+from utils.date_parser import utc_now
 from utils.logging_config import logging
 
+
+def configure_connection(dbapi_connection, connection_record):
+
+    """Apply the SQLite storage profile to a new connection."""
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=' + SQLITE_JOURNAL_MODE)
+    cursor.execute('PRAGMA synchronous=' + SQLITE_SYNCHRONOUS)
+    cursor.execute('PRAGMA cache_size=' + str(int(SQLITE_CACHE_SIZE)))
+    cursor.execute('PRAGMA mmap_size=' + str(int(SQLITE_MMAP_SIZE)))
+    cursor.close()
+
+
+def email_row(message_id, details):
+
+    """Map the extracted Email details to the columns of the emails table.
+
+    The body itself goes to the bodies table, the Email only keeps its hash."""
+
+    body = details.get('Message')
+    return {
+        'id': message_id,
+        'from_mail': details.get('From'),
+        'to_mail': details.get('To'),
+        'subject': details.get('Subject'),
+        'date': details.get('Date'),
+        'body_hash': None if body is None else body_hash(body)
+    }
+
+
+def save_bodies(connection, bodies):
+
+    """Compress and store the bodies missing from the bodies table, a dict of hash to body."""
+
+    if not bodies:
+        return
+
+    stored = set(connection.execute(select(Body.hash).where(Body.hash.in_(list(bodies)))).scalars())
+    rows = [{'hash': key, 'data': compress_body(body), 'size': len(body)}
+            for key, body in bodies.items() if key not in stored]
+    if rows:
+        connection.execute(insert(Body).on_conflict_do_nothing(), rows)
+
+
+def delete_orphan_bodies(connection):
+
+    """Delete the bodies no Email points to anymore."""
+
+    connection.execute(Body.__table__.delete().where(
+        Body.hash.not_in(select(Email.body_hash).where(Email.body_hash.is_not(None)))
+    ))
+
+
+class EmailWriter:
+
+    """Buffer Emails and insert them in chunks, one transaction per chunk.
+
+    Emails already in the DB are skipped by the INSERT itself, and bodies
+    already stored aren't compressed again. Use it as a context manager, so
+    the buffered Emails are always flushed on exit."""
+
+    def __init__(self, engine, chunk_size=WRITE_CHUNK_SIZE):
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.bodies = {}
+        self.label_rows = []
+        # IDs of the buffered Emails whose labels are known, replacing the ones stored
+        self.labeled_ids = []
+        self.inserted = 0
+        self.duplicates = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, message_id, details):
+
+        """Queue an Email, flushing the buffer once it is full."""
+
+        row = email_row(message_id, details)
+        self.buffer.append(row)
+        if row['body_hash'] is not None:
+            self.bodies[row['body_hash']] = details['Message']
+        if details.get('Labels') is not None:
+            self.labeled_ids.append(message_id)
+            self.label_rows += [{'message_id': message_id, 'label_id': label_id} for label_id in details['Labels']]
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+
+        """Write the buffered Emails in a single transaction."""
+
+        if not self.buffer:
+            return
+
+        statement = insert(Email).on_conflict_do_nothing(index_elements=['id'])
+        with self.engine.begin() as connection:
+            # Before the Emails, the full text index reads their bodies
+            save_bodies(connection, self.bodies)
+            result = connection.execute(statement, self.buffer)
+            # The labels fetched now replace any stored before, rather than merging into them
+            if self.labeled_ids:
+                connection.execute(MessageLabel.__table__.delete().where(MessageLabel.message_id.in_(self.labeled_ids)))
+            if self.label_rows:
+                connection.execute(insert(MessageLabel).on_conflict_do_nothing(), self.label_rows)
+
+        self.inserted += result.rowcount
+        self.duplicates += len(self.buffer) - result.rowcount
+        self.buffer = []
+        self.bodies = {}
+        self.label_rows = []
+        self.labeled_ids = []
+
+    def close(self):
+
+        """Flush whatever is left in the buffer."""
+
+        self.flush()
+        if self.duplicates:
+            logging.info("Duplicate Emails Found, Skipped: " + str(self.duplicates))
+
+
+class ActionJournal:
+
+    """The label changes already applied to each email, by each ruleset.
+
+    Label changes are (label_id, add, ruleset_hash) tuples. Reruns drop the
+    ones found in the journal, and the rest are recorded as soon as their
+    modify request succeeds, so a run stopped part-way resumes where it
+    stopped."""
+
+    def __init__(self, engine, chunk_size=WRITE_CHUNK_SIZE):
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.skipped = 0
+
+    def unapplied(self, message_ids, changes):
+
+        """Group the emails by the changes they still need, dropping the journaled ones."""
+
+        hashes = {ruleset_hash for _, _, ruleset_hash in changes}
+        groups = {}
+
+        for i in range(0, len(message_ids), self.chunk_size):
+            chunk = message_ids[i:i + self.chunk_size]
+            statement = select(JournalEntry.message_id, JournalEntry.ruleset_hash, JournalEntry.action).where(
+                JournalEntry.message_id.in_(chunk), JournalEntry.ruleset_hash.in_(hashes)
+            )
+            with self.engine.connect() as connection:
+                applied = set(connection.execute(statement))
+
+            for message_id in chunk:
+                remaining = tuple(change for change in changes
+                                  if (message_id, change[2], journal_action(change)) not in applied)
+                self.skipped += len(changes) - len(remaining)
+                if remaining:
+                    groups.setdefault(remaining, []).append(message_id)
+
+        return groups
+
+    def record(self, message_ids, changes):
+
+        """Record the changes as applied to the emails, and mirror them in their local labels."""
+
+        applied_at = utc_now()
+        added = [label_id for label_id, add, _ in changes if add]
+        removed = [label_id for label_id, add, _ in changes if not add]
+
+        for i in range(0, len(message_ids), self.chunk_size):
+            chunk = message_ids[i:i + self.chunk_size]
+            rows = [{'message_id': message_id, 'ruleset_hash': ruleset_hash,
+                     'action': journal_action((label_id, add)), 'applied_at': applied_at}
+                    for message_id in chunk for label_id, add, ruleset_hash in changes]
+            with self.engine.begin() as connection:
+                connection.execute(insert(JournalEntry).on_conflict_do_nothing(), rows)
+                if added:
+                    connection.execute(insert(MessageLabel).on_conflict_do_nothing(),
+                                       [{'message_id': message_id, 'label_id': label_id}
+                                        for message_id in chunk for label_id in added])
+                if removed:
+                    connection.execute(MessageLabel.__table__.delete().where(
+                        MessageLabel.message_id.in_(chunk), MessageLabel.label_id.in_(removed)
+                    ))
+
+
+def journal_action(change):
+
+    """Name a label change in the journal."""
+
+    label_id, add = change[:2]
+    return ('add:' if add else 'remove:') + label_id
+
+
 class DatabaseHandler:
-    def __init__(self, load_flag, update_flag, gmail_handler):
+    def __init__(self, load_flag, update_flag, gmail_handler, fetch_bodies=True):
 
         ''' Init DB Engine '''
 
         logging.info("Initialising the Database Connection...")
 
         self.engine = create_engine('sqlite:///emails.db')
+        event.listen(self.engine, 'connect', configure_connection)
         Base.metadata.create_all(self.engine)
+        self.migrate_schema()
         self.Session = sessionmaker(bind=self.engine)
+        self.fts_enabled = FTS_ENABLED and self.create_fts_index()
 
         logging.info("Database successfully connected.\n")
 
         self.load_flag = load_flag
         self.update_flag = update_flag
         self.gmail_handler = gmail_handler
+        # Without bodies, only the headers are fetched and the message column is left NULL
+        self.message_format = 'full' if fetch_bodies else 'metadata'
         self.run()
 
     def save_email_to_db(self, message_id, details):
         # Add the given Email to the DB
 
-        try:
-            session = self.Session()
-            email = Email(
-                id=message_id,
-                from_mail=details.get('From'),
-                to_mail=details.get('To'),
-                subject=details.get('Subject'),
-                date=details.get('Date'),
-                message=details.get('Message')
-            )
-            session.add(email)
-            session.commit()
-            session.close()
-        except IntegrityError:
-            logging.info("Duplicate Email Found, Skipping...\n")
+        with self.email_writer() as writer:
+            writer.add(message_id, details)
+
+    def email_writer(self, chunk_size=WRITE_CHUNK_SIZE):
+
+        """Create a buffered writer for saving Emails in bulk."""
+
+        return EmailWriter(self.engine, chunk_size)
 
-    def fetch_emails_from_db(self):
+    def action_journal(self):
 
-        """Fetch and print all emails from the database."""
+        """Get the journal of the actions already applied to the emails."""
+
+        return ActionJournal(self.engine)
+
+    def fetch_emails_from_db(self, criterion=None):
+
+        """Fetch all emails from the database, optionally filtered by a WHERE clause."""
 
         session = self.Session()
-        emails = session.query(Email).all()
+        # The Emails are detached once returned, so their bodies are loaded now, decompressed when read
+        query = session.query(Email).options(selectinload(Email.body))
+        if criterion is not None:
+            query = query.filter(criterion)
+        emails = query.all()
         session.close()
         return emails
 
+    def iter_emails(self, criterion=None, columns=None, chunk_size=READ_CHUNK_SIZE):
+
+        """Stream the emails from the database as light rows, optionally filtered by a WHERE clause.
+
+        columns names the Email fields to read, all of them by default. The rows
+        are fetched chunk_size at a time, so memory stays bounded on any
+        mailbox size."""
+
+        columns = columns or [column.name for column in Email.__table__.columns]
+        statement = select(*[email_column(column) for column in columns])
+        if criterion is not None:
+            statement = statement.where(criterion)
+
+        session = self.Session()
+        try:
+            yield from session.execute(statement.execution_options(yield_per=chunk_size))
+        finally:
+            session.close()
+
+    def iter_records(self, criterion=None, columns=None, chunk_size=READ_CHUNK_SIZE):
+
+        """Stream the emails from the database as EmailRecords, for the rules."""
+
+        columns = list(columns or [column.name for column in Email.__table__.columns])
+        build = EmailRecord.builder(columns)
+        for row in self.iter_emails(criterion, columns, chunk_size):
+            yield build(row)
+
     def get_latest_email_date(self):
 
         ''' Find the latest email's date from the database '''
 
+        # Answered from the end of the date index
         session = self.Session()
-        latest_email = session.query(Email).order_by(Email.date.desc()).first()
-        latest_date = latest_email.date if latest_email else None
+        latest_date = session.query(func.max(Email.date)).scalar()
         session.close()
         return latest_date
     
@@ -70,41 +310,211 @@ class DatabaseHandler:
 
         logging.info("Loading the database with emails from the inbox...")
 
-        messages = self.gmail_handler.fetch_messages(MAIL_COUNT_LIMIT)
+        # Taken before listing, so changes made while loading are caught by the next sync
+        history_id = self.gmail_handler.get_history_id()
+        self.save_labels(self.gmail_handler.list_labels())
+
+        # Stream the IDs page by page, batches are fetched while listing continues
+        messages = self.gmail_handler.iter_messages(MAIL_COUNT_LIMIT)
+        count = self.store_messages(message['id'] for message in messages)
+
+        self.save_sync_history_id(history_id)
+
+        logging.info("Total Emails Loaded: " + str(count))
+        logging.info("Done loading all the Emails.\n")
+
+    async def load_db_async(self, gmail_handler):
+
+        """Load the database with emails through an AsyncGmailHandler.
+
+        The fetched Mails are decoded and written in a worker thread, one chunk
+        at a time, so the event loop keeps the requests flowing meanwhile."""
 
-        logging.info("Total Emails Found: " + str(len(messages)))
+        await asyncio.to_thread(self.empty_table)
+
+        logging.info("Loading the database with emails from the inbox...")
 
-        for message in messages:
-            message_id = message['id']
-            # Get the Mail
-            msg = self.gmail_handler.fetch_message_by_id(message_id)
-            # Extract the Mail Details to save in the DB
-            email_details = self.gmail_handler.get_email_details(msg)
-            # Save it in the DB
-            self.save_email_to_db(message_id, email_details)
+        history_id = await gmail_handler.get_history_id()
+        labels = await gmail_handler.list_labels()
+        await asyncio.to_thread(self.save_labels, labels)
+        message_ids = (message['id'] async for message in gmail_handler.iter_messages(MAIL_COUNT_LIMIT))
+        writer = self.email_writer()
+        count = 0
 
+        def write(messages):
+            for message_id, msg in messages:
+                writer.add(message_id, gmail_handler.get_email_details(msg))
+
+        writing = None
+        chunk = []
+        try:
+            async for message_id, msg in gmail_handler.fetch_messages_concurrently(message_ids, self.message_format):
+                chunk.append((message_id, msg))
+                count += 1
+                if len(chunk) >= writer.chunk_size:
+                    # The writer isn't thread safe, so only one chunk is written at a time
+                    if writing:
+                        await writing
+                    writing = asyncio.ensure_future(asyncio.to_thread(write, chunk))
+                    chunk = []
+            if writing:
+                await writing
+            await asyncio.to_thread(write, chunk)
+        finally:
+            # A chunk may still be writing if fetching failed, and the writer isn't thread safe
+            if writing:
+                await asyncio.gather(writing, return_exceptions=True)
+            await asyncio.to_thread(writer.close)
+
+        await asyncio.to_thread(self.save_sync_history_id, history_id)
+
+        logging.info("Total Emails Loaded: " + str(count))
         logging.info("Done loading all the Emails.\n")
 
     def update_db(self):
 
-        """Update the database with newer emails from Gmail API."""
+        """Update the database with the mailbox changes since the last sync."""
+
+        history_id = self.get_sync_history_id()
+        if not history_id:
+            logging.info("No sync state found, falling back to a full load...")
+            return self.load_db()
+
+        logging.info("Syncing the database with the changes since History ID " + str(history_id) + "...")
+
+        changes = self.gmail_handler.fetch_history(history_id)
+        if changes is None:
+            logging.info("Sync state has expired, falling back to a full load...")
+            return self.load_db()
+
+        # Drop the Emails deleted from the mailbox
+        self.delete_emails(changes['deleted'])
+
+        # Keep the local labels of the relabeled Emails current
+        self.save_labels(self.gmail_handler.list_labels())
+        self.save_message_labels({message_id: label_ids for message_id, label_ids in changes['labels'].items()
+                                  if message_id in changes['relabeled']})
+
+        # Only fetch the Emails added since the last sync
+        self.store_messages(changes['added'])
+
+        self.save_sync_history_id(changes['history_id'])
+
+        logging.info("Emails Added: " + str(len(changes['added'])) + ", Deleted: " + str(len(changes['deleted']))
+                     + ", Relabeled: " + str(len(changes['relabeled'])) + "\n")
+
+    def store_messages(self, message_ids):
+
+        """Fetch the Mails with the given IDs and save them in the DB.
+
+        Fetching, decoding and writing run concurrently in a LoadPipeline.
+        Returns the number of Emails saved."""
+
+        with self.email_writer() as writer:
+            return LoadPipeline(self.gmail_handler, writer, message_format=self.message_format).run(message_ids)
+
+    def load_bodies(self, criterion=None):
+
+        """Fetch the bodies of the emails loaded without one, and save them in the DB.
+
+        Only the emails matching the criterion are fetched. Returns the number
+        of bodies fetched."""
+
+        statement = select(Email.id).where(body_missing())
+        if criterion is not None:
+            statement = statement.where(criterion)
+        with self.engine.connect() as connection:
+            message_ids = connection.execute(statement).scalars().all()
+
+        if not message_ids:
+            return 0
+
+        logging.info("Fetching the bodies of " + str(len(message_ids)) + " Emails...")
+
+        update_statement = update(Email).where(Email.id == bindparam('email_id')).values(body_hash=bindparam('key'))
+        rows = []
+        bodies = {}
+        count = 0
+
+        for message_id, message in self.gmail_handler.fetch_messages_batch(message_ids):
+            # An empty body marks Mails without a text part as fetched
+            body = self.gmail_handler.get_email_details(message).get('Message') or ''
+            key = body_hash(body)
+            bodies[key] = body
+            rows.append({'email_id': message_id, 'key': key})
+            if len(rows) >= WRITE_CHUNK_SIZE:
+                count += self.update_bodies(update_statement, rows, bodies)
+                rows = []
+                bodies = {}
 
-        # Get the latest email date from the DB
-        latest_date = self.get_latest_email_date().replace(' (UTC)', '')
-        if latest_date:
-            latest_date = datetime.strptime(latest_date, '%a, %d %b %Y %H:%M:%S %z')
+        return count + self.update_bodies(update_statement, rows, bodies)
 
-        messages = self.gmail_handler.fetch_messages(MAIL_COUNT_LIMIT)
+    def update_bodies(self, statement, rows, bodies):
+        if rows:
+            with self.engine.begin() as connection:
+                save_bodies(connection, bodies)
+                connection.execute(statement, rows)
+        return len(rows)
 
-        for message in messages:
-            msg_id = message['id']
-            msg = self.gmail_handler.fetch_message_by_id(msg_id)
-            email_details = self.gmail_handler.get_email_details(msg)
-            email_date = datetime.strptime(email_details['Date'].replace(' (UTC)', ''), '%a, %d %b %Y %H:%M:%S %z')
+    def get_sync_history_id(self):
 
-            # Only insert emails received after the latest DB Email
-            if not latest_date or email_date > latest_date:
-                self.save_email_to_db(msg_id, email_details)
+        """Get the mailbox history ID stored by the last sync."""
+
+        session = self.Session()
+        state = session.get(SyncState, 1)
+        history_id = state.history_id if state else None
+        session.close()
+        return history_id
+
+    def save_sync_history_id(self, history_id):
+
+        """Store the mailbox history ID the database is in sync with."""
+
+        session = self.Session()
+        session.merge(SyncState(id=1, history_id=str(history_id)))
+        session.commit()
+        session.close()
+
+    def delete_emails(self, message_ids):
+
+        """Delete the given emails, and their labels, from the database."""
+
+        if not message_ids:
+            return
+
+        session = self.Session()
+        session.query(Email).filter(Email.id.in_(list(message_ids))).delete(synchronize_session=False)
+        session.query(MessageLabel).filter(MessageLabel.message_id.in_(list(message_ids))).delete(synchronize_session=False)
+        delete_orphan_bodies(session)
+        session.commit()
+        session.close()
+
+    def save_labels(self, labels):
+
+        """Replace the labels of the mailbox with the ones listed from Gmail."""
+
+        with self.engine.begin() as connection:
+            connection.execute(Label.__table__.delete())
+            if labels:
+                connection.execute(insert(Label), [{'id': label['id'], 'name': label['name']} for label in labels])
+
+    def save_message_labels(self, message_labels):
+
+        """Replace the labels of the given emails, a dict of message ID to label IDs.
+
+        Only the emails in the DB get labels, the history also reports Mails
+        outside of the synced ones."""
+
+        if not message_labels:
+            return
+
+        with self.engine.begin() as connection:
+            stored = set(connection.execute(select(Email.id).where(Email.id.in_(list(message_labels)))).scalars())
+            rows = [{'message_id': message_id, 'label_id': label_id}
+                    for message_id, label_ids in message_labels.items() if message_id in stored for label_id in label_ids]
+            connection.execute(MessageLabel.__table__.delete().where(MessageLabel.message_id.in_(list(message_labels))))
+            if rows:
+                connection.execute(insert(MessageLabel), rows)
 
     def run(self):
 
@@ -117,14 +527,111 @@ class DatabaseHandler:
 
     def empty_table(self):
 
-        """Empty the emails table in the database."""
+        """Empty the emails table, and their labels, in the database."""
 
         session = self.Session()
         session.query(Email).delete()
+        session.query(MessageLabel).delete()
+        session.query(Body).delete()
         session.commit()
         session.close()
 
-    
+    def migrate_schema(self):
+
+        """Bring a DB created by an older version up to date with the models.
+
+        create_all only creates the missing tables, so the columns and indexes
+        added to the existing tables since are created here."""
+
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in columns:
+                        logging.info("Adding the column " + table.name + "." + column.name + " to the DB...")
+                        column_type = column.type.compile(dialect=self.engine.dialect)
+                        connection.execute(text('ALTER TABLE ' + table.name + ' ADD COLUMN ' + column.name + ' ' + column_type))
+                for index in table.indexes:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+
+        self.compress_inline_bodies()
+
+    def compress_inline_bodies(self):
+
+        """Move the bodies stored in emails.message by older versions to the compressed bodies table."""
+
+        statement = (select(Email.id, Email.inline_message)
+                     .where(Email.inline_message.is_not(None), Email.body_hash.is_(None))
+                     .limit(WRITE_CHUNK_SIZE))
+        update_statement = (update(Email).where(Email.id == bindparam('email_id'))
+                            .values(body_hash=bindparam('key'), inline_message=None))
+        count = 0
+
+        while True:
+            with self.engine.begin() as connection:
+                rows = connection.execute(statement).all()
+                if not rows:
+                    break
+                bodies = {body_hash(body): body for _, body in rows}
+                save_bodies(connection, bodies)
+                connection.execute(update_statement, [{'email_id': message_id, 'key': body_hash(body)}
+                                                      for message_id, body in rows])
+            count += len(rows)
+
+        if count:
+            logging.info("Compressed the bodies of " + str(count) + " Emails.")
+
+    def create_fts_index(self):
+
+        """Create the full text index over the Emails, if SQLite supports it.
+
+        Triggers keep the index in sync with the emails table. Returns whether
+        the index is available."""
+
+        try:
+            with self.engine.begin() as connection:
+                indexed = inspect(connection).has_table('emails_fts')
+                definition = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'emails_fts'")).scalar()
+                if indexed and 'email_texts' not in definition:
+                    # Created before the bodies were compressed, it can't read them
+                    for statement in EMAILS_FTS_DROP:
+                        connection.execute(text(statement))
+                    indexed = False
+                for statement in EMAILS_FTS_DDL:
+                    connection.execute(text(statement))
+                if not indexed:
+                    # Index the Emails stored before the index existed
+                    connection.execute(text("INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')"))
+        except OperationalError as e:
+            logging.warning("Full text index unavailable, text rules will scan the table: " + str(e))
+            return False
+
+        return True
+
+    def search_emails(self, query, fields=FTS_FIELDS, limit=50):
+
+        """Search the Emails whose fields contain the query, best matches first.
+
+        Queries of 3+ characters go through the full text index, shorter ones
+        fall back to a table scan."""
+
+        session = self.Session()
+        emails_query = session.query(Email).options(selectinload(Email.body))
+
+        if self.fts_enabled and len(query) >= 3:
+            matches = select(EmailSearch.c.rowid, EmailSearch.c.rank).where(
+                EmailSearch.c.emails_fts.op('MATCH')(fts_phrase(query, fields))
+            ).subquery()
+            emails_query = emails_query.join(matches, literal_column('emails.rowid') == matches.c.rowid).order_by(matches.c.rank)
+        else:
+            conditions = [getattr(Email, field).icontains(query, autoescape=True) for field in fields]
+            emails_query = emails_query.filter(or_(*conditions)).order_by(Email.date.desc())
+
+        emails = emails_query.limit(limit).all()
+        session.close()
+        return emails
+
     def table_exists(self):
 
         """Check if the emails table exists in the database."""
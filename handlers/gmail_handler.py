@@ -2,19 +2,74 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import os
-import base64
-from datetime import datetime
-import pytz
+import copy
+import time
+from config.constants import (BATCH_MODIFY_SIZE, BATCH_SIZE, EXCLUDED_LABEL_IDS, MAIL_QUERY, MAX_RETRIES, PAGE_SIZE,
+                              SYNC_LABEL_ID)
+from utils.date_parser import parse_date
+from utils.label_cache import LabelCache
 from utils.logging_config import logging
+from utils.mime import extract_body
+from utils.rate_limiter import RateLimiter
 
 # If modifying these SCOPES, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# History record types tracked by incremental syncs
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+
+# Headers requested when only the metadata of the Mails is fetched
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+
+# HTTP statuses worth retrying: quota errors and transient server errors.
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def is_retryable_error(exception):
+
+    """Check whether a failed Gmail request is worth retrying."""
+
+    if not isinstance(exception, HttpError):
+        return False
+
+    return exception.resp.status in RETRYABLE_STATUSES or is_rate_limit_error(exception)
+
+
+def is_rate_limit_error(exception):
+
+    """Check whether a failed Gmail request went over the quota."""
+
+    if not isinstance(exception, HttpError):
+        return False
+
+    return is_rate_limited(exception.resp.status, exception.content)
+
+
+def is_rate_limited(status, content):
+
+    """Check whether a Gmail response, given its HTTP status and body, went over the quota."""
+
+    # Gmail reports per-user rate limits as 403 rather than 429 too
+    return status == 429 or (status == 403 and b'ateLimitExceeded' in content)
+
+
+def label_body(label_name):
+
+    """Build the labels.create request body of a folder shown in the label and message lists."""
+
+    return {'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+
+
 class GmailHandler:
-    def __init__(self):
+    def __init__(self, rate_limiter=None, clock=time.monotonic):
         self.creds = None
         self.service = None
+        # Label name -> label ID, loaded on first use
+        self.label_cache = LabelCache(clock=clock)
+        # Shared by the clones, so concurrent threads stay within one quota
+        self.rate_limiter = rate_limiter or RateLimiter()
         self.authenticate()
 
     def authenticate(self):
@@ -40,7 +95,43 @@ class GmailHandler:
         
         logging.info("Authentication successful!\n")
 
-        self.service = build('gmail', 'v1', credentials=self.creds)
+        self.service = self.build_service()
+
+    def build_service(self):
+
+        """Build a Gmail API service with the current credentials."""
+
+        return build('gmail', 'v1', credentials=self.creds)
+
+    def clone(self):
+
+        """Create a handler sharing these credentials, with its own service.
+
+        The underlying httplib2 connection isn't thread safe, so every thread
+        making requests needs its own clone."""
+
+        handler = copy.copy(self)
+        handler.service = self.build_service()
+        return handler
+
+    def execute(self, request, method):
+
+        """Execute a Gmail API request within the quota, retrying quota and server errors."""
+
+        for attempt in range(MAX_RETRIES + 1):
+            self.rate_limiter.acquire(method)
+            try:
+                response = request.execute()
+                self.rate_limiter.succeeded()
+                return response
+            except HttpError as e:
+                if not is_retryable_error(e) or attempt == MAX_RETRIES:
+                    raise
+                if is_rate_limit_error(e):
+                    self.rate_limiter.throttled()
+                delay = self.rate_limiter.backoff(attempt)
+                logging.info(method + " failed with " + str(e.resp.status) + ", retrying in " + str(round(delay, 2)) + " seconds...")
+                self.rate_limiter.sleep(delay)
 
     def get_email_details(self, message):
 
@@ -56,17 +147,17 @@ class GmailHandler:
             elif name == 'Subject':
                 details['Subject'] = value
             elif name == 'Date':
-                details['Date'] = datetime.strptime(value.replace(' (UTC)', ''), '%a, %d %b %Y %H:%M:%S %z').astimezone(pytz.utc)
+                details['Date'] = parse_date(value)
             elif name == "To":
                 details["To"] = value
 
-        parts = message.get('payload', {}).get('parts', [])
-        if parts:
-            for part in parts:
-                if part['mimeType'] == 'text/plain':
-                    details['Message'] = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-        else:
-            details['Message'] = base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
+        if 'labelIds' in message:
+            details['Labels'] = message['labelIds']
+
+        # Mails fetched in 'metadata' format have no body, their Message is left out
+        body = extract_body(message.get('payload', {}))
+        if body is not None:
+            details['Message'] = body
 
         return details
     
@@ -74,47 +165,303 @@ class GmailHandler:
 
         """Fetch messages from Gmail API."""
 
-        query = 'category:primary'
-        results = self.service.users().messages().list(userId='me', maxResults=max_results, q=query).execute()
-        messages = results.get('messages', [])
-        return messages
+        return list(self.iter_messages(max_results))
 
-    def fetch_message_by_id(self, message_id):
+    def iter_messages(self, max_results=None, query=MAIL_QUERY, page_size=PAGE_SIZE):
+
+        """Lazily list messages from Gmail API, following the page tokens.
+
+        Message stubs are yielded as each page arrives, and the next page is only
+        requested once the previous one has been consumed."""
+
+        count = 0
+        page_token = None
+
+        while max_results is None or count < max_results:
+            limit = page_size if max_results is None else min(page_size, max_results - count)
+            request = self.service.users().messages().list(userId='me', maxResults=limit, q=query, pageToken=page_token)
+            results = self.execute(request, 'messages.list')
+
+            for message in results.get('messages', []):
+                yield message
+                count += 1
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    def message_request(self, message_id, message_format='full'):
+
+        """Build the request getting a message, in 'full' or 'metadata' format.
+
+        The 'metadata' format only carries the headers the Emails keep, and none
+        of the MIME parts and attachments."""
+
+        if message_format == 'metadata':
+            return self.service.users().messages().get(userId='me', id=message_id, format='metadata',
+                                                       metadataHeaders=METADATA_HEADERS)
+        return self.service.users().messages().get(userId='me', id=message_id, format=message_format)
+
+    def fetch_message_by_id(self, message_id, message_format='full'):
 
         """Fetch a message by its ID from Gmail API."""
 
-        message = self.service.users().messages().get(userId='me', id=message_id, format='full').execute()
+        message = self.execute(self.message_request(message_id, message_format), 'messages.get')
         return message
+
+    def fetch_messages_batch(self, message_ids, batch_size=BATCH_SIZE, message_format='full'):
+
+        """Fetch messages by their IDs, grouping them into Gmail batch requests.
+
+        Yields (message_id, message) tuples as every batch completes, so callers
+        can start processing before all the messages are fetched."""
+
+        chunk = []
+        for message_id in message_ids:
+            chunk.append(message_id)
+            if len(chunk) >= batch_size:
+                yield from self._execute_batch(chunk, message_format)
+                chunk = []
+
+        if chunk:
+            yield from self._execute_batch(chunk, message_format)
+
+    def _execute_batch(self, message_ids, message_format='full'):
+
+        """Run one batch of message gets, retrying the items that failed transiently."""
+
+        # Batch request IDs must be unique
+        pending = list(dict.fromkeys(message_ids))
+
+        for attempt in range(MAX_RETRIES + 1):
+            results = {}
+            failed = []
+            throttled = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = response
+                elif is_retryable_error(exception):
+                    failed.append(request_id)
+                    if is_rate_limit_error(exception):
+                        throttled.append(request_id)
+                else:
+                    logging.warning("Failed to fetch Email ID \"" + request_id + "\": " + str(exception))
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(self.message_request(message_id, message_format), request_id=message_id)
+
+            # Every request in the batch counts against the quota
+            self.rate_limiter.acquire('messages.get', len(pending))
+
+            try:
+                batch.execute()
+            except HttpError as e:
+                if not is_retryable_error(e):
+                    raise
+                if is_rate_limit_error(e):
+                    throttled.append(None)
+                # The whole batch was rejected, retry everything without a result
+                failed = [message_id for message_id in pending if message_id not in results]
+
+            for message_id in pending:
+                if message_id in results:
+                    yield message_id, results[message_id]
+
+            if results:
+                self.rate_limiter.succeeded(len(results))
+            if throttled:
+                self.rate_limiter.throttled()
+
+            pending = failed
+            if not pending:
+                return
+
+            if attempt < MAX_RETRIES:
+                delay = self.rate_limiter.backoff(attempt)
+                logging.info("Retrying " + str(len(pending)) + " Emails in " + str(round(delay, 2)) + " seconds...")
+                self.rate_limiter.sleep(delay)
+
+        logging.warning("Giving up on " + str(len(pending)) + " Emails after " + str(MAX_RETRIES) + " retries.")
     
-    def move_to_folder(self, message_id, folder_name):
+    def get_history_id(self):
+
+        """Get the current history ID of the mailbox."""
+
+        profile = self.execute(self.service.users().getProfile(userId='me'), 'users.getProfile')
+        return profile['historyId']
+
+    def fetch_history(self, start_history_id, label_id=SYNC_LABEL_ID):
+
+        """Fetch the mailbox changes made since the given history ID.
+
+        Returns a dict with the 'added', 'deleted' and 'relabeled' message IDs,
+        the latest 'labels' seen of each message and the new 'history_id', or
+        None if the start history ID has expired and a full sync is required.
+        Mails gaining the label_id count as added, and Mails losing it as
+        deleted. Like messages.list, the Mails in the trash or spam are left
+        out: moving a Mail there deletes it, and moving it back adds it again."""
+
+        added, deleted, relabeled = set(), set(), set()
+        labels = {}
+        history_id = start_history_id
+        page_token = None
+
+        def add(message_id):
+            added.add(message_id)
+            deleted.discard(message_id)
+
+        def delete(message_id):
+            deleted.add(message_id)
+            added.discard(message_id)
+
+        def synced(item):
+            # Without the labels of the Mail, it's taken as synced
+            label_ids = item['message'].get('labelIds')
+            return label_ids is None or (label_id in label_ids and not any(
+                excluded in label_ids for excluded in EXCLUDED_LABEL_IDS))
+
+        while True:
+            try:
+                # Not filtered by label_id, as Gmail would leave out the Mails that lost it
+                request = self.service.users().history().list(
+                    userId='me', startHistoryId=start_history_id, historyTypes=HISTORY_TYPES,
+                    maxResults=PAGE_SIZE, pageToken=page_token
+                )
+                results = self.execute(request, 'history.list')
+            except HttpError as e:
+                if e.resp.status == 404:
+                    logging.warning("History ID " + str(start_history_id) + " has expired.")
+                    return None
+                raise
+
+            # Records are in chronological order, so later changes win
+            for record in results.get('history', []):
+                for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                    for item in record.get(key, []):
+                        if 'labelIds' in item['message']:
+                            labels[item['message']['id']] = item['message']['labelIds']
+                for item in record.get('messagesAdded', []):
+                    if label_id in item['message'].get('labelIds', []) and synced(item):
+                        add(item['message']['id'])
+                for item in record.get('messagesDeleted', []):
+                    delete(item['message']['id'])
+                for item in record.get('labelsAdded', []):
+                    changed = item.get('labelIds', [])
+                    if any(excluded in changed for excluded in EXCLUDED_LABEL_IDS):
+                        delete(item['message']['id'])
+                    elif label_id in changed and synced(item):
+                        add(item['message']['id'])
+                    else:
+                        relabeled.add(item['message']['id'])
+                for item in record.get('labelsRemoved', []):
+                    changed = item.get('labelIds', [])
+                    if label_id in changed:
+                        delete(item['message']['id'])
+                    elif any(excluded in changed for excluded in EXCLUDED_LABEL_IDS) and synced(item):
+                        add(item['message']['id'])
+                    else:
+                        relabeled.add(item['message']['id'])
+
+            history_id = results.get('historyId', history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        return {
+            'added': added,
+            'deleted': deleted,
+            'relabeled': relabeled - added - deleted,
+            'labels': labels,
+            'history_id': history_id
+        }
+
+    def move_to_folder(self, message_id, folder_name, create=False):
 
         """Move an email to a specific folder/label."""
 
         # Get the label ID by folder_name
-        label_id = self.get_label_id(folder_name)
+        label_id = self.get_label_id(folder_name, create)
         if label_id:
-            self.service.users().messages().modify(userId='me', id=message_id, body={'addLabelIds': [label_id]}).execute()
+            request = self.service.users().messages().modify(userId='me', id=message_id, body={'addLabelIds': [label_id]})
+            self.execute(request, 'messages.modify')
             logging.info("Assigned " + folder_name + " to the Email ID " + str(message_id))
         else:
             logging.warn("Folder Name: \"" + folder_name + "\" not found! Skipping ...")
 
-    def get_label_id(self, label_name):
+    def batch_modify(self, message_ids, add_label_ids=(), remove_label_ids=(), chunk_size=BATCH_MODIFY_SIZE):
 
-        """Get label ID by label name."""
+        """Add and remove labels on many emails with messages.batchModify.
 
-        labels = self.service.users().labels().list(userId='me').execute().get('labels', [])
+        Returns one result per chunk of IDs, with the 'error' of the failed ones."""
+
+        message_ids = list(message_ids)
+        results = []
+
+        for i in range(0, len(message_ids), chunk_size):
+            chunk = message_ids[i:i + chunk_size]
+            body = {'ids': chunk, 'addLabelIds': list(add_label_ids), 'removeLabelIds': list(remove_label_ids)}
+            try:
+                self.execute(self.service.users().messages().batchModify(userId='me', body=body), 'messages.batchModify')
+                results.append({'ids': chunk, 'error': None})
+                logging.info("Modified " + str(len(chunk)) + " Emails, Added: " + str(list(add_label_ids))
+                             + ", Removed: " + str(list(remove_label_ids)))
+            except HttpError as e:
+                results.append({'ids': chunk, 'error': str(e)})
+                logging.error("Failed to modify " + str(len(chunk)) + " Emails: " + str(e))
+
+        return results
+
+    def get_label_id(self, label_name, create=False):
+
+        """Get label ID by label name, optionally creating the label if it's missing."""
+
+        key = label_name.lower()
+
+        if self.label_cache.needs_refresh(key):
+            self.refresh_label_cache()
+
+        label_id = self.label_cache.lookup(key, create)
+        if label_id is None and create:
+            label_id = self.create_label(label_name)
+        return label_id
+
+    def create_label(self, label_name):
+
+        """Create a label, adding it to the label cache. Returns its ID."""
+
+        label = self.execute(self.service.users().labels().create(userId='me', body=label_body(label_name)), 'labels.create')
+        self.label_cache.add(label_name.lower(), label['id'])
+        logging.info("Created the Folder \"" + label_name + "\"")
+        return label['id']
+
+    def refresh_label_cache(self):
+
+        """List the labels of the account into the label cache."""
+
+        self.list_labels()
+
+    def list_labels(self):
+
+        """List the labels of the account, loading them into the label cache on the way."""
+
+        labels = self.execute(self.service.users().labels().list(userId='me'), 'labels.list').get('labels', [])
+        self.label_cache.load(labels)
+        return labels
+
+    def invalidate_label_cache(self):
+
+        """Drop the label cache, so the labels are listed again on next use."""
+
+        self.label_cache.invalidate()
 
-        for label in labels:
-            if label['name'].lower() == label_name.lower():
-                return label['id']
-            
-        return None
-    
     def mark_as_read(self, message_id):
 
         """Mark an email as read."""
 
-        self.service.users().messages().modify(userId='me', id=message_id, body={'removeLabelIds': ['UNREAD']}).execute()
+        request = self.service.users().messages().modify(userId='me', id=message_id, body={'removeLabelIds': ['UNREAD']})
+        self.execute(request, 'messages.modify')
 
         logging.info("Email ID \"" + str(message_id) + "\" is marked as READ.")
 
@@ -122,7 +469,8 @@ class GmailHandler:
 
         """Mark an email as read."""
 
-        self.service.users().messages().modify(userId='me', id=message_id, body={'addLabelIds': ['UNREAD']}).execute()
+        request = self.service.users().messages().modify(userId='me', id=message_id, body={'addLabelIds': ['UNREAD']})
+        self.execute(request, 'messages.modify')
 
         logging.info("Email ID \"" + str(message_id) + "\" is marked as UNREAD.")
 
@@ -0,0 +1,160 @@
+import queue
+import threading
+from config.constants import BATCH_SIZE, FETCH_WORKERS, PARSE_WORKERS, QUEUE_SIZE
+from utils.logging_config import logging
+
+"""
+Concurrent loading of Emails into the DB, in three stages:
+- fetch: a pool of threads fetching the Mails in batches, each with its own Gmail service
+- parse: threads extracting the Email details from the fetched Mails
+- write: a single thread saving the Emails through an EmailWriter
+
+The stages are connected by bounded queues, so a slow stage holds back the
+ones feeding it instead of letting the fetched Mails pile up in memory.
+"""
+
+# Marks the end of the work for a stage
+DONE = object()
+
+# How often (seconds) blocked stages check whether the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class LoadPipeline:
+
+    def __init__(self, gmail_handler, email_writer, fetch_workers=FETCH_WORKERS,
+                 parse_workers=PARSE_WORKERS, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, message_format='full'):
+        self.gmail_handler = gmail_handler
+        self.email_writer = email_writer
+        self.message_format = message_format
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.batch_size = batch_size
+
+        self.fetch_queue = queue.Queue(maxsize=fetch_workers * 2)
+        self.parse_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.error = None
+        self.count = 0
+
+    def run(self, message_ids):
+
+        """Load the Mails with the given IDs, returning the number of Emails written."""
+
+        fetchers = self.start_stage(self.fetch, self.fetch_workers, 'fetch')
+        parsers = self.start_stage(self.parse, self.parse_workers, 'parse')
+        writers = self.start_stage(self.write, 1, 'write')
+
+        try:
+            chunk = []
+            for message_id in message_ids:
+                chunk.append(message_id)
+                if len(chunk) >= self.batch_size:
+                    self.put(self.fetch_queue, chunk)
+                    chunk = []
+            if chunk:
+                self.put(self.fetch_queue, chunk)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            # Shut the stages down in order, so every queued Mail is handled
+            self.finish_stage(self.fetch_queue, fetchers)
+            self.finish_stage(self.parse_queue, parsers)
+            self.finish_stage(self.write_queue, writers)
+
+        if self.error:
+            raise self.error
+
+        return self.count
+
+    def fetch(self):
+        gmail_handler = self.gmail_handler.clone()
+        for chunk in self.consume(self.fetch_queue):
+            for message_id, message in gmail_handler.fetch_messages_batch(chunk, self.batch_size, self.message_format):
+                self.put(self.parse_queue, (message_id, message))
+
+    def parse(self):
+        for message_id, message in self.consume(self.parse_queue):
+            details = self.gmail_handler.get_email_details(message)
+            self.put(self.write_queue, (message_id, details))
+
+    def write(self):
+        for message_id, details in self.consume(self.write_queue):
+            self.email_writer.add(message_id, details)
+            self.count += 1
+
+    def start_stage(self, target, workers, name):
+
+        """Start the worker threads of a stage."""
+
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.guard, args=(target,), name=name + '-' + str(i), daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def finish_stage(self, stage_queue, threads):
+
+        """Signal the workers of a stage that no more work is coming, and wait for them."""
+
+        try:
+            for _ in threads:
+                self.put(stage_queue, DONE)
+        except PipelineStopped:
+            pass
+
+        for thread in threads:
+            thread.join()
+
+    def guard(self, target):
+
+        """Run a stage worker, stopping the whole pipeline if it fails."""
+
+        try:
+            target()
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                logging.error("Loading pipeline failed: " + str(error))
+                self.error = error
+        self.stopped.set()
+
+    def put(self, stage_queue, item):
+
+        """Put an item on a queue, blocking while it's full unless the pipeline stops."""
+
+        while not self.stopped.is_set():
+            try:
+                stage_queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise PipelineStopped()
+
+    def consume(self, stage_queue):
+
+        """Yield the items of a queue until the stage is done or the pipeline stops."""
+
+        while not self.stopped.is_set():
+            try:
+                item = stage_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
@@ -1,7 +1,17 @@
+import asyncio
+import hashlib
 import json
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from utils.logging_config import logging
 from datetime import datetime, timedelta
+from sqlalchemy import and_, func, literal_column, or_, select
 from config.actions import ActionType
+from config.constants import BATCH_MODIFY_SIZE, READ_CHUNK_SIZE, RULE_WORKERS
+from config.models import Email, EmailRecord, EmailSearch, Label, MessageLabel, FTS_FIELDS, body_missing, fts_phrase, label_set
+from utils.date_parser import parse_date, utc_now
+from utils.keyword_matcher import KeywordMatcher
 
 """
 The Rules can have all the fields from models.py : 
@@ -10,6 +20,7 @@ The Rules can have all the fields from models.py :
 - to_mail
 - subject
 - message
+- labels {only with the is_unread and in_label predicates}
 
 The following are the predicates supported:
 - contains
@@ -18,112 +29,630 @@ The following are the predicates supported:
 - not_equals
 - greater_than
 - less_than
+- is_unread {value true or false}
+- in_label {value is a label name or ID}
 
 The following are the actions supported:
 - mark_as_read
 - mark_as_unread
-- move {additionally requires 'folder' attribute}
+- move {additionally requires 'folder_name' attribute, 'create_folder': true creates it if missing}
+
+A rules.json can also hold many named rulesets, evaluated in one pass:
+
+    {"rulesets": [{"name": ..., "priority": 1, "predicate": "all", "rules": [...], "actions": [...]}, ...]}
+
+A rule with its own 'rules' and 'predicate' is a nested all/any group.
+The actions of every ruleset an email passes are merged into a single label
+change, those of a higher priority winning over the lower ones. A rules.json
+without 'rulesets' is a single ruleset.
 
 """
 
 class RulesHandler:
 
-    def __init__(self, rules_file):
+    def __init__(self, rules_file, workers=RULE_WORKERS):
+        # Processes evaluating the rules, 1 evaluates them in this one
+        self.workers = workers
         self.rules = self.load_rules(rules_file)
         logging.info("Loaded the rules.json\n")
 
+    @classmethod
+    def from_rules(cls, rules, now=None):
+
+        """Create a handler for already loaded rules, compiled for the given time."""
+
+        rules_handler = cls.__new__(cls)
+        rules_handler.workers = 1
+        rules_handler._rules = rules
+        rules_handler.compile_rules(now)
+        return rules_handler
+
+    @property
+    def rules(self):
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        # Recompile whenever the rules are replaced
+        self._rules = rules
+        self.compile_rules()
+
     def load_rules(self, rules_file):
 
         """Load rules from a JSON file."""
 
         with open(rules_file, 'r') as file:
             return json.load(file)
-        
-    def evaluate_rule(self, email, rule):
 
-        """Evaluate a single rule on an email."""
+    def get_rulesets(self):
+
+        """Get the rulesets, lowest priority first, a rules.json without 'rulesets' being a single one."""
+
+        if 'rulesets' in self.rules:
+            rulesets = self.rules['rulesets']
+        else:
+            rulesets = [dict(self.rules, name=self.rules.get('name', 'default'))]
+        return sorted(rulesets, key=lambda ruleset: ruleset.get('priority', 0))
+
+    def compile_rules(self, now=None):
+
+        """Compile every ruleset into a matcher over normalized field values.
+
+        Rule values are lowercased and the date cutoffs are computed here once,
+        instead of on every email. A condition found in several rulesets is
+        evaluated once per email, and every keyword rule on a field is answered
+        from one scan, whichever ruleset it belongs to."""
+
+        now = self.now = now or utc_now()
+        self.rulesets = self.get_rulesets()
+        conditions = [rule for ruleset in self.rulesets for rule in iter_conditions(ruleset['rules'])]
+        matchers = self.compile_matchers(conditions)
+        counts = Counter(condition_key(rule) for rule in conditions)
+        tests = {}
+
+        def compile_condition(rule):
+            key = condition_key(rule)
+            if key not in tests:
+                test = self.compile_rule(rule, now, matchers)
+                tests[key] = share_test(key, test) if counts[key] > 1 else test
+            return tests[key]
+
+        def compile_group(group):
+            group_tests = [compile_group(rule) if 'rules' in rule else compile_condition(rule) for rule in group['rules']]
+            if group['predicate'] == 'all':
+                return lambda values: all(test(values) for test in group_tests)
+            if group['predicate'] == 'any':
+                return lambda values: any(test(values) for test in group_tests)
+            return lambda values: False
+
+        self.fields = tuple(dict.fromkeys(rule['field'].lower() for rule in conditions))
+        self.matchers = [compile_group(ruleset) for ruleset in self.rulesets]
+        if len(self.matchers) == 1:
+            self.matcher = self.matchers[0]
+        else:
+            self.matcher = lambda values: any(matcher(values) for matcher in self.matchers)
+
+    def compile_matchers(self, rules):
+
+        """Build one keyword matcher per field for its contains/not_contains rules.
+
+        Every keyword rule on a field is then answered from a single scan."""
+
+        keywords = {}
+        for rule in rules:
+            if rule['predicate'] in ('contains', 'not_contains'):
+                keywords.setdefault(rule['field'].lower(), []).append(rule['value'].lower())
+
+        return {field: KeywordMatcher(values) for field, values in keywords.items()}
+
+    def compile_rule(self, rule, now, matchers):
+
+        """Compile a single rule into a test over normalized field values."""
+
+        field = rule['field'].lower()
+        predicate = rule['predicate']
+
+        if predicate in ('is_unread', 'in_label'):
+            label, expected = label_condition(rule)
+            # Emails whose labels aren't known have none
+            return lambda values: (label in (label_set(values[field] or None) or ())) == expected
+
+        if predicate in ('less_than', 'greater_than'):
+            cutoff = self.get_date_cutoff(rule['value'], now)
+            if cutoff is None:
+                return lambda values: False
+
+            newer = predicate == 'less_than'
+
+            def test(values):
+                value = values[field]
+                # Dates not parsed yet are Date header strings
+                if isinstance(value, str):
+                    value = parse_date(value)
+                if not isinstance(value, datetime):
+                    return False
+                return value > cutoff if newer else value < cutoff
+
+            return test
+
+        value = rule['value'].lower()
+
+        if predicate in ('contains', 'not_contains'):
+            matcher = matchers[field]
+            key = (field, 'keywords')
+
+            def found(values):
+                # Scan the field on first use, the other keyword rules reuse the result
+                if key not in values:
+                    values[key] = matcher.find(values[field])
+                return values[key]
+
+            if predicate == 'contains':
+                return lambda values: value in found(values)
+            return lambda values: value not in found(values)
+
+        if predicate == 'equals':
+            return lambda values: value == values[field]
+
+        if predicate == 'not_equals':
+            return lambda values: value != values[field]
+
+        return lambda values: False
+
+    def get_date_cutoff(self, rule_value, now):
+
+        """Get the cutoff date of a date rule value, such as '2 days' or '1 months'."""
 
-        field_value = getattr(email, rule['field'].lower(), "")
-
-        if rule['predicate'] == 'contains':
-            return rule['value'].lower() in field_value.lower()
-        
-        if rule['predicate'] == 'not_contains':
-            return rule['value'].lower() not in field_value.lower()
-        
-        if rule['predicate'] == 'equals':
-            return rule['value'].lower() == field_value.lower()
-        
-        if rule['predicate'] == 'not_equals':
-            return rule['value'].lower() != field_value.lower()
-        
-        if rule['predicate'] == 'less_than':
-            return self.evaluate_date_rule(field_value, rule['value'], 'less_than')
-        
-        if rule['predicate'] == 'greater_than':
-            return self.evaluate_date_rule(field_value, rule['value'], 'greater_than')
-
-        return False
-    
-    def evaluate_date_rule(self, email_date, rule_value, predicate):
-
-        """Evaluate a date rule on an email."""
-
-        # email_date_str = email_date_str.replace(' (UTC)', '')
-        # email_date = datetime.strptime(email_date_str, '%a, %d %b %Y %H:%M:%S %z')
         rule_parts = rule_value.split()
         number = int(rule_parts[0])
         unit = rule_parts[1]
 
         if unit == 'days':
-            cutoff_date = datetime.now() - timedelta(days=number)
+            return now - timedelta(days=number)
         elif unit == 'months':
-            cutoff_date = datetime.now() - timedelta(days=number * 30)
-        else:
-            return False
+            return now - timedelta(days=number * 30)
+
+        return None
+
+    def columns(self):
+
+        """Get the Email columns the rules read, along with the ones the actions log and check.
+
+        The labels are read whenever there are actions, so the ones already in
+        place are skipped."""
+
+        columns = dict.fromkeys(('id', 'subject') + self.fields)
+        if any(ruleset.get('actions', []) for ruleset in self.rulesets):
+            columns['labels'] = None
+        return [column for column in columns if column in Email.__table__.columns or column == 'labels']
+
+    def needs_field(self, field):
+
+        """Check whether any rule reads the given email field."""
+
+        return field in self.fields
+
+    def normalize_email(self, email, fields=None):
+
+        """Read the rule fields of an email once, lowercasing the strings."""
 
-        if predicate == 'less_than':
-            return email_date > cutoff_date
-        elif predicate == 'greater_than':
-            return email_date < cutoff_date
+        values = {}
+
+        if isinstance(email, EmailRecord):
+            # Lowercased when the record was built
+            for field in fields or self.fields:
+                value = getattr(email, field, None)
+                values[field] = "" if value is None else value
+            return values
+
+        for field in fields or self.fields:
+            value = getattr(email, field, "")
+            if value is None:
+                value = ""
+            values[field] = value.lower() if isinstance(value, str) else value
+        return values
+
+    def evaluate_rule(self, email, rule):
+
+        """Evaluate a single rule on an email."""
+
+        test = self.compile_rule(rule, utc_now(), self.compile_matchers([rule]))
+        return test(self.normalize_email(email, [rule['field'].lower()]))
 
     def evaluate_rules(self, email):
 
-        """Evaluate all rules on an email."""
+        """Evaluate all rules on an email, passing if any ruleset passes."""
+
+        return self.matcher(self.normalize_email(email))
+
+    def match_rulesets(self, email):
+
+        """Get the indexes in self.rulesets of the rulesets an email passes."""
+
+        values = self.normalize_email(email)
+        return tuple(index for index, matcher in enumerate(self.matchers) if matcher(values))
+
+    def build_sql_filter(self, now=None, use_fts=False):
+
+        """Translate the rules into a WHERE clause narrowing down the emails loaded from the DB.
+
+        Rules that can't be translated are left to the Python evaluation, so the
+        clause matches a superset of the emails the rules pass. Returns None if
+        the rules can't narrow the emails down at all. With use_fts, contains
+        rules on indexed fields are answered by the full text index."""
+
+        now = now or utc_now()
+        rulesets = self.get_rulesets()
+        if len(rulesets) == 1:
+            return self.group_to_sql(rulesets[0], now, use_fts)
+
+        # An email is kept if any ruleset may pass it
+        return self.group_to_sql({'rules': rulesets, 'predicate': 'any'}, now, use_fts)
+
+    def group_to_sql(self, group, now, use_fts=False):
+
+        """Translate an all/any group of rules into a SQL condition, or None if it can't narrow the emails down."""
+
+        clauses = [self.group_to_sql(rule, now, use_fts) if 'rules' in rule else self.rule_to_sql(rule, now, use_fts)
+                   for rule in group['rules']]
+
+        if group['predicate'] == 'all':
+            # Leaving a rule out of an AND only widens the result
+            clauses = [clause for clause in clauses if clause is not None]
+            return and_(*clauses) if clauses else None
+
+        if group['predicate'] == 'any':
+            # An OR can't be narrowed if any of its rules must run in Python
+            if not clauses or any(clause is None for clause in clauses):
+                return None
+            return or_(*clauses)
+
+        return None
+
+    def rule_to_sql(self, rule, now, use_fts=False):
+
+        """Translate a single rule into a SQL condition, or None if it isn't supported."""
+
+        field = rule['field'].lower()
+        # The message is read through the bodies table
+        column = getattr(Email, field) if field in Email.__table__.columns else None
+        predicate = rule['predicate']
+        value = rule['value']
+
+        if predicate in ('is_unread', 'in_label'):
+            label, expected = label_condition(rule)
+            labeled = select(MessageLabel.message_id).outerjoin(Label, Label.id == MessageLabel.label_id).where(
+                or_(func.lower(MessageLabel.label_id) == label, func.lower(Label.name) == label)
+            )
+            return Email.id.in_(labeled) if expected else Email.id.not_in(labeled)
+
+        if column is None:
+            return None
+
+        if predicate in ('less_than', 'greater_than'):
+            cutoff = self.get_date_cutoff(value, now)
+            if field != 'date' or cutoff is None:
+                return None
+            return column > cutoff if predicate == 'less_than' else column < cutoff
+
+        # SQLite only folds the case of ASCII characters
+        if not value or not value.isascii():
+            return None
+
+        if predicate == 'contains':
+            # The trigram index only answers substrings of 3+ characters
+            if use_fts and field in FTS_FIELDS and len(value) >= 3:
+                matches = select(EmailSearch.c.rowid).where(
+                    EmailSearch.c.emails_fts.op('MATCH')(fts_phrase(value, [field]))
+                )
+                clause = literal_column('emails.rowid').in_(matches)
+            else:
+                clause = column.icontains(value.lower(), autoescape=True)
+        elif predicate == 'equals':
+            clause = func.lower(column) == value.lower()
+        else:
+            return None
+
+        # Bodies that weren't fetched yet are NULL, keep them for the Python evaluation
+        if field == 'message':
+            clause = or_(clause, body_missing())
+
+        return clause
 
-        if self.rules['predicate'] == 'all':
-            return all(self.evaluate_rule(email, rule) for rule in self.rules['rules'])
-        elif self.rules['predicate'] == 'any':
-            return any(self.evaluate_rule(email, rule) for rule in self.rules['rules'])
-        
-        return False
-    
     def apply_actions(self, gmail_handler, email):
 
-        """Apply actions on an email based on the rules."""
+        """Apply the actions of every ruleset on an email, in a single modify request."""
+
+        label_changes = self.resolve_actions(gmail_handler)
+        changes = merge_label_changes(change for ruleset_changes in label_changes for change in ruleset_changes)
+        return self.apply_pending_actions(gmail_handler, {changes: [email.id]})
+
+    def folders(self):
+
+        """Get the (folder_name, create_folder) pairs the move actions of the rulesets need."""
+
+        folders = {}
+        for ruleset in self.rulesets:
+            for action in ruleset.get('actions', []):
+                if ActionType(action['name']) == ActionType.MOVE:
+                    folder_name = action['folder_name']
+                    folders[folder_name] = folders.get(folder_name, False) or action.get('create_folder', False)
+        return list(folders.items())
+
+    def resolve_actions(self, gmail_handler):
+
+        """Turn the actions of each ruleset into its label changes, resolving each folder once."""
+
+        folder_ids = {folder_name: gmail_handler.get_label_id(folder_name, create) for folder_name, create in self.folders()}
+        return [self.label_changes(folder_ids, ruleset) for ruleset in self.rulesets]
+
+    async def resolve_actions_async(self, gmail_handler):
+
+        """Turn the actions of each ruleset into its label changes, with an AsyncGmailHandler."""
+
+        folder_ids = {}
+        for folder_name, create in self.folders():
+            folder_ids[folder_name] = await gmail_handler.get_label_id(folder_name, create)
+        return [self.label_changes(folder_ids, ruleset) for ruleset in self.rulesets]
 
-        for action in self.rules['actions']:
+    def label_changes(self, folder_ids, ruleset):
+
+        """Turn the actions of a ruleset into (label_id, add, ruleset_hash) changes, in order, given the folder label IDs."""
+
+        key = ruleset_hash(ruleset)
+        changes = []
+        for action in ruleset.get('actions', []):
             action_type = ActionType(action['name'])
             if action_type == ActionType.MARK_AS_READ:
-                gmail_handler.mark_as_read(email.id)
-            elif action_type == ActionType.MOVE:
-                gmail_handler.move_to_folder(email.id, action['folder_name'])
+                changes.append(('UNREAD', False, key))
             elif action_type == ActionType.MARK_AS_UNREAD:
-                gmail_handler.mark_as_unread(email.id)
+                changes.append(('UNREAD', True, key))
+            elif action_type == ActionType.MOVE:
+                label_id = folder_ids.get(action['folder_name'])
+                if label_id:
+                    changes.append((label_id, True, key))
+                else:
+                    logging.warning("Folder Name: \"" + action['folder_name'] + "\" not found! Skipping ...")
+        return changes
+
+    def match_emails(self, emails, label_changes):
+
+        """Collect the IDs of the emails passing the rulesets, keyed by the label changes they get.
+
+        label_changes holds the changes of each ruleset, as resolve_actions
+        returns them. The changes of the rulesets an email passes are merged,
+        so every email gets a single set of changes, keyed the same way as
+        the other emails getting them."""
+
+        pending = {}
+        merged = {}
+        in_place = 0
+        for message_id, subject, rulesets, labels in self.iter_matches(emails):
+            if len(self.rulesets) > 1:
+                names = ", ".join(str(self.rulesets[index]['name']) for index in rulesets)
+                logging.info("Rulesets Passed for email with Subject: " + str(subject) + " (" + names + ")")
+            else:
+                logging.info("Rule Passed for email with Subject: " + str(subject))
+            if rulesets not in merged:
+                merged[rulesets] = merge_label_changes(change for index in rulesets for change in label_changes[index])
+            changes = merged[rulesets]
+            if labels is not None:
+                # Leave out the changes whose label is already added or removed
+                changes = tuple(change for change in changes if (change[0].lower() in labels) != change[1])
+                in_place += len(merged[rulesets]) - len(changes)
+            pending.setdefault(changes, []).append(message_id)
+
+        count = sum(len(message_ids) for message_ids in pending.values())
+        logging.info("Total Number of Emails Matched: " + str(count))
+        if in_place:
+            logging.info("Mail Actions Already in Place, Skipped: " + str(in_place))
+        return pending
+
+    def iter_matches(self, emails, chunk_size=READ_CHUNK_SIZE):
+
+        """Yield the (id, subject, rulesets, labels) of the emails passing the rules, in the order of the emails.
+
+        rulesets holds the indexes in self.rulesets of the rulesets passed, and
+        labels the set of label IDs and names of the email, None if unknown.
+
+        With more than one worker, chunks of emails are evaluated in a pool of
+        processes, each compiling the rules once for the same time as this
+        handler. Chunks are collected in the order they were sent, so the
+        matches are the same as evaluating here."""
+
+        if self.workers <= 1:
+            yield from match_chunk(self, emails)
+            return
+
+        emails = iter(emails)
+        with ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.rules, self.now)) as executor:
+            futures = deque()
+            while chunk := list(islice(emails, chunk_size)):
+                futures.append(executor.submit(match_chunk, None, chunk))
+                # Keep a few chunks queued per worker, not the whole mailbox
+                if len(futures) >= self.workers * 2:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+
+    def unapplied_actions(self, pending, journal=None):
+
+        """Drop the label changes the journal has as applied already, if there is one."""
+
+        if journal is None:
+            return pending
+
+        unapplied = {}
+        for changes, message_ids in pending.items():
+            for remaining, remaining_ids in journal.unapplied(message_ids, changes).items():
+                unapplied.setdefault(remaining, []).extend(remaining_ids)
+
+        logging.info("Mail Actions Already Applied, Skipped: " + str(journal.skipped))
+        return unapplied
+
+    def apply_pending_actions(self, gmail_handler, pending, journal=None):
+
+        """Send the collected label changes, one batchModify per chunk of emails sharing them.
+
+        With an ActionJournal, the changes already applied are left out, and
+        each chunk is journaled as soon as it succeeds. Returns the results of
+        every chunk."""
+
+        results = []
+        for changes, message_ids in self.unapplied_actions(pending, journal).items():
+            add_label_ids, remove_label_ids = split_label_changes(changes)
+            if not (add_label_ids or remove_label_ids):
+                continue
+            for i in range(0, len(message_ids), BATCH_MODIFY_SIZE):
+                chunk_results = gmail_handler.batch_modify(message_ids[i:i + BATCH_MODIFY_SIZE], add_label_ids, remove_label_ids)
+                self.journal_results(journal, chunk_results, changes)
+                results += chunk_results
+
+        self.report_results(results)
+        return results
+
+    async def apply_pending_actions_async(self, gmail_handler, pending, journal=None):
+
+        """Send the collected label changes with an AsyncGmailHandler."""
+
+        results = []
+        for changes, message_ids in self.unapplied_actions(pending, journal).items():
+            add_label_ids, remove_label_ids = split_label_changes(changes)
+            if add_label_ids or remove_label_ids:
+                changes_results = await gmail_handler.batch_modify(message_ids, add_label_ids, remove_label_ids)
+                # The chunks are sent concurrently, so they're journaled together
+                await asyncio.to_thread(self.journal_results, journal, changes_results, changes)
+                results += changes_results
+
+        self.report_results(results)
+        return results
+
+    def journal_results(self, journal, results, changes):
+
+        """Record the changes of the successful modify requests in the journal, if there is one."""
+
+        if journal is not None:
+            journal.record([message_id for result in results if not result['error'] for message_id in result['ids']],
+                           changes)
+
+    def report_results(self, results):
+        executed = sum(len(result['ids']) for result in results if not result['error'])
+        failed = sum(len(result['ids']) for result in results if result['error'])
+        logging.info("Total Number of Mail Actions Executed: " + str(executed))
+        logging.info("Modify Requests Sent: " + str(len(results)) + ", Emails Failed: " + str(failed))
+
+    def process_emails(self, gmail_handler, emails, now=None, journal=None):
+
+        """Process emails and apply rules/actions.
+
+        The emails can be any iterable, such as DatabaseHandler.iter_emails, as
+        they are read once. The actions are collected over the whole run and
+        sent in bulk at the end, skipping the ones already in the journal."""
+
+        # Date cutoffs are fixed for the whole run
+        self.compile_rules(now)
+
+        label_changes = self.resolve_actions(gmail_handler)
+        pending = self.match_emails(emails, label_changes)
+        return self.apply_pending_actions(gmail_handler, pending, journal)
+
+    async def process_emails_async(self, gmail_handler, emails, now=None, journal=None):
+
+        """Process emails and apply rules/actions with an AsyncGmailHandler."""
+
+        self.compile_rules(now)
+
+        label_changes = await self.resolve_actions_async(gmail_handler)
+        pending = self.match_emails(emails, label_changes)
+        return await self.apply_pending_actions_async(gmail_handler, pending, journal)
+
+
+# The rules compiled in a worker process of RulesHandler.iter_matches
+worker_rules_handler = None
+
+
+def init_worker(rules, now):
+
+    """Compile the rules once in a new worker process."""
+
+    global worker_rules_handler
+    worker_rules_handler = RulesHandler.from_rules(rules, now)
+
+
+def match_chunk(rules_handler, emails):
+
+    """Get the (id, subject, rulesets, labels) of the emails passing the rules, with the worker's rules if none are given."""
+
+    rules_handler = rules_handler or worker_rules_handler
+    matches = []
+    for email in emails:
+        rulesets = rules_handler.match_rulesets(email)
+        if rulesets:
+            matches.append((email.id, email.subject, rulesets, label_set(getattr(email, 'labels', None))))
+    return matches
+
+
+def label_condition(rule):
+
+    """Get the lowercased label an is_unread or in_label rule looks for, and whether the email must have it."""
+
+    if rule['predicate'] == 'is_unread':
+        return 'unread', str(rule['value']).lower() in ('true', '1', 'yes')
+    return str(rule['value']).lower(), True
+
+
+def iter_conditions(rules):
+
+    """Yield the conditions of a list of rules, going into the nested groups."""
+
+    for rule in rules:
+        if 'rules' in rule:
+            yield from iter_conditions(rule['rules'])
+        else:
+            yield rule
+
+
+def condition_key(rule):
+
+    """Get a key telling apart the conditions that test different things."""
+
+    return ('condition', rule['field'].lower(), rule['predicate'], str(rule['value']).lower())
+
+
+def share_test(key, test):
+
+    """Wrap the test of a condition found in several rulesets, so it runs once per email."""
+
+    def shared(values):
+        if key not in values:
+            values[key] = test(values)
+        return values[key]
+
+    return shared
+
+
+def ruleset_hash(ruleset):
+
+    """Get a short hash of a ruleset, changing whenever the ruleset is edited."""
+
+    return hashlib.sha1(json.dumps(ruleset, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
 
-        logging.info("Successfully finished all actions for the mail!\n")
+def merge_label_changes(changes):
 
-    def process_emails(self, gmail_handler, emails):
+    """Merge label changes into one per label, a later change of a label winning."""
 
-        """Process emails and apply rules/actions."""
+    final = {}
+    for change in changes:
+        # Re-inserted, so the labels keep the order of their last change
+        final.pop(change[0], None)
+        final[change[0]] = change
+    return tuple(final.values())
 
-        count = 0
 
-        for email in emails:
-            if self.evaluate_rules(email):
-                logging.info("Rule Passed for email with Subject: " + str(email.subject))
-                self.apply_actions(gmail_handler, email)
-                count += 1
+def split_label_changes(changes):
 
-        logging.info("Total Number of Mail Actions Executed: " + str(count))
+    """Split label changes into the (addLabelIds, removeLabelIds) of a modify request."""
 
+    return (tuple(label_id for label_id, add, *_ in changes if add),
+            tuple(label_id for label_id, add, *_ in changes if not add))
@@ -1,20 +1,37 @@
-from config.constants import LOAD_FLAG, UPDATE_FLAG
+from config.constants import LAZY_BODIES, LOAD_FLAG, UPDATE_FLAG
 from handlers.db_handler import DatabaseHandler
 from handlers.gmail_handler import GmailHandler
 from handlers.rules_handler import RulesHandler
+from utils.date_parser import utc_now
 from utils.logging_config import logging
 
 try:
     # Init all Handlers
     gmail_handler = GmailHandler()
-    database_handler = DatabaseHandler(load_flag=LOAD_FLAG, update_flag=UPDATE_FLAG, gmail_handler=gmail_handler)
     rules_handler = RulesHandler(rules_file='config/rules.json')
 
-    # Check if emails needs to be fetched, and fetch
-    emails = database_handler.fetch_emails_from_db()
+    # Only download the Mail bodies up front if a rule reads them
+    fetch_bodies = not LAZY_BODIES or rules_handler.needs_field('message')
+    database_handler = DatabaseHandler(load_flag=LOAD_FLAG, update_flag=UPDATE_FLAG, gmail_handler=gmail_handler,
+                                       fetch_bodies=fetch_bodies)
 
-    # Process All Emails
-    rules_handler.process_emails(gmail_handler, emails)
+    # Date rules are evaluated against the same time in SQL and in Python, in UTC like the stored dates
+    now = utc_now()
+
+    # Let SQLite filter the emails on the rules it can evaluate
+    criterion = rules_handler.build_sql_filter(now, use_fts=database_handler.fts_enabled)
+
+    # Emails loaded with their headers only get their bodies now
+    if rules_handler.needs_field('message'):
+        database_handler.load_bodies(criterion)
+
+    # Stream the remaining Emails through the rules, reading only the columns they need
+    emails = database_handler.iter_records(criterion, rules_handler.columns())
+    # The journal skips the actions earlier runs already applied
+    rules_handler.process_emails(gmail_handler, emails, now, database_handler.action_journal())
+
+    # Report how the run fared against the Gmail API quota
+    gmail_handler.rate_limiter.log_metrics()
     
 except Exception as e:
     logging.error("Oops! There was an issue: ")
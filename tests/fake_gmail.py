@@ -0,0 +1,380 @@
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+from unittest.mock import patch
+import httplib2
+import httpx
+from googleapiclient.errors import HttpError
+from handlers.gmail_handler import GmailHandler
+from utils.rate_limiter import RateLimiter
+
+"""
+An in-process stand-in for the Gmail API service returned by
+googleapiclient.discovery.build. It serves a synthetic mailbox and counts
+every HTTP round trip, so tests and benchmarks can measure API usage
+without network access.
+"""
+
+
+# System labels every fake mailbox starts with
+SYSTEM_LABELS = ['INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'TRASH', 'SPAM', 'CATEGORY_PERSONAL']
+
+
+def make_message(message_id, subject='Test Subject', from_mail='test@example.com',
+                 to_mail='recipient@example.com', date='Sat, 01 Jan 2022 12:00:00 +0000',
+                 body='This is a test message', label_ids=('INBOX', 'UNREAD', 'CATEGORY_PERSONAL')):
+
+    """Build a Gmail API message resource in 'full' format."""
+
+    return {
+        'id': message_id,
+        'threadId': message_id,
+        'labelIds': list(label_ids),
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [
+                {'name': 'From', 'value': from_mail},
+                {'name': 'To', 'value': to_mail},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Date', 'value': date}
+            ],
+            'body': {'data': base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')}
+        }
+    }
+
+
+def fake_gmail_handler(service, clock=time.monotonic, **limiter_kwargs):
+
+    """Build a GmailHandler talking to the given fake service, without authenticating.
+
+    Its RateLimiter has no rate limit unless one is given in limiter_kwargs."""
+
+    with patch.object(GmailHandler, 'authenticate'):
+        gmail_handler = GmailHandler(rate_limiter=RateLimiter(**dict({'rate': None}, **limiter_kwargs)), clock=clock)
+    gmail_handler.service = service
+    return gmail_handler
+
+
+def metadata_message(message, headers=None):
+
+    """Strip a message down to what the 'metadata' format returns."""
+
+    payload = message['payload']
+    return {
+        'id': message['id'],
+        'threadId': message['threadId'],
+        'labelIds': list(message['labelIds']),
+        'payload': {
+            'mimeType': payload['mimeType'],
+            'headers': [header for header in payload['headers'] if not headers or header['name'] in headers]
+        }
+    }
+
+
+def make_http_error(status, reason=''):
+
+    """Build an HttpError the way googleapiclient raises it."""
+
+    content = json.dumps({'error': {'code': status, 'message': reason,
+                                    'errors': [{'reason': reason}]}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeRequest:
+
+    def __init__(self, service, method, handler):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self):
+        self.service.record_round_trip()
+        return self.run()
+
+    def run(self):
+        self.service.record_call(self.method)
+        self.service.raise_random_failure()
+        response = self.handler()
+        self.service.record_bytes(response)
+        return response
+
+
+class FakeBatch:
+
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if any(request_id == existing_id for existing_id, _, _ in self.requests):
+            raise KeyError('A request with this ID already exists: ' + str(request_id))
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.service.record_round_trip()
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class FakeMessages:
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, maxResults=100, q=None, pageToken=None):
+        def handler():
+            ids = self.service.message_order
+            start = int(pageToken or 0)
+            end = start + maxResults
+            response = {'messages': [{'id': i, 'threadId': i} for i in ids[start:end]],
+                        'resultSizeEstimate': len(ids)}
+            if end < len(ids):
+                response['nextPageToken'] = str(end)
+            return response
+        return FakeRequest(self.service, 'messages.list', handler)
+
+    def get(self, userId, id, format='full', metadataHeaders=None, **kwargs):
+        def handler():
+            self.service.raise_pending_failure(id)
+            if id not in self.service.messages:
+                raise make_http_error(404, 'Requested entity was not found.')
+            message = self.service.messages[id]
+            if format == 'metadata':
+                return metadata_message(message, metadataHeaders)
+            return message
+        return FakeRequest(self.service, 'messages.get', handler)
+
+    def modify(self, userId, id, body):
+        def handler():
+            self.service.modify_labels([id], body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return self.service.messages[id]
+        return FakeRequest(self.service, 'messages.modify', handler)
+
+    def batchModify(self, userId, body):
+        def handler():
+            if len(body['ids']) > 1000:
+                raise make_http_error(400, 'Too many messages')
+            self.service.modify_labels(body['ids'], body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return ''
+        return FakeRequest(self.service, 'messages.batchModify', handler)
+
+
+class FakeLabels:
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId):
+        return FakeRequest(self.service, 'labels.list', lambda: {'labels': list(self.service.labels.values())})
+
+    def create(self, userId, body):
+        def handler():
+            if any(label['name'].lower() == body['name'].lower() for label in self.service.labels.values()):
+                raise make_http_error(409, 'Label name exists or conflicts')
+            return self.service.create_label(body['name'])
+        return FakeRequest(self.service, 'labels.create', handler)
+
+
+class FakeHistory:
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, startHistoryId, labelId=None, historyTypes=None, maxResults=100, pageToken=None):
+        def handler():
+            if int(startHistoryId) < self.service.oldest_history_id:
+                raise make_http_error(404, 'Requested entity was not found.')
+            records = [record for record in self.service.history if int(record['id']) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            end = start + maxResults
+            response = {'history': records[start:end], 'historyId': str(self.service.history_id)}
+            if end < len(records):
+                response['nextPageToken'] = str(end)
+            return response
+        return FakeRequest(self.service, 'history.list', handler)
+
+
+class FakeUsers:
+
+    def __init__(self, service):
+        self.service = service
+
+    def messages(self):
+        return FakeMessages(self.service)
+
+    def history(self):
+        return FakeHistory(self.service)
+
+    def labels(self):
+        return FakeLabels(self.service)
+
+    def getProfile(self, userId):
+        return FakeRequest(self.service, 'users.getProfile', lambda: {'historyId': str(self.service.history_id)})
+
+
+class FakeGmailService:
+
+    def __init__(self, messages=(), failures=None, latency=0, labels=(), error_rate=0, seed=None):
+        # Seconds every round trip takes, simulating the network
+        self.latency = latency
+        # Share of the requests failing with a quota error, at random but repeatably for a seed
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.messages = {message['id']: message for message in messages}
+        self.message_order = [message['id'] for message in messages]
+        # Message ID -> list of HTTP statuses to fail with before succeeding
+        self.failures = {key: list(value) for key, value in (failures or {}).items()}
+        self.round_trips = 0
+        self.calls = {}
+        # Size of the JSON responses, as the API would send them
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.history = []
+        self.history_id = 1000
+        self.oldest_history_id = self.history_id
+        # Bearer token accepted by the REST transport
+        self.access_token = 'token'
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.labels = {}
+        for name in SYSTEM_LABELS:
+            self.labels[name] = {'id': name, 'name': name, 'type': 'system'}
+        for name in labels:
+            self.create_label(name)
+
+    def users(self):
+        return FakeUsers(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def add_history_record(self, key, message_id, **fields):
+        self.history_id += 1
+        message = {'id': message_id}
+        if message_id in self.messages:
+            message['labelIds'] = list(self.messages[message_id]['labelIds'])
+        self.history.append({'id': str(self.history_id), key: [dict(message=message, **fields)]})
+
+    def add_message(self, message):
+        self.messages[message['id']] = message
+        self.message_order.insert(0, message['id'])
+        self.add_history_record('messagesAdded', message['id'])
+
+    def delete_message(self, message_id):
+        del self.messages[message_id]
+        self.message_order.remove(message_id)
+        self.add_history_record('messagesDeleted', message_id)
+
+    def relabel_message(self, message_id, label_ids, removed=False):
+        message = self.messages[message_id]
+        if removed:
+            message['labelIds'] = [label_id for label_id in message['labelIds'] if label_id not in label_ids]
+        else:
+            message['labelIds'] = message['labelIds'] + [label_id for label_id in label_ids if label_id not in message['labelIds']]
+        self.add_history_record('labelsRemoved' if removed else 'labelsAdded', message_id, labelIds=label_ids)
+
+    def create_label(self, name):
+        label = {'id': 'Label_' + str(len(self.labels) + 1), 'name': name, 'type': 'user'}
+        self.labels[label['id']] = label
+        return label
+
+    def modify_labels(self, message_ids, add_label_ids, remove_label_ids):
+        for label_id in list(add_label_ids) + list(remove_label_ids):
+            if label_id not in self.labels:
+                raise make_http_error(400, 'Invalid label: ' + label_id)
+        for message_id in message_ids:
+            if message_id not in self.messages:
+                raise make_http_error(404, 'Requested entity was not found.')
+        for message_id in message_ids:
+            message = self.messages[message_id]
+            label_ids = [label_id for label_id in message['labelIds'] if label_id not in remove_label_ids]
+            message['labelIds'] = label_ids + [label_id for label_id in add_label_ids if label_id not in label_ids]
+
+    def label_ids(self, message_id):
+        return set(self.messages[message_id]['labelIds'])
+
+    def expire_history(self):
+        self.oldest_history_id = self.history_id + 1
+
+    def record_round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def record_bytes(self, response):
+        size = len(json.dumps(response)) if response else 0
+        with self.lock:
+            self.bytes_sent += size
+
+    def record_call(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def raise_pending_failure(self, message_id):
+        with self.lock:
+            statuses = self.failures.get(message_id)
+            status = statuses.pop(0) if statuses else None
+        if status:
+            raise make_http_error(status, 'rateLimitExceeded' if status in (403, 429) else 'backendError')
+
+    def raise_random_failure(self):
+        if not self.error_rate:
+            return
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            self.errors += failed
+        if failed:
+            raise make_http_error(429, 'rateLimitExceeded')
+
+    def rest_transport(self):
+
+        """Serve the mailbox over the Gmail REST API, for httpx clients."""
+
+        return httpx.MockTransport(self.handle_rest_request)
+
+    async def handle_rest_request(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            self.round_trips += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if request.headers.get('Authorization') != 'Bearer ' + self.access_token:
+                return httpx.Response(401, json={'error': {'code': 401, 'message': 'Invalid Credentials'}})
+            try:
+                result = self.route_rest_request(request).run()
+                return httpx.Response(204) if result == '' else httpx.Response(200, json=result)
+            except HttpError as e:
+                return httpx.Response(e.resp.status, content=e.content)
+        finally:
+            self.in_flight -= 1
+
+    def route_rest_request(self, request):
+        path = request.url.path.split('/gmail/v1/users/me/', 1)[1].split('/')
+        params = dict(request.url.params)
+        body = json.loads(request.content) if request.content else None
+        users = self.users()
+
+        if path == ['profile']:
+            return users.getProfile('me')
+        if path == ['labels']:
+            return users.labels().create('me', body) if request.method == 'POST' else users.labels().list('me')
+        if path == ['messages']:
+            return users.messages().list('me', maxResults=int(params['maxResults']), q=params.get('q'),
+                                         pageToken=params.get('pageToken'))
+        if path == ['messages', 'batchModify']:
+            return users.messages().batchModify('me', body)
+        if len(path) == 3 and path[2] == 'modify':
+            return users.messages().modify('me', path[1], body)
+        return users.messages().get('me', path[1], format=params.get('format', 'full'),
+                                    metadataHeaders=request.url.params.get_list('metadataHeaders'))
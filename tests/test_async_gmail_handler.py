@@ -0,0 +1,131 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import Mock, patch
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from config.models import Base
+from handlers.async_gmail_handler import AsyncGmailHandler
+from handlers.db_handler import DatabaseHandler, EmailWriter
+from handlers.rules_handler import RulesHandler
+from tests.fake_gmail import FakeGmailService, make_message
+from utils.rate_limiter import RateLimiter
+
+
+class FakeCredentials:
+
+    def __init__(self, service):
+        self.service = service
+        self.token = 'token'
+        self.valid = True
+        self.refresh_count = 0
+
+    def refresh(self, request):
+        self.refresh_count += 1
+        self.token = self.service.access_token
+        self.valid = True
+
+
+class TestAsyncGmailHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.message_ids = ['id-' + str(i) for i in range(100)]
+        self.service = FakeGmailService([make_message(i, subject='Subject ' + i) for i in self.message_ids],
+                                        labels=['HappyFox'], latency=0.01)
+        self.creds = FakeCredentials(self.service)
+        self.rate_limiter = RateLimiter(rate=None)
+
+    def run_with_handler(self, coroutine, max_concurrency=5):
+        async def run():
+            async with AsyncGmailHandler(self.creds, max_concurrency, transport=self.service.rest_transport(),
+                                         rate_limiter=self.rate_limiter) as handler:
+                return await coroutine(handler)
+        return asyncio.run(run())
+
+    def test_fetch_messages_follows_pages(self):
+        async def fetch(handler):
+            return [message async for message in handler.iter_messages(page_size=30)]
+        self.assertEqual(len(self.run_with_handler(fetch)), 100)
+        self.assertEqual(self.service.calls['messages.list'], 4)
+
+    def test_fetch_messages_concurrently_is_bounded(self):
+        async def fetch(handler):
+            return dict([item async for item in handler.fetch_messages_concurrently(self.message_ids + ['missing'])])
+        messages = self.run_with_handler(fetch, max_concurrency=5)
+        self.assertEqual(sorted(messages), sorted(self.message_ids))
+        self.assertEqual(messages['id-3']['id'], 'id-3')
+        self.assertEqual(self.service.max_in_flight, 5)
+
+    def test_token_is_refreshed_once_for_all_tasks(self):
+        self.service.access_token = 'new-token'
+        async def fetch(handler):
+            return await asyncio.gather(*(handler.fetch_message_by_id(i) for i in self.message_ids[:20]))
+        self.assertEqual(len(self.run_with_handler(fetch)), 20)
+        self.assertEqual(self.creds.refresh_count, 1)
+
+    @patch('handlers.async_gmail_handler.asyncio.sleep')
+    def test_rate_limited_requests_are_retried(self, mock_sleep):
+        self.service.latency = 0
+        self.service.failures = {'id-1': [429, 500]}
+        self.assertEqual(self.run_with_handler(lambda handler: handler.fetch_message_by_id('id-1'))['id'], 'id-1')
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(self.rate_limiter.throttle_count, 1)
+
+    def test_requests_wait_for_the_quota(self):
+        self.service.latency = 0
+        self.rate_limiter = RateLimiter(rate=50)
+        async def fetch(handler):
+            return await asyncio.gather(*(handler.fetch_message_by_id(i) for i in self.message_ids[:20]))
+        start = time.monotonic()
+        self.assertEqual(len(self.run_with_handler(fetch)), 20)
+        # 20 gets of 5 units from a bucket of 50 at 50 units per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.95)
+        self.assertEqual(self.rate_limiter.metrics()['completed'], 20)
+
+    def test_labels_and_modify(self):
+        async def modify(handler):
+            await handler.mark_as_read('id-1')
+            await handler.move_to_folder('id-1', 'happyfox')
+            return await handler.batch_modify(self.message_ids, add_label_ids=['STARRED'], chunk_size=40)
+        results = self.run_with_handler(modify)
+        self.assertEqual([len(result['ids']) for result in results], [40, 40, 20])
+        self.assertEqual(self.service.label_ids('id-1'), {'INBOX', 'CATEGORY_PERSONAL', 'Label_9', 'STARRED'})
+
+    def test_labels_are_cached(self):
+        async def resolve(handler):
+            for name in ['HappyFox', 'happyfox', 'Missing', 'Missing']:
+                await handler.get_label_id(name)
+            handler.invalidate_label_cache()
+            return await handler.get_label_id('HAPPYFOX')
+        self.assertEqual(self.run_with_handler(resolve), 'Label_9')
+        # The first listing, the refresh for the first miss, and the one after invalidating
+        self.assertEqual(self.service.calls['labels.list'], 3)
+
+    def test_database_and_rules_handlers_drive_it(self):
+        engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        with patch('handlers.db_handler.create_engine', return_value=engine), \
+             patch('handlers.db_handler.MAIL_COUNT_LIMIT', None):
+            db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=Mock())
+            # Small chunks, so several are written from the worker thread
+            with patch.object(DatabaseHandler, 'email_writer', lambda handler: EmailWriter(engine, chunk_size=30)):
+                self.run_with_handler(db_handler.load_db_async)
+
+        emails = db_handler.fetch_emails_from_db()
+        self.assertEqual(len(emails), 100)
+        self.assertEqual(db_handler.get_sync_history_id(), '1000')
+
+        rules_handler = RulesHandler('config/rules.json')
+        rules_handler.rules = {
+            'rules': [{'field': 'subject', 'predicate': 'contains', 'value': 'id-1'}],
+            'predicate': 'all',
+            'actions': [{'name': 'mark_as_read'}, {'name': 'move', 'folder_name': 'HappyFox'}]
+        }
+        results = self.run_with_handler(lambda handler: rules_handler.process_emails_async(handler, emails))
+        self.assertEqual(len(results[0]['ids']), 11)
+        self.assertEqual(self.service.label_ids('id-10'), {'INBOX', 'CATEGORY_PERSONAL', 'Label_9'})
+        self.assertEqual(self.service.label_ids('id-20'), {'INBOX', 'UNREAD', 'CATEGORY_PERSONAL'})
+
+
+if __name__ == '__main__':
+    unittest.main()
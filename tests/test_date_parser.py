@@ -0,0 +1,45 @@
+import unittest
+from datetime import datetime
+from utils.date_parser import parse_date
+
+
+class TestParseDate(unittest.TestCase):
+
+    def test_rfc_2822_variants(self):
+        expected = datetime(2022, 1, 1, 12, 0)
+        for value in ['Sat, 01 Jan 2022 12:00:00 +0000',
+                      'Sat, 01 Jan 2022 12:00:00 +0000 (UTC)',
+                      'Sat, 1 Jan 2022 12:00:00 GMT',
+                      '1 Jan 2022 12:00 UT',
+                      'Sat, 01 Jan 22 12:00:00 -0000',
+                      'sat, 01 jan 2022 12:00:00 +0000',
+                      'Sat,  1 Jan 2022 12:00:00.250 +0000',
+                      'Sat, 01 Jan 2022 13:00:00 +01:00',
+                      'Saturday, 01 January 2022 12:00:00 +0000',
+                      '01-Jan-2022 12:00:00 +0000']:
+            self.assertEqual(parse_date(value), expected, value)
+
+    def test_time_zones_are_converted_to_utc(self):
+        self.assertEqual(parse_date('Mon, 3 Feb 2020 08:15:30 -0800 (PST)'), datetime(2020, 2, 3, 16, 15, 30))
+        self.assertEqual(parse_date('Mon, 3 Feb 2020 08:15:30 EDT'), datetime(2020, 2, 3, 12, 15, 30))
+        self.assertEqual(parse_date('Mon, 3 Feb 2020 02:00:00 +0530'), datetime(2020, 2, 2, 20, 30))
+
+    def test_obsolete_years(self):
+        self.assertEqual(parse_date('1 Jan 99 00:00:00 +0000'), datetime(1999, 1, 1))
+        self.assertEqual(parse_date('1 Jan 103 00:00:00 +0000'), datetime(2003, 1, 1))
+
+    def test_fallbacks(self):
+        self.assertEqual(parse_date('2022-01-01T12:00:00+02:00'), datetime(2022, 1, 1, 10, 0))
+        self.assertIsNone(parse_date('Fri, 31 Feb 2020 10:00:00 +0000'))
+        self.assertIsNone(parse_date('not a date'))
+        self.assertIsNone(parse_date(''))
+
+    def test_results_are_cached(self):
+        parse_date.cache_clear()
+        for _ in range(3):
+            parse_date('Sat, 01 Jan 2022 12:00:00 +0000')
+        self.assertEqual(parse_date.cache_info().hits, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
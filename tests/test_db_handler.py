@@ -1,9 +1,15 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, Mock
-from sqlalchemy import create_engine
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
-from handlers.db_handler import DatabaseHandler
-from config.models import Base, Email
+from sqlalchemy.pool import StaticPool
+from handlers.db_handler import DatabaseHandler, EmailWriter
+from handlers.gmail_handler import GmailHandler
+from config.models import Base, Email, MessageLabel, label_set
+from tests.fake_gmail import FakeGmailService, fake_gmail_handler, make_message
 
 class TestDatabaseHandler(unittest.TestCase):
     def setUp(self):
@@ -26,24 +32,33 @@ class TestDatabaseHandler(unittest.TestCase):
                 'body': {'data': 'VGhpcyBpcyBhIHRlc3QgbWVzc2FnZQ=='}
             }
         }
+        self.mock_gmail_handler.get_history_id.return_value = '1'
+        self.mock_gmail_handler.clone.return_value = self.mock_gmail_handler
+        self.mock_gmail_handler.iter_messages.side_effect = lambda *args, **kwargs: iter(
+            self.mock_gmail_handler.fetch_messages.return_value
+        )
+        self.mock_gmail_handler.list_labels.return_value = []
+        self.mock_gmail_handler.fetch_messages_batch.side_effect = lambda message_ids, *args, **kwargs: (
+            (message_id, self.mock_gmail_handler.fetch_message_by_id(message_id)) for message_id in message_ids
+        )
         self.mock_gmail_handler.get_email_details.return_value = {
             'From': 'test@example.com',
             'Subject': 'Test Subject',
-            'Date': 'Sat, 01 Jan 2022 12:00:00 +0000',
+            'Date': datetime(2022, 1, 1, 12),
             'To': 'recipient@example.com',
             'Message': 'This is a test message'
         }
 
         # Create an in-memory SQLite database for testing
-        self.engine = create_engine('sqlite:///:memory:')
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
 
         # Patch the create_engine and sessionmaker to use the in-memory database
-        with patch('database_handler.create_engine', return_value=self.engine), \
-             patch('database_handler.sessionmaker', return_value=self.Session):
+        with patch('handlers.db_handler.create_engine', return_value=self.engine), \
+             patch('handlers.db_handler.sessionmaker', return_value=self.Session):
 
-            self.db_handler = DatabaseHandler(load_flag=True, update_flag=False, gmail_handler=self.mock_gmail_handler)
+            self.db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=self.mock_gmail_handler)
 
     def tearDown(self):
         Base.metadata.drop_all(self.engine)
@@ -57,7 +72,7 @@ class TestDatabaseHandler(unittest.TestCase):
         self.assertIsNotNone(email)
         self.assertEqual(email.from_mail, 'test@example.com')
         self.assertEqual(email.subject, 'Test Subject')
-        self.assertEqual(email.date, 'Sat, 01 Jan 2022 12:00:00 +0000')
+        self.assertEqual(email.date, datetime(2022, 1, 1, 12))
         self.assertEqual(email.to_mail, 'recipient@example.com')
         self.assertEqual(email.message, 'This is a test message')
         session.close()
@@ -69,7 +84,7 @@ class TestDatabaseHandler(unittest.TestCase):
             from_mail='test@example.com',
             to_mail='recipient@example.com',
             subject='Test Subject',
-            date='Sat, 01 Jan 2022 12:00:00 +0000',
+            date=datetime(2022, 1, 1, 12),
             message='This is a test message'
         )
         session.add(email)
@@ -87,14 +102,14 @@ class TestDatabaseHandler(unittest.TestCase):
             from_mail='test@example.com',
             to_mail='recipient@example.com',
             subject='Test Subject',
-            date='Sat, 01 Jan 2022 12:00:00 +0000',
+            date=datetime(2022, 1, 1, 12),
             message='This is a test message'
         )
         session.add(email)
         session.commit()
 
         latest_date = self.db_handler.get_latest_email_date()
-        self.assertEqual(latest_date, 'Sat, 01 Jan 2022 12:00:00 +0000')
+        self.assertEqual(latest_date, datetime(2022, 1, 1, 12))
         session.close()
 
     def test_load_db(self):
@@ -111,17 +126,19 @@ class TestDatabaseHandler(unittest.TestCase):
             from_mail='test@example.com',
             to_mail='recipient@example.com',
             subject='Test Subject',
-            date='Sat, 01 Jan 2022 12:00:00 +0000',
+            date=datetime(2022, 1, 1, 12),
             message='This is a test message'
         )
         session.add(email)
         session.commit()
         session.close()
 
-        # Mocking the new email that comes after the existing email
-        self.mock_gmail_handler.fetch_messages.return_value = [
-            {'id': 'test-id-3'}
-        ]
+        self.db_handler.save_sync_history_id('1')
+
+        # Mocking the new email added since the last sync
+        self.mock_gmail_handler.fetch_history.return_value = {
+            'added': {'test-id-3'}, 'deleted': set(), 'relabeled': set(), 'labels': {}, 'history_id': '2'
+        }
         self.mock_gmail_handler.fetch_message_by_id.return_value = {
             'payload': {
                 'headers': [
@@ -136,7 +153,7 @@ class TestDatabaseHandler(unittest.TestCase):
         self.mock_gmail_handler.get_email_details.return_value = {
             'From': 'new@example.com',
             'Subject': 'New Test Subject',
-            'Date': 'Sun, 02 Jan 2022 12:00:00 +0000',
+            'Date': datetime(2022, 1, 2, 12),
             'To': 'new_recipient@example.com',
             'Message': 'This is a new test message'
         }
@@ -150,7 +167,7 @@ class TestDatabaseHandler(unittest.TestCase):
         self.assertIsNotNone(new_email)
         self.assertEqual(new_email.from_mail, 'new@example.com')
         self.assertEqual(new_email.subject, 'New Test Subject')
-        self.assertEqual(new_email.date, 'Sun, 02 Jan 2022 12:00:00 +0000')
+        self.assertEqual(new_email.date, datetime(2022, 1, 2, 12))
         self.assertEqual(new_email.to_mail, 'new_recipient@example.com')
         self.assertEqual(new_email.message, 'This is a new test message')
         session.close()
@@ -162,7 +179,7 @@ class TestDatabaseHandler(unittest.TestCase):
             from_mail='test@example.com',
             to_mail='recipient@example.com',
             subject='Test Subject',
-            date='Sat, 01 Jan 2022 12:00:00 +0000',
+            date=datetime(2022, 1, 1, 12),
             message='This is a test message'
         )
         session.add(email)
@@ -179,5 +196,369 @@ class TestDatabaseHandler(unittest.TestCase):
     def test_table_exists(self):
         self.assertTrue(self.db_handler.table_exists())
 
+class TestDatabaseHandlerWithFakeService(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeGmailService([make_message('id-' + str(i)) for i in range(10)])
+        self.gmail_handler = fake_gmail_handler(self.service)
+
+        # Pipeline fetch threads build their own service
+        build_service = patch.object(GmailHandler, 'build_service', return_value=self.service)
+        build_service.start()
+        self.addCleanup(build_service.stop)
+
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+
+        with patch('handlers.db_handler.create_engine', return_value=self.engine):
+            self.db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=self.gmail_handler)
+
+    def tearDown(self):
+        Base.metadata.drop_all(self.engine)
+
+    def test_load_db_uses_batch_requests(self):
+        self.db_handler.load_db()
+        session = self.Session()
+        self.assertEqual(session.query(Email).count(), 10)
+        session.close()
+        # getProfile, the labels, one list call and a single batch for all ten messages
+        self.assertEqual(self.service.round_trips, 4)
+        self.assertEqual(self.db_handler.get_sync_history_id(), '1000')
+
+    def test_update_db_applies_history_changes(self):
+        self.db_handler.load_db()
+        self.service.add_message(make_message('new-id'))
+        self.service.delete_message('id-0')
+        self.service.relabel_message('id-1', ['STARRED'])
+        self.service.round_trips = 0
+
+        self.db_handler.update_db()
+
+        session = self.Session()
+        ids = {email.id for email in session.query(Email).all()}
+        session.close()
+        self.assertIn('new-id', ids)
+        self.assertNotIn('id-0', ids)
+        self.assertEqual(len(ids), 10)
+        # One history call, the labels and one batch for the single added message
+        self.assertEqual(self.service.round_trips, 3)
+        self.assertEqual(self.db_handler.get_sync_history_id(), str(self.service.history_id))
+
+    def labels(self, message_id):
+        rows = self.db_handler.iter_emails(Email.id == message_id, ['labels'])
+        return label_set(next(rows).labels)
+
+    def test_labels_are_mirrored_locally(self):
+        self.db_handler.load_db()
+        self.assertEqual(self.labels('id-1'), {'inbox', 'unread', 'category_personal'})
+
+        self.service.create_label('HappyFox')
+        self.service.relabel_message('id-1', ['UNREAD'], removed=True)
+        self.service.relabel_message('id-1', ['Label_9'])
+        self.db_handler.update_db()
+        self.assertEqual(self.labels('id-1'), {'inbox', 'category_personal', 'label_9', 'happyfox'})
+        self.assertEqual(self.labels('id-2'), {'inbox', 'unread', 'category_personal'})
+
+        self.service.delete_message('id-1')
+        self.db_handler.update_db()
+        session = self.Session()
+        self.assertEqual(session.query(MessageLabel).filter(MessageLabel.message_id == 'id-1').count(), 0)
+        session.close()
+
+    def test_labels_of_unsynced_mails_are_not_kept(self):
+        self.db_handler.load_db()
+        self.service.add_message(make_message('promotion', label_ids=['INBOX', 'UNREAD', 'CATEGORY_PROMOTIONS']))
+        self.service.relabel_message('promotion', ['UNREAD'], removed=True)
+        self.db_handler.update_db()
+        session = self.Session()
+        self.assertEqual(session.query(MessageLabel).filter(MessageLabel.message_id == 'promotion').count(), 0)
+        session.close()
+
+        self.service.relabel_message('promotion', ['CATEGORY_PROMOTIONS'], removed=True)
+        self.service.relabel_message('promotion', ['CATEGORY_PERSONAL'])
+        self.db_handler.update_db()
+        self.assertEqual(self.labels('promotion'), {'inbox', 'category_personal'})
+
+    def test_update_db_drops_trashed_mails(self):
+        self.db_handler.load_db()
+        self.service.add_message(make_message('promotion', label_ids=['INBOX', 'CATEGORY_PROMOTIONS', 'SPAM']))
+        self.service.relabel_message('id-3', ['TRASH'])
+        self.service.relabel_message('id-4', ['SPAM'])
+        self.db_handler.update_db()
+
+        session = self.Session()
+        ids = {email.id for email in session.query(Email).all()}
+        self.assertNotIn('id-3', ids)
+        self.assertNotIn('id-4', ids)
+
+        self.service.relabel_message('id-3', ['TRASH'], removed=True)
+        self.service.relabel_message('promotion', ['SPAM'], removed=True)
+        self.db_handler.update_db()
+
+        ids = {email.id for email in session.query(Email).all()}
+        session.close()
+        self.assertIn('id-3', ids)
+        self.assertNotIn('id-4', ids)
+        self.assertNotIn('promotion', ids)
+
+    def test_update_db_follows_the_sync_label(self):
+        self.db_handler.load_db()
+        self.service.add_message(make_message('promotion', label_ids=['INBOX', 'CATEGORY_PROMOTIONS']))
+        self.service.add_message(make_message('moved', label_ids=['INBOX', 'CATEGORY_UPDATES']))
+        self.service.relabel_message('moved', ['CATEGORY_PERSONAL'])
+        self.service.relabel_message('id-2', ['CATEGORY_PERSONAL'], removed=True)
+
+        self.db_handler.update_db()
+
+        session = self.Session()
+        ids = {email.id for email in session.query(Email).all()}
+        session.close()
+        self.assertIn('moved', ids)
+        self.assertNotIn('promotion', ids)
+        self.assertNotIn('id-2', ids)
+
+    def test_bodies_are_fetched_lazily(self):
+        self.db_handler.message_format = 'metadata'
+        self.db_handler.load_db()
+        emails = self.db_handler.fetch_emails_from_db()
+        self.assertTrue(all(email.message is None for email in emails))
+        self.assertEqual(emails[0].subject, 'Test Subject')
+
+        self.service.round_trips = 0
+        self.assertEqual(self.db_handler.load_bodies(Email.id.in_(['id-1', 'id-2', 'id-3', 'id-4'])), 4)
+        self.assertEqual(self.service.round_trips, 1)
+
+        emails = {email.id: email for email in self.db_handler.fetch_emails_from_db()}
+        self.assertEqual(emails['id-1'].message, 'This is a test message')
+        self.assertEqual(sum(email.message is not None for email in emails.values()), 4)
+        self.assertEqual(self.db_handler.load_bodies(), 6)
+        self.assertEqual(self.db_handler.load_bodies(), 0)
+
+    def test_iter_emails_streams_the_selected_columns(self):
+        self.db_handler.load_db()
+        rows = self.db_handler.iter_emails(Email.id != 'id-0', ['id', 'subject'], chunk_size=3)
+        first = next(rows)
+        self.assertEqual(first._fields, ('id', 'subject'))
+        self.assertEqual(first.subject, 'Test Subject')
+        self.assertEqual(len([first] + list(rows)), 9)
+
+    def test_iter_records_lowercases_the_text_fields(self):
+        self.db_handler.load_db()
+        records = list(self.db_handler.iter_records(Email.id == 'id-0', ['id', 'subject', 'date']))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].id, 'id-0')
+        self.assertEqual(records[0].subject, 'test subject')
+        self.assertEqual(records[0].date, datetime(2022, 1, 1, 12))
+        self.assertIsNone(records[0].from_mail)
+
+    def test_update_db_falls_back_to_full_load_when_history_expired(self):
+        self.db_handler.load_db()
+        self.service.add_message(make_message('new-id'))
+        self.service.expire_history()
+
+        self.db_handler.update_db()
+
+        session = self.Session()
+        self.assertIsNotNone(session.get(Email, 'new-id'))
+        session.close()
+        self.assertEqual(self.service.calls['messages.list'], 2)
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.engine = create_engine('sqlite:///' + os.path.join(directory.name, 'emails.db'))
+        self.addCleanup(self.engine.dispose)
+
+    def create_handler(self):
+        with patch('handlers.db_handler.create_engine', return_value=self.engine):
+            return DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=Mock())
+
+    def query_plan(self, statement):
+        with self.engine.connect() as connection:
+            return ' '.join(row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + statement)))
+
+    def test_storage_profile_is_applied(self):
+        self.create_handler()
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+            # NORMAL
+            self.assertEqual(connection.execute(text('PRAGMA synchronous')).scalar(), 1)
+            self.assertEqual(connection.execute(text('PRAGMA cache_size')).scalar(), -64000)
+
+    def test_lookups_use_the_indexes(self):
+        db_handler = self.create_handler()
+        now = datetime(2024, 6, 1)
+        with db_handler.email_writer() as writer:
+            for i in range(200):
+                writer.add('id-' + str(i), {'From': 'sender' + str(i) + '@example.com', 'Date': now - timedelta(hours=i)})
+
+        self.assertEqual(db_handler.get_latest_email_date(), now)
+        self.assertIn('ix_emails_date', self.query_plan('SELECT max(date) FROM emails'))
+        self.assertIn('ix_emails_date', self.query_plan("SELECT * FROM emails WHERE date > '2024-05-01'"))
+        self.assertIn('ix_emails_from_mail_lower', self.query_plan("SELECT * FROM emails WHERE lower(from_mail) = 'a'"))
+
+    def test_old_databases_are_migrated(self):
+        with self.engine.begin() as connection:
+            connection.execute(text('CREATE TABLE emails (id VARCHAR PRIMARY KEY, from_mail VARCHAR, to_mail VARCHAR, '
+                                    'subject VARCHAR, date DATETIME)'))
+            connection.execute(text("INSERT INTO emails (id, subject) VALUES ('old-id', 'Kept')"))
+
+        db_handler = self.create_handler()
+
+        emails = db_handler.fetch_emails_from_db()
+        self.assertEqual([(email.id, email.subject, email.message) for email in emails], [('old-id', 'Kept', None)])
+        self.assertIn('ix_emails_date', self.query_plan('SELECT max(date) FROM emails'))
+        # Migrating again is a no-op
+        db_handler.migrate_schema()
+
+    def count(self, table):
+        with self.engine.connect() as connection:
+            return connection.execute(text('SELECT count(*) FROM ' + table)).scalar()
+
+    def test_bodies_are_stored_once_compressed(self):
+        db_handler = self.create_handler()
+        newsletter = 'Read this week\'s digest online. ' * 200
+        with db_handler.email_writer() as writer:
+            for i in range(3):
+                writer.add('id-' + str(i), {'Subject': 'Digest ' + str(i), 'Message': newsletter})
+            writer.add('id-3', {'Subject': 'Hello', 'Message': 'A personal message'})
+            writer.add('id-4', {'Subject': 'Headers only'})
+
+        self.assertEqual(self.count('bodies'), 2)
+        self.assertEqual(self.count('emails WHERE message IS NOT NULL'), 0)
+        with self.engine.connect() as connection:
+            self.assertLess(connection.execute(text('SELECT max(length(data)) FROM bodies')).scalar(), len(newsletter) / 10)
+
+        emails = {email.id: email for email in db_handler.fetch_emails_from_db()}
+        self.assertEqual(emails['id-2'].message, newsletter)
+        self.assertIsNone(emails['id-4'].message)
+        records = list(db_handler.iter_records(Email.id == 'id-3', ['id', 'message']))
+        self.assertEqual(records[0].message, 'a personal message')
+        self.assertEqual({email.id for email in db_handler.search_emails('personal')}, {'id-3'})
+        self.assertEqual({email.id for email in db_handler.fetch_emails_from_db(Email.message.icontains('digest online'))},
+                         {'id-0', 'id-1', 'id-2'})
+
+        db_handler.delete_emails(['id-0', 'id-1'])
+        self.assertEqual(self.count('bodies'), 2)
+        db_handler.delete_emails(['id-2'])
+        self.assertEqual(self.count('bodies'), 1)
+        self.assertEqual(db_handler.search_emails('digest online'), [])
+
+    def test_inline_bodies_are_compressed_on_migration(self):
+        with self.engine.begin() as connection:
+            connection.execute(text('CREATE TABLE emails (id VARCHAR PRIMARY KEY, from_mail VARCHAR, to_mail VARCHAR, '
+                                    'subject VARCHAR, date DATETIME, message VARCHAR)'))
+            # The full text index as it was created over emails.message
+            connection.execute(text("CREATE VIRTUAL TABLE emails_fts USING fts5(subject, from_mail, message, "
+                                    "content='emails', content_rowid='rowid', tokenize='trigram')"))
+            connection.execute(text("CREATE TRIGGER emails_fts_insert AFTER INSERT ON emails BEGIN "
+                                    "INSERT INTO emails_fts(rowid, subject, from_mail, message) "
+                                    "VALUES (new.rowid, new.subject, new.from_mail, new.message); END"))
+            connection.execute(text("INSERT INTO emails (id, subject, message) VALUES ('old-id', 'Kept', 'Old body')"))
+
+        db_handler = self.create_handler()
+
+        self.assertEqual(self.count('bodies'), 1)
+        self.assertEqual(self.count('emails WHERE message IS NOT NULL'), 0)
+        self.assertEqual([email.message for email in db_handler.fetch_emails_from_db()], ['Old body'])
+        self.assertEqual([email.id for email in db_handler.search_emails('old bod')], ['old-id'])
+
+
+class TestEmailWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.commits = 0
+
+        @event.listens_for(self.engine, 'commit')
+        def count_commit(connection):
+            self.commits += 1
+
+    def details(self, subject='Test Subject'):
+        return {'From': 'test@example.com', 'To': 'recipient@example.com', 'Subject': subject,
+                'Date': datetime(2022, 1, 1, 12), 'Message': 'This is a test message'}
+
+    def count_emails(self):
+        session = self.Session()
+        count = session.query(Email).count()
+        session.close()
+        return count
+
+    def test_writes_one_transaction_per_chunk(self):
+        with EmailWriter(self.engine, chunk_size=500) as writer:
+            for i in range(1200):
+                writer.add('id-' + str(i), self.details())
+        self.assertEqual(self.count_emails(), 1200)
+        self.assertEqual(self.commits, 3)
+
+    def test_skips_duplicates_in_sql(self):
+        with EmailWriter(self.engine) as writer:
+            writer.add('id-1', self.details())
+        with EmailWriter(self.engine) as writer:
+            writer.add('id-1', self.details('Changed Subject'))
+            writer.add('id-2', self.details())
+        self.assertEqual(writer.inserted, 1)
+        self.assertEqual(writer.duplicates, 1)
+        session = self.Session()
+        self.assertEqual(session.get(Email, 'id-1').subject, 'Test Subject')
+        session.close()
+
+    def test_flushes_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with EmailWriter(self.engine) as writer:
+                writer.add('id-1', self.details())
+                raise RuntimeError('fetch failed')
+        self.assertEqual(self.count_emails(), 1)
+
+
+class TestFullTextSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+
+        # An Email stored before the index existed
+        with EmailWriter(self.engine) as writer:
+            writer.add('old-id', self.details('Old India Report', 'archive@example.com'))
+
+        with patch('handlers.db_handler.create_engine', return_value=self.engine):
+            self.db_handler = DatabaseHandler(load_flag=False, update_flag=False, gmail_handler=Mock())
+
+        with self.db_handler.email_writer() as writer:
+            writer.add('id-1', self.details('Weekly Indiana digest', 'news@google.com'))
+            writer.add('id-2', self.details('Lunch?', 'friend@example.com', 'See you in India'))
+
+    def details(self, subject, from_mail, message='Hello'):
+        return {'From': from_mail, 'To': 'me@example.com', 'Subject': subject,
+                'Date': datetime(2022, 1, 1, 12), 'Message': message}
+
+    def search_ids(self, query, **kwargs):
+        return {email.id for email in self.db_handler.search_emails(query, **kwargs)}
+
+    def test_index_is_enabled(self):
+        self.assertTrue(self.db_handler.fts_enabled)
+
+    def test_search_matches_substrings_case_insensitively(self):
+        self.assertEqual(self.search_ids('INDIA'), {'old-id', 'id-1', 'id-2'})
+        self.assertEqual(self.search_ids('india', fields=('subject',)), {'old-id', 'id-1'})
+        self.assertEqual(self.search_ids('google.com'), {'id-1'})
+
+    def test_short_queries_scan_the_table(self):
+        self.assertEqual(self.search_ids('?'), {'id-2'})
+
+    def test_index_follows_deletes(self):
+        self.db_handler.delete_emails(['id-1'])
+        self.assertEqual(self.search_ids('india'), {'old-id', 'id-2'})
+        self.db_handler.empty_table()
+        self.assertEqual(self.search_ids('india'), set())
+
+
 if __name__ == '__main__':
     unittest.main()
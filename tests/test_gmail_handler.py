@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import patch, Mock
 from googleapiclient.errors import HttpError
 from handlers.gmail_handler import GmailHandler
+from tests.fake_gmail import FakeGmailService, fake_gmail_handler, make_message
 
 class TestGmailHandler(unittest.TestCase):
     
@@ -87,5 +88,148 @@ class TestGmailHandler(unittest.TestCase):
             userId='me', id='test-id', body={'addLabelIds': ['UNREAD']}
         )
 
+class TestGmailHandlerListing(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeGmailService([make_message('id-' + str(i)) for i in range(1200)])
+        self.gmail_handler = fake_gmail_handler(self.service)
+
+    def test_iter_messages_follows_page_tokens(self):
+        messages = list(self.gmail_handler.iter_messages(page_size=500))
+        self.assertEqual(len(messages), 1200)
+        self.assertEqual(self.service.calls['messages.list'], 3)
+
+    def test_iter_messages_is_lazy(self):
+        messages = self.gmail_handler.iter_messages(page_size=500)
+        first = [next(messages) for _ in range(500)]
+        self.assertEqual(first[0]['id'], 'id-0')
+        self.assertEqual(self.service.calls['messages.list'], 1)
+
+    def test_iter_messages_stops_at_max_results(self):
+        messages = list(self.gmail_handler.iter_messages(max_results=600, page_size=500))
+        self.assertEqual(len(messages), 600)
+        self.assertEqual(self.service.calls['messages.list'], 2)
+
+    def test_random_quota_errors_are_retried(self):
+        self.service = FakeGmailService([make_message('id-' + str(i)) for i in range(300)], error_rate=0.1, seed=7)
+        self.gmail_handler = fake_gmail_handler(self.service, sleep=lambda delay: None)
+
+        message_ids = [message['id'] for message in self.gmail_handler.iter_messages(page_size=100)]
+        fetched = dict(self.gmail_handler.fetch_messages_batch(message_ids))
+        self.assertEqual(len(fetched), 300)
+        self.assertGreater(self.service.errors, 0)
+        self.assertEqual(sum(self.service.calls.values()), 3 + 300 + self.service.errors)
+
+
+class TestGmailHandlerLabelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeGmailService([make_message('id-' + str(i)) for i in range(20)], labels=['HappyFox'])
+        self.gmail_handler = fake_gmail_handler(self.service)
+
+    def test_labels_are_listed_once(self):
+        for i in range(20):
+            self.gmail_handler.move_to_folder('id-' + str(i), 'happyfox')
+        self.assertEqual(self.service.calls['labels.list'], 1)
+        self.assertEqual(self.service.calls['messages.modify'], 20)
+        self.assertIn('Label_9', self.service.label_ids('id-3'))
+
+    def test_miss_refreshes_once(self):
+        self.gmail_handler.get_label_id('HappyFox')
+        self.service.create_label('Receipts')
+        self.assertEqual(self.gmail_handler.get_label_id('RECEIPTS'), 'Label_10')
+        self.assertIsNone(self.gmail_handler.get_label_id('Missing'))
+        self.assertIsNone(self.gmail_handler.get_label_id('Missing'))
+        self.assertEqual(self.service.calls['labels.list'], 3)
+
+    def test_cache_expires(self):
+        now = [1000]
+        gmail_handler = fake_gmail_handler(self.service, clock=lambda: now[0])
+        gmail_handler.get_label_id('HappyFox')
+        now[0] += 299
+        gmail_handler.get_label_id('HappyFox')
+        self.assertEqual(self.service.calls['labels.list'], 1)
+        now[0] += 2
+        gmail_handler.get_label_id('HappyFox')
+        self.assertEqual(self.service.calls['labels.list'], 2)
+
+    def test_invalidate_label_cache(self):
+        self.gmail_handler.get_label_id('HappyFox')
+        self.gmail_handler.invalidate_label_cache()
+        self.gmail_handler.get_label_id('HappyFox')
+        self.assertEqual(self.service.calls['labels.list'], 2)
+
+    def test_missing_label_is_created(self):
+        label_id = self.gmail_handler.get_label_id('Newsletters', create=True)
+        self.assertEqual(self.service.labels[label_id]['name'], 'Newsletters')
+        self.assertEqual(self.gmail_handler.get_label_id('newsletters'), label_id)
+        self.assertEqual(self.service.calls['labels.create'], 1)
+        self.assertEqual(self.service.calls['labels.list'], 1)
+
+
+class TestGmailHandlerBatchFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.message_ids = ['id-' + str(i) for i in range(120)]
+        self.service = FakeGmailService([make_message(i) for i in self.message_ids])
+        self.gmail_handler = fake_gmail_handler(self.service, sleep=self.sleeps.append)
+
+    def test_fetch_messages_batch_round_trips(self):
+        messages = dict(self.gmail_handler.fetch_messages_batch(self.message_ids, batch_size=50))
+        self.assertEqual(sorted(messages), sorted(self.message_ids))
+        self.assertEqual(self.service.round_trips, 3)
+
+    def test_fetch_message_by_id_round_trips(self):
+        for message_id in self.message_ids:
+            self.gmail_handler.fetch_message_by_id(message_id)
+        self.assertEqual(self.service.round_trips, 120)
+
+    def test_fetch_messages_batch_retries_rate_limited_items(self):
+        self.service.failures = {'id-1': [429], 'id-2': [503, 403]}
+        messages = dict(self.gmail_handler.fetch_messages_batch(self.message_ids[:10]))
+        self.assertEqual(len(messages), 10)
+        self.assertEqual(self.service.round_trips, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertEqual(self.gmail_handler.rate_limiter.throttle_count, 2)
+
+    def test_execute_retries_with_backoff(self):
+        self.service.failures = {'id-1': [429, 503]}
+        self.assertEqual(self.gmail_handler.fetch_message_by_id('id-1')['id'], 'id-1')
+        self.assertEqual(self.service.round_trips, 3)
+        # Jittered exponential backoff: 0.5-1 then 1-2 seconds
+        self.assertTrue(0.5 <= self.sleeps[0] <= 1 and 1 <= self.sleeps[1] <= 2)
+        self.assertEqual(self.gmail_handler.rate_limiter.throttle_count, 1)
+        self.assertEqual(self.gmail_handler.rate_limiter.metrics()['completed'], 1)
+
+    def test_execute_gives_up_after_max_retries(self):
+        self.service.failures = {'id-1': [503] * 4}
+        with self.assertRaises(HttpError):
+            self.gmail_handler.fetch_message_by_id('id-1')
+        self.assertEqual(self.service.round_trips, 4)
+
+    def test_execute_does_not_retry_client_errors(self):
+        with self.assertRaises(HttpError):
+            self.gmail_handler.fetch_message_by_id('missing')
+        self.assertEqual(self.service.round_trips, 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_metadata_format_leaves_out_the_body(self):
+        full = dict(self.gmail_handler.fetch_messages_batch(self.message_ids[:10]))
+        full_bytes = self.service.bytes_sent
+        metadata = dict(self.gmail_handler.fetch_messages_batch(self.message_ids[:10], message_format='metadata'))
+        self.assertLess(self.service.bytes_sent - full_bytes, full_bytes)
+
+        details = self.gmail_handler.get_email_details(metadata['id-3'])
+        self.assertNotIn('Message', details)
+        self.assertEqual(details['Subject'], 'Test Subject')
+        self.assertEqual(self.gmail_handler.get_email_details(full['id-3'])['Message'], 'This is a test message')
+
+    def test_fetch_messages_batch_skips_missing_messages(self):
+        messages = dict(self.gmail_handler.fetch_messages_batch(['id-0', 'missing', 'id-1']))
+        self.assertEqual(sorted(messages), ['id-0', 'id-1'])
+        self.assertEqual(self.service.round_trips, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
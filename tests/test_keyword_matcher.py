@@ -0,0 +1,39 @@
+import random
+import unittest
+from utils.keyword_matcher import KeywordMatcher, build_trie_pattern
+
+
+class TestKeywordMatcher(unittest.TestCase):
+
+    def test_trie_pattern_factors_prefixes(self):
+        self.assertEqual(build_trie_pattern(['ab', 'ac']), 'a(?:b|c)')
+        self.assertEqual(build_trie_pattern(['in', 'india']), 'in(?:dia)?')
+
+    def test_overlapping_and_nested_keywords(self):
+        keywords = ['india', 'ind', 'dia', 'indian', 'ian', 'nope']
+        matcher = KeywordMatcher(keywords, regex_min_keywords=0)
+        self.assertIsNotNone(matcher.pattern)
+        self.assertEqual(matcher.find('weekly indian news'), {'india', 'ind', 'dia', 'indian', 'ian'})
+
+    def test_empty_keyword_always_matches(self):
+        matcher = KeywordMatcher(['', 'abc'], regex_min_keywords=0)
+        self.assertEqual(matcher.find('xyz'), {''})
+
+    def test_special_characters_are_escaped(self):
+        matcher = KeywordMatcher(['a.b', '(x)', '[y]'], regex_min_keywords=0)
+        self.assertEqual(matcher.find('axb (x) a.b'), {'a.b', '(x)'})
+
+    def test_regex_and_plain_scans_agree(self):
+        random_generator = random.Random(7)
+        alphabet = 'abcd '
+        for _ in range(200):
+            keywords = [''.join(random_generator.choice(alphabet) for _ in range(random_generator.randint(1, 4)))
+                        for _ in range(random_generator.randint(1, 12))]
+            text = ''.join(random_generator.choice(alphabet) for _ in range(random_generator.randint(0, 60)))
+            expected = {keyword for keyword in keywords if keyword in text}
+            self.assertEqual(KeywordMatcher(keywords, regex_min_keywords=0).find(text), expected)
+            self.assertEqual(KeywordMatcher(keywords).find(text), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import base64
+import unittest
+from utils.mime import decode_data, extract_body, find_text_part, get_charset
+
+
+def encode(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii')
+
+
+def part(mime_type, text='', charset=None, filename=''):
+    headers = [{'name': 'Content-Type', 'value': mime_type + ('; charset="' + charset + '"' if charset else '')}]
+    return {'mimeType': mime_type, 'filename': filename, 'headers': headers,
+            'body': {'data': encode(text, charset or 'utf-8')}}
+
+
+def multipart(mime_type, *parts):
+    return {'mimeType': mime_type, 'body': {'size': 0}, 'parts': list(parts)}
+
+
+class TestMime(unittest.TestCase):
+
+    def test_nested_plain_text_is_found(self):
+        payload = multipart('multipart/mixed',
+                            multipart('multipart/related',
+                                      multipart('multipart/alternative',
+                                                part('text/plain', 'Hello plain'),
+                                                part('text/html', '<p>Hello html</p>'))),
+                            part('text/plain', 'attached notes', filename='notes.txt'))
+        self.assertEqual(extract_body(payload), 'Hello plain')
+
+    def test_first_plain_part_wins(self):
+        payload = multipart('multipart/mixed', part('text/plain', 'first'), part('text/plain', 'second'))
+        self.assertEqual(extract_body(payload), 'first')
+
+    def test_html_is_used_without_plain_text(self):
+        payload = multipart('multipart/alternative',
+                            part('text/html', '<style>p {}</style><p>Caf&eacute; <b>menu</b></p>'))
+        self.assertEqual(extract_body(payload).split(), ['Café', 'menu'])
+
+    def test_deep_nesting_does_not_recurse(self):
+        payload = part('text/plain', 'deep')
+        for _ in range(5000):
+            payload = multipart('multipart/mixed', payload)
+        self.assertEqual(find_text_part(payload)['mimeType'], 'text/plain')
+
+    def test_charsets(self):
+        self.assertEqual(extract_body(part('text/plain', 'Grüße', charset='iso-8859-1')), 'Grüße')
+        self.assertEqual(extract_body(part('text/plain', 'こんにちは', charset='Shift_JIS')), 'こんにちは')
+        unknown = {'headers': [{'name': 'content-type', 'value': 'text/plain; charset=x-unknown'}]}
+        self.assertEqual(get_charset(unknown), 'utf-8')
+        # Invalid bytes don't abort the decoding
+        self.assertEqual(decode_data(base64.urlsafe_b64encode(b'ok \xff').decode()), 'ok �')
+
+    def test_large_bodies_are_cut(self):
+        text = 'é' * 1000
+        self.assertEqual(decode_data(encode(text), max_bytes=101), 'é' * 50)
+        self.assertEqual(decode_data(encode(text), max_bytes=4000), text)
+        self.assertEqual(decode_data(encode('short'), max_bytes=5), 'short')
+
+    def test_unpadded_data(self):
+        self.assertEqual(decode_data(encode('ab').rstrip('=')), 'ab')
+
+    def test_missing_bodies(self):
+        # 'metadata' format
+        self.assertIsNone(extract_body({'mimeType': 'text/plain', 'headers': []}))
+        self.assertEqual(extract_body(multipart('multipart/mixed', part('image/png'))), '')
+        self.assertEqual(extract_body({'mimeType': 'text/plain', 'body': {'size': 0}}), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from unittest.mock import patch
+from handlers.gmail_handler import GmailHandler
+from handlers.pipeline import LoadPipeline
+from tests.fake_gmail import FakeGmailService, fake_gmail_handler, make_message
+
+
+class ListWriter:
+
+    def __init__(self):
+        self.emails = {}
+
+    def add(self, message_id, details):
+        self.emails[message_id] = details
+
+
+class TestLoadPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.message_ids = ['id-' + str(i) for i in range(500)]
+        self.service = FakeGmailService([make_message(i, subject='Subject ' + i) for i in self.message_ids])
+        self.gmail_handler = fake_gmail_handler(self.service)
+
+        build_service = patch.object(GmailHandler, 'build_service', return_value=self.service)
+        build_service.start()
+        self.addCleanup(build_service.stop)
+
+        self.writer = ListWriter()
+
+    def test_run_loads_all_messages(self):
+        pipeline = LoadPipeline(self.gmail_handler, self.writer, fetch_workers=4, parse_workers=2, batch_size=50)
+        count = pipeline.run(iter(self.message_ids))
+        self.assertEqual(count, 500)
+        self.assertEqual(sorted(self.writer.emails), sorted(self.message_ids))
+        self.assertEqual(self.writer.emails['id-7']['Subject'], 'Subject id-7')
+        self.assertEqual(self.service.round_trips, 10)
+
+    def test_run_with_small_queues(self):
+        pipeline = LoadPipeline(self.gmail_handler, self.writer, fetch_workers=2, parse_workers=1,
+                                queue_size=1, batch_size=10)
+        self.assertEqual(pipeline.run(self.message_ids), 500)
+
+    def test_run_stops_on_parse_error(self):
+        pipeline = LoadPipeline(self.gmail_handler, self.writer, batch_size=50)
+        with patch.object(GmailHandler, 'get_email_details', side_effect=ValueError('bad message')):
+            with self.assertRaises(ValueError):
+                pipeline.run(self.message_ids)
+        self.assertEqual(self.writer.emails, {})
+
+    def test_run_stops_on_listing_error(self):
+        def message_ids():
+            yield from self.message_ids[:100]
+            raise RuntimeError('listing failed')
+
+        pipeline = LoadPipeline(self.gmail_handler, self.writer, batch_size=50)
+        with self.assertRaises(RuntimeError):
+            pipeline.run(message_ids())
+
+
+if __name__ == '__main__':
+    unittest.main()
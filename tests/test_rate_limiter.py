@@ -0,0 +1,96 @@
+import asyncio
+import time
+import unittest
+from utils.rate_limiter import RateLimiter
+
+
+class FakeClock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(rate=100, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_burst_is_not_delayed(self):
+        for _ in range(20):
+            self.limiter.acquire('messages.get')
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_waits_once_the_bucket_is_empty(self):
+        self.limiter.acquire('messages.batchModify', 2)
+        self.limiter.acquire('messages.get')
+        self.assertEqual(self.clock.sleeps, [0.05])
+        self.assertEqual(self.limiter.metrics()['units'], 105)
+
+    def test_bucket_refills_over_time(self):
+        self.limiter.reserve(100)
+        self.clock.now += 0.5
+        self.assertEqual(self.limiter.reserve(50), 0)
+        self.assertEqual(self.limiter.reserve(10), 0.1)
+
+    def test_clock_going_backwards_does_not_drain_the_bucket(self):
+        self.clock.now -= 1000
+        self.assertEqual(self.limiter.reserve(5), 0)
+
+    def test_throttling_halves_the_rate_and_success_recovers_it(self):
+        self.limiter.throttled()
+        self.limiter.throttled()
+        self.assertEqual(self.limiter.rate, 25)
+        for _ in range(100):
+            self.limiter.succeeded()
+        self.assertEqual(self.limiter.rate, 100)
+        self.assertEqual(self.limiter.throttle_count, 2)
+
+    def test_rate_never_drops_below_the_minimum(self):
+        for _ in range(20):
+            self.limiter.throttled()
+        self.assertEqual(self.limiter.rate, 100 / 32)
+
+    def test_backoff_is_exponential_with_jitter(self):
+        for attempt in range(4):
+            delay = self.limiter.backoff(attempt)
+            self.assertTrue(2 ** attempt / 2 <= delay <= 2 ** attempt)
+
+    def test_qps_counts_completed_calls(self):
+        self.limiter.acquire('messages.get', 10)
+        self.limiter.succeeded(4)
+        self.clock.now += 2
+        metrics = self.limiter.metrics()
+        self.assertEqual(metrics['calls'], 10)
+        self.assertEqual(metrics['qps'], 2)
+
+    def test_no_rate_only_keeps_metrics(self):
+        limiter = RateLimiter(rate=None, clock=self.clock, sleep=self.clock.sleep)
+        for _ in range(1000):
+            limiter.acquire('messages.batchModify')
+        limiter.throttled()
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(limiter.metrics()['units'], 50000)
+
+    def test_acquire_async_waits(self):
+        limiter = RateLimiter(rate=1000)
+        async def acquire():
+            for _ in range(250):
+                await limiter.acquire_async('messages.get')
+        start = time.monotonic()
+        asyncio.run(acquire())
+        # 1250 units from a bucket of 1000 at 1000 units per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.24)
+        self.assertGreater(limiter.wait_time, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
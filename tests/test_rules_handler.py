@@ -1,8 +1,14 @@
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from datetime import datetime, timezone, timedelta
-from config.models import Email
-from handlers.rules_handler import RulesHandler
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import sessionmaker
+from config.models import (Base, Email, EmailRecord, EMAIL_FIELDS, EMAILS_FTS_DDL, Label, MessageLabel,
+                           email_labels)
+from handlers.db_handler import ActionJournal
+from handlers.rules_handler import RulesHandler, merge_label_changes, split_label_changes
+from tests.fake_gmail import FakeGmailService, fake_gmail_handler, make_message
+from utils.keyword_matcher import KeywordMatcher
 # from email_message import Email
 
 
@@ -58,9 +64,441 @@ class TestRulesHandler(unittest.TestCase):
         gmail_ops_mock = Mock()
         email = Email(id='test-id', from_mail='test@google.com', subject='Test Subject',
                              date='Sat, 01 Jan 2022 12:00:00 +0000', message='Test Body')
+        gmail_ops_mock.get_label_id.return_value = 'Label_1'
+        gmail_ops_mock.batch_modify.return_value = [{'ids': ['test-id'], 'error': None}]
         self.rules_handler.apply_actions(gmail_ops_mock, email)
-        gmail_ops_mock.mark_as_read.assert_called_once_with('test-id')
-        gmail_ops_mock.move_to_folder.assert_called_once_with('test-id', 'HappyFox')
+        gmail_ops_mock.get_label_id.assert_called_once_with('HappyFox', False)
+        gmail_ops_mock.batch_modify.assert_called_once_with(['test-id'], ('Label_1',), ('UNREAD',))
+
+
+class TestCompiledRules(unittest.TestCase):
+
+    def setUp(self):
+        self.rules_handler = RulesHandler('config/rules.json')
+        self.now = datetime(2024, 6, 1, 12)
+
+    def compile(self, rules, predicate='all'):
+        self.rules_handler.rules = {'rules': rules, 'predicate': predicate, 'actions': []}
+        self.rules_handler.compile_rules(self.now)
+
+    def email(self, **fields):
+        values = dict(id='test-id', from_mail='News@Google.com', to_mail='me@example.com',
+                      subject='Weekly Digest', date=self.now - timedelta(hours=12), message='Hello World')
+        values.update(fields)
+        return Email(**values)
+
+    def test_string_predicates_ignore_case(self):
+        self.compile([
+            {'field': 'from_mail', 'predicate': 'contains', 'value': 'GOOGLE'},
+            {'field': 'subject', 'predicate': 'not_contains', 'value': 'urgent'},
+            {'field': 'to_mail', 'predicate': 'equals', 'value': 'Me@Example.com'},
+            {'field': 'message', 'predicate': 'not_equals', 'value': 'bye'}
+        ])
+        self.assertTrue(self.rules_handler.evaluate_rules(self.email()))
+        self.assertFalse(self.rules_handler.evaluate_rules(self.email(subject='URGENT: Digest')))
+
+    def test_date_cutoffs(self):
+        self.compile([{'field': 'date', 'predicate': 'less_than', 'value': '1 days'}])
+        self.assertTrue(self.rules_handler.evaluate_rules(self.email()))
+        self.assertFalse(self.rules_handler.evaluate_rules(self.email(date=self.now - timedelta(days=2))))
+
+        self.compile([{'field': 'date', 'predicate': 'greater_than', 'value': '1 months'}])
+        self.assertTrue(self.rules_handler.evaluate_rules(self.email(date=self.now - timedelta(days=31))))
+        self.assertFalse(self.rules_handler.evaluate_rules(self.email()))
+
+    def test_any_predicate(self):
+        self.compile([
+            {'field': 'subject', 'predicate': 'contains', 'value': 'invoice'},
+            {'field': 'from_mail', 'predicate': 'contains', 'value': 'google'}
+        ], predicate='any')
+        self.assertTrue(self.rules_handler.evaluate_rules(self.email()))
+        self.assertFalse(self.rules_handler.evaluate_rules(self.email(from_mail='someone@else.com')))
+
+    def test_missing_values_do_not_match(self):
+        self.compile([{'field': 'subject', 'predicate': 'contains', 'value': 'digest'}])
+        self.assertFalse(self.rules_handler.evaluate_rules(self.email(subject=None)))
+
+    def test_keyword_rules_share_one_scan_per_field(self):
+        self.compile([
+            {'field': 'message', 'predicate': 'contains', 'value': 'hello'},
+            {'field': 'message', 'predicate': 'contains', 'value': 'world'},
+            {'field': 'message', 'predicate': 'not_contains', 'value': 'unsubscribe'}
+        ])
+        with patch.object(KeywordMatcher, 'find', autospec=True, side_effect=KeywordMatcher.find) as mock_find:
+            self.assertTrue(self.rules_handler.evaluate_rules(self.email()))
+        self.assertEqual(mock_find.call_count, 1)
+
+    def test_records_match_like_orm_emails(self):
+        self.compile([
+            {'field': 'from_mail', 'predicate': 'contains', 'value': 'GOOGLE'},
+            {'field': 'subject', 'predicate': 'equals', 'value': 'weekly digest'},
+            {'field': 'message', 'predicate': 'not_contains', 'value': 'bye'},
+            {'field': 'date', 'predicate': 'less_than', 'value': '1 days'}
+        ])
+        build = EmailRecord.builder(list(EMAIL_FIELDS))
+        email = self.email()
+        record = build(tuple(getattr(email, field, None) for field in EMAIL_FIELDS))
+        self.assertEqual(record.from_mail, 'news@google.com')
+        self.assertTrue(self.rules_handler.evaluate_rules(record))
+
+        record = build(tuple(getattr(self.email(subject=None), field, None) for field in EMAIL_FIELDS))
+        self.assertFalse(self.rules_handler.evaluate_rules(record))
+
+    def test_records_are_built_from_the_selected_columns(self):
+        build = EmailRecord.builder(['subject', 'id', 'date'])
+        record = build(('Weekly Digest', 'test-id', 'Sat, 01 Jun 2024 00:00:00 +0000'))
+        self.assertEqual(record.id, 'test-id')
+        self.assertEqual(record.subject, 'weekly digest')
+        self.assertEqual(record.date, datetime(2024, 6, 1))
+        self.assertIsNone(record.message)
+        with self.assertRaises(AttributeError):
+            record.subject = 'other'
+
+    def test_worker_processes_match_like_the_serial_path(self):
+        self.compile([
+            {'field': 'subject', 'predicate': 'contains', 'value': 'digest'},
+            {'field': 'date', 'predicate': 'less_than', 'value': '3 days'}
+        ])
+        build = EmailRecord.builder(list(EMAIL_FIELDS))
+        emails = [self.email(id='id-' + str(i), subject=('Weekly Digest ' if i % 3 else 'Hello ') + str(i),
+                             date=self.now - timedelta(days=i % 5))
+                  for i in range(50)]
+        records = [build(tuple(getattr(email, field, None) for field in EMAIL_FIELDS)) for email in emails]
+
+        serial = list(self.rules_handler.iter_matches(records))
+        self.rules_handler.workers = 2
+        self.assertEqual(list(self.rules_handler.iter_matches(iter(records), chunk_size=7)), serial)
+        self.assertEqual([match[0] for match in self.rules_handler.iter_matches(emails, chunk_size=4)],
+                         [match[0] for match in serial])
+        self.assertEqual(serial[0], ('id-1', 'weekly digest 1', (0,), None))
+
+    def test_fields_are_normalized_once(self):
+        self.compile([
+            {'field': 'subject', 'predicate': 'contains', 'value': 'weekly'},
+            {'field': 'Subject', 'predicate': 'contains', 'value': 'digest'}
+        ])
+        self.assertEqual(self.rules_handler.fields, ('subject',))
+
+
+class TestRulesets(unittest.TestCase):
+
+    def setUp(self):
+        self.rules_handler = RulesHandler('config/rules.json')
+        self.now = datetime(2024, 6, 1, 12)
+        self.rules_handler.rules = {'rulesets': [
+            {
+                'name': 'Archive Google',
+                'priority': 2,
+                'predicate': 'all',
+                'rules': [
+                    {'field': 'from_mail', 'predicate': 'contains', 'value': 'google'},
+                    {'predicate': 'any', 'rules': [
+                        {'field': 'subject', 'predicate': 'contains', 'value': 'digest'},
+                        {'field': 'date', 'predicate': 'greater_than', 'value': '1 months'}
+                    ]}
+                ],
+                'actions': [{'name': 'mark_as_read'}, {'name': 'move', 'folder_name': 'Archive'}]
+            },
+            {
+                'name': 'Keep Google',
+                'priority': 1,
+                'predicate': 'all',
+                'rules': [{'field': 'from_mail', 'predicate': 'contains', 'value': 'GOOGLE'}],
+                'actions': [{'name': 'mark_as_unread'}, {'name': 'move', 'folder_name': 'Google'}]
+            },
+            {
+                'name': 'Lunch',
+                'predicate': 'any',
+                'rules': [{'field': 'subject', 'predicate': 'equals', 'value': 'lunch?'}],
+                'actions': [{'name': 'move', 'folder_name': 'Google', 'create_folder': True}]
+            }
+        ]}
+        self.rules_handler.compile_rules(self.now)
+        self.emails = [
+            Email(id='1', from_mail='News@Google.com', subject='Weekly Digest', date=self.now, message='a'),
+            Email(id='2', from_mail='alerts@google.com', subject='Security', date=self.now, message='b'),
+            Email(id='3', from_mail='friend@example.com', subject='Lunch?', date=self.now, message='c'),
+            Email(id='4', from_mail='friend@example.com', subject='Hello', date=self.now, message='d')
+        ]
+
+    def test_rulesets_are_ordered_by_priority(self):
+        self.assertEqual([ruleset['name'] for ruleset in self.rules_handler.rulesets],
+                         ['Lunch', 'Keep Google', 'Archive Google'])
+        self.assertEqual([self.rules_handler.match_rulesets(email) for email in self.emails],
+                         [(1, 2), (1,), (0,), ()])
+
+    def test_shared_conditions_are_evaluated_once(self):
+        with patch.object(KeywordMatcher, 'find', autospec=True, side_effect=KeywordMatcher.find) as mock_find:
+            self.rules_handler.match_rulesets(self.emails[0])
+        # One scan of from_mail for both rulesets, one of the subject for the nested group
+        self.assertEqual(mock_find.call_count, 2)
+        self.assertEqual(self.rules_handler.fields, ('subject', 'from_mail', 'date'))
+
+    def test_actions_are_merged_per_message(self):
+        gmail_handler = Mock()
+        gmail_handler.get_label_id.side_effect = lambda name, create: 'Label_' + name
+        gmail_handler.batch_modify.side_effect = lambda ids, add, remove: [{'ids': ids, 'error': None}]
+
+        self.rules_handler.process_emails(gmail_handler, self.emails, self.now)
+
+        self.assertEqual(sorted(gmail_handler.get_label_id.call_args_list),
+                         [(('Archive', False),), (('Google', True),)])
+        calls = {call.args[0][0]: call.args[1:] for call in gmail_handler.batch_modify.call_args_list}
+        self.assertEqual(len(gmail_handler.batch_modify.call_args_list), 3)
+        # The higher priority ruleset marks it as read, over the other one marking it as unread
+        self.assertEqual(calls['1'], (('Label_Google', 'Label_Archive'), ('UNREAD',)))
+        self.assertEqual(calls['2'], (('UNREAD', 'Label_Google'), ()))
+        self.assertEqual(calls['3'], (('Label_Google',), ()))
+
+    def test_sql_filter_keeps_the_emails_of_every_ruleset(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all(self.emails)
+        session.commit()
+        criterion = self.rules_handler.build_sql_filter(self.now)
+        self.assertEqual({email.id for email in session.query(Email).filter(criterion)}, {'1', '2', '3'})
+        session.close()
+
+    def test_ruleset_without_actions(self):
+        del self.rules_handler.rules['rulesets'][2]['actions']
+        self.rules_handler.compile_rules(self.now)
+        gmail_handler = Mock()
+        gmail_handler.get_label_id.side_effect = lambda name, create: 'Label_' + name
+        gmail_handler.batch_modify.side_effect = lambda ids, add, remove: [{'ids': ids, 'error': None}]
+
+        self.assertIn('labels', self.rules_handler.columns())
+        self.rules_handler.process_emails(gmail_handler, self.emails, self.now)
+
+        modified = {message_id for call in gmail_handler.batch_modify.call_args_list for message_id in call.args[0]}
+        self.assertEqual(modified, {'1', '2'})
+
+    def test_single_rules_file_is_one_ruleset(self):
+        self.rules_handler.rules = {'rules': [{'field': 'subject', 'predicate': 'equals', 'value': 'hello'}],
+                                    'predicate': 'all', 'actions': []}
+        self.assertEqual(len(self.rules_handler.rulesets), 1)
+        self.assertEqual([self.rules_handler.evaluate_rules(email) for email in self.emails],
+                         [False, False, False, True])
+
+
+class TestLabelRules(unittest.TestCase):
+
+    def setUp(self):
+        self.rules_handler = RulesHandler('config/rules.json')
+        self.now = datetime(2024, 6, 1, 12)
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.session.add_all([Email(id=str(i), subject='Offer ' + str(i), date=self.now) for i in range(1, 4)] + [
+            Label(id='UNREAD', name='UNREAD'), Label(id='INBOX', name='INBOX'), Label(id='Label_9', name='HappyFox'),
+            MessageLabel(message_id='1', label_id='UNREAD'), MessageLabel(message_id='1', label_id='Label_9'),
+            MessageLabel(message_id='2', label_id='INBOX')
+        ])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def records(self):
+        build = EmailRecord.builder(['id', 'subject', 'labels'])
+        rows = self.session.execute(select(Email.id, Email.subject, email_labels()).order_by(Email.id))
+        return [build(row) for row in rows]
+
+    def check(self, rule, expected_ids):
+        self.rules_handler.rules = {'rules': [rule], 'predicate': 'all', 'actions': []}
+        python_ids = {record.id for record in self.records() if self.rules_handler.evaluate_rules(record)}
+        sql_ids = {email.id for email in self.session.query(Email).filter(self.rules_handler.build_sql_filter(self.now))}
+        self.assertEqual(python_ids, expected_ids)
+        self.assertEqual(sql_ids, expected_ids)
+
+    def test_label_predicates_are_evaluated_locally(self):
+        self.check({'field': 'labels', 'predicate': 'is_unread', 'value': True}, {'1'})
+        self.check({'field': 'labels', 'predicate': 'is_unread', 'value': 'false'}, {'2', '3'})
+        self.check({'field': 'labels', 'predicate': 'in_label', 'value': 'happyfox'}, {'1'})
+        self.check({'field': 'labels', 'predicate': 'in_label', 'value': 'INBOX'}, {'2'})
+
+    def test_actions_already_in_place_are_skipped(self):
+        self.rules_handler.rules = {
+            'rules': [{'field': 'subject', 'predicate': 'contains', 'value': 'offer'}],
+            'predicate': 'all',
+            'actions': [{'name': 'mark_as_read'}, {'name': 'move', 'folder_name': 'HappyFox'}]
+        }
+        self.assertIn('labels', self.rules_handler.columns())
+        # Nothing is known of the labels of the third email, so it gets every change
+        records = self.records()
+        gmail_handler = Mock()
+        gmail_handler.get_label_id.return_value = 'Label_9'
+        gmail_handler.batch_modify.side_effect = lambda ids, add, remove: [{'ids': ids, 'error': None}]
+
+        self.rules_handler.process_emails(gmail_handler, records, self.now)
+
+        calls = {call.args[0][0]: call.args[1:] for call in gmail_handler.batch_modify.call_args_list}
+        self.assertEqual(calls, {'1': ((), ('UNREAD',)), '2': (('Label_9',), ()), '3': (('Label_9',), ('UNREAD',))})
+
+    def test_journaled_changes_update_the_local_labels(self):
+        ActionJournal(self.engine).record(['1', '2'], (('Label_9', True, 'hash'), ('UNREAD', False, 'hash')))
+        self.assertEqual([record.labels for record in self.records()],
+                         [{'label_9', 'happyfox'}, {'inbox', 'label_9', 'happyfox'}, None])
+
+
+class TestSqlFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.rules_handler = RulesHandler('config/rules.json')
+        self.now = datetime(2024, 6, 1, 12)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            for statement in EMAILS_FTS_DDL:
+                connection.execute(text(statement))
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all([
+            Email(id='1', from_mail='News@Google.com', subject='India Weekly', date=self.now - timedelta(hours=2), message='a'),
+            Email(id='2', from_mail='friend@example.com', subject='Lunch?', date=self.now - timedelta(days=3), message='b'),
+            Email(id='3', from_mail='alerts@google.com', subject='Security 100%_off', date=self.now - timedelta(days=40), message='c'),
+            Email(id='4', from_mail=None, subject='Été', date=self.now - timedelta(hours=1), message='d'),
+            # Loaded without its body
+            Email(id='5', from_mail='bot@example.com', subject='Ping', date=self.now - timedelta(days=10), message=None)
+        ])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def check(self, rules, predicate, expected_sql_ids, use_fts=False):
+        self.rules_handler.rules = {'rules': rules, 'predicate': predicate, 'actions': []}
+        self.rules_handler.compile_rules(self.now)
+        emails = self.session.query(Email).all()
+        python_ids = {email.id for email in emails if self.rules_handler.evaluate_rules(email)}
+
+        criterion = self.rules_handler.build_sql_filter(self.now, use_fts)
+        query = self.session.query(Email)
+        if criterion is not None:
+            query = query.filter(criterion)
+        sql_ids = {email.id for email in query.all()}
+
+        self.assertTrue(python_ids <= sql_ids)
+        self.assertEqual(sql_ids, expected_sql_ids)
+
+    def test_all_predicate_is_fully_translated(self):
+        self.check([
+            {'field': 'from_mail', 'predicate': 'contains', 'value': 'GOOGLE'},
+            {'field': 'date', 'predicate': 'less_than', 'value': '2 days'}
+        ], 'all', {'1'})
+
+    def test_any_predicate_is_fully_translated(self):
+        self.check([
+            {'field': 'subject', 'predicate': 'equals', 'value': 'lunch?'},
+            {'field': 'date', 'predicate': 'greater_than', 'value': '1 months'}
+        ], 'any', {'2', '3'})
+
+    def test_contains_uses_full_text_index(self):
+        rules = [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'WEEK'},
+            {'field': 'from_mail', 'predicate': 'contains', 'value': 'google'}
+        ]
+        self.rules_handler.rules = {'rules': rules, 'predicate': 'all', 'actions': []}
+        self.assertIn('emails_fts', str(self.rules_handler.build_sql_filter(self.now, use_fts=True)))
+        self.check(rules, 'all', {'1'}, use_fts=True)
+        # Too short for the trigram index, falls back to LIKE
+        self.check([{'field': 'subject', 'predicate': 'contains', 'value': '?'}], 'all', {'2'}, use_fts=True)
+
+    def test_like_wildcards_are_escaped(self):
+        self.check([{'field': 'subject', 'predicate': 'contains', 'value': '100%_'}], 'all', {'3'})
+
+    def test_untranslated_rules_fall_back_to_python(self):
+        # not_contains stays in Python, the AND is narrowed by the date rule alone
+        self.check([
+            {'field': 'subject', 'predicate': 'not_contains', 'value': 'india'},
+            {'field': 'date', 'predicate': 'less_than', 'value': '5 days'}
+        ], 'all', {'1', '2', '4'})
+        # Non-ASCII values can't be folded by SQLite, so the OR can't be narrowed
+        self.check([
+            {'field': 'subject', 'predicate': 'contains', 'value': 'été'},
+            {'field': 'subject', 'predicate': 'contains', 'value': 'india'}
+        ], 'any', {'1', '2', '3', '4', '5'})
+
+    def test_emails_without_body_are_kept_for_message_rules(self):
+        self.check([{'field': 'message', 'predicate': 'contains', 'value': 'b'}], 'all', {'2', '5'})
+        self.check([{'field': 'message', 'predicate': 'equals', 'value': 'C'}], 'all', {'3', '5'}, use_fts=True)
+
+
+class TestBatchedActions(unittest.TestCase):
+
+    def setUp(self):
+        self.rules_handler = RulesHandler('config/rules.json')
+        self.message_ids = ['id-' + str(i) for i in range(2500)]
+        self.service = FakeGmailService([make_message(i) for i in self.message_ids], labels=['HappyFox'])
+        self.gmail_handler = fake_gmail_handler(self.service)
+        self.emails = [Email(id=i, subject='Offer', from_mail='news@google.com') for i in self.message_ids]
+
+    def set_actions(self, actions):
+        self.rules_handler.rules = {
+            'rules': [{'field': 'from_mail', 'predicate': 'contains', 'value': 'google'}],
+            'predicate': 'all',
+            'actions': actions
+        }
+
+    def test_actions_are_sent_in_chunks(self):
+        self.set_actions([{'name': 'mark_as_read'}, {'name': 'move', 'folder_name': 'happyfox'}])
+        results = self.rules_handler.process_emails(self.gmail_handler, self.emails)
+        self.assertEqual([len(result['ids']) for result in results], [1000, 1000, 500])
+        self.assertTrue(all(result['error'] is None for result in results))
+        self.assertEqual(self.service.calls['messages.batchModify'], 3)
+        self.assertNotIn('messages.modify', self.service.calls)
+        self.assertEqual(self.service.label_ids('id-42'), {'INBOX', 'CATEGORY_PERSONAL', 'Label_9'})
+
+    def test_emails_are_read_once_from_an_iterator(self):
+        self.set_actions([{'name': 'mark_as_read'}])
+        results = self.rules_handler.process_emails(self.gmail_handler, iter(self.emails))
+        self.assertEqual(sum(len(result['ids']) for result in results), 2500)
+
+    def test_later_action_wins(self):
+        self.set_actions([{'name': 'mark_as_unread'}, {'name': 'mark_as_read'}])
+        label_changes = self.rules_handler.resolve_actions(self.gmail_handler)
+        self.assertEqual(split_label_changes(merge_label_changes(label_changes[0])), ((), ('UNREAD',)))
+
+    def test_missing_folder_is_skipped(self):
+        self.set_actions([{'name': 'move', 'folder_name': 'Nowhere'}])
+        self.assertEqual(self.rules_handler.process_emails(self.gmail_handler, self.emails), [])
+        self.assertNotIn('messages.batchModify', self.service.calls)
+
+    def test_failed_chunks_are_reported(self):
+        self.set_actions([{'name': 'mark_as_read'}])
+        self.emails.insert(1500, Email(id='deleted-id', subject='Gone', from_mail='news@google.com'))
+        results = self.rules_handler.process_emails(self.gmail_handler, self.emails)
+        self.assertEqual([result['error'] is None for result in results], [True, False, True])
+
+    def journal(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        return ActionJournal(engine)
+
+    def test_journaled_actions_are_not_sent_again(self):
+        self.set_actions([{'name': 'mark_as_read'}, {'name': 'move', 'folder_name': 'happyfox'}])
+        journal = self.journal()
+        self.rules_handler.process_emails(self.gmail_handler, self.emails, journal=journal)
+        self.assertEqual(self.service.calls['messages.batchModify'], 3)
+
+        self.assertEqual(self.rules_handler.process_emails(self.gmail_handler, self.emails, journal=journal), [])
+        self.assertEqual(self.service.calls['messages.batchModify'], 3)
+        self.assertEqual(journal.skipped, 5000)
+
+        # Editing the rules applies them again
+        self.set_actions([{'name': 'mark_as_read'}])
+        results = self.rules_handler.process_emails(self.gmail_handler, self.emails[:10], journal=journal)
+        self.assertEqual([result['ids'] for result in results], [self.message_ids[:10]])
+
+    def test_failed_chunks_are_resumed(self):
+        self.set_actions([{'name': 'mark_as_read'}])
+        journal = self.journal()
+        self.emails.insert(1500, Email(id='deleted-id', subject='Gone', from_mail='news@google.com'))
+        self.rules_handler.process_emails(self.gmail_handler, self.emails, journal=journal)
+
+        del self.emails[1500]
+        results = self.rules_handler.process_emails(self.gmail_handler, self.emails, journal=journal)
+        self.assertEqual([result['ids'] for result in results], [self.message_ids[1000:1999]])
+        self.assertTrue(all(result['error'] is None for result in results))
 
 
 if __name__ == '__main__':
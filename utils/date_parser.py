@@ -0,0 +1,94 @@
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_tz
+from functools import lru_cache
+
+"""
+Parsing of the Date headers of Mails into naive UTC datetimes, the way the
+emails table stores them.
+
+Real mail uses many RFC 2822 variants: with or without the weekday, single
+digit days, two digit years, missing seconds, obsolete zone names such as
+EST or GMT, and comments like '(UTC)' after the zone. The common shapes are
+matched by a single regex, anything else goes through email.utils. Mails
+in a thread share their Date headers, and syncs see the same headers again,
+so the results are cached.
+"""
+
+# Number of parsed Date headers kept in the cache
+DATE_CACHE_SIZE = 4096
+
+DATE_PATTERN = re.compile(
+    r'\s*(?:[a-z]+,?\s*)?(\d{1,2})[\s-]+([a-z]{3})[a-z]*\.?[\s-]+(\d{2,4})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?'
+    r'(?:\.\d+)?\s*(?:([+-])(\d{2}):?(\d{2})|([a-z]{1,5}))?',
+    re.IGNORECASE
+)
+
+MONTHS = {month: number for number, month in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1
+)}
+
+# Hours from UTC of the obsolete zone names of RFC 822, military zones count as UTC
+ZONES = {'ut': 0, 'utc': 0, 'gmt': 0, 'z': 0, 'est': -5, 'edt': -4, 'cst': -6, 'cdt': -5,
+         'mst': -7, 'mdt': -6, 'pst': -8, 'pdt': -7}
+
+
+def to_year(year):
+
+    """Expand the two and three digit years of obsolete dates."""
+
+    if year < 50:
+        return year + 2000
+    if year < 1000:
+        return year + 1900
+    return year
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+
+    """Parse a Date header into a naive UTC datetime, or None if it isn't a date."""
+
+    if not value:
+        return None
+
+    match = DATE_PATTERN.match(value)
+    if match:
+        day, month, year, hour, minute, second, sign, zone_hours, zone_minutes, zone = match.groups()
+        month = MONTHS.get(month.lower())
+        if month is not None:
+            year = int(year)
+            try:
+                date = datetime(year if year >= 1000 else to_year(year), month, int(day),
+                                int(hour), int(minute), int(second) if second else 0)
+            except ValueError:
+                date = None
+            if date is not None:
+                if sign:
+                    offset = int(zone_hours) * 60 + int(zone_minutes)
+                    return date + timedelta(minutes=offset if sign == '-' else -offset) if offset else date
+                offset = ZONES.get(zone.lower(), 0) if zone else 0
+                return date - timedelta(hours=offset) if offset else date
+
+    parsed = parsedate_tz(value)
+    if parsed is not None:
+        try:
+            date = datetime(*parsed[:6])
+            return date - timedelta(seconds=parsed[9] or 0)
+        except ValueError:
+            pass
+
+    try:
+        date = datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def utc_now():
+
+    """Get the current time as a naive UTC datetime, comparable with the stored dates."""
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,73 @@
+import re
+
+"""
+Multi-keyword substring matching, answering every contains/not_contains
+rule on a field from a single scan of its value.
+
+The keywords are compiled into one regex shaped as a trie, so the regex
+engine walks the text once and branches on the next character instead of
+retrying every keyword at every position. A lookahead makes the matches
+zero-width, so overlapping keywords are all reported.
+
+For a handful of keywords, separate `in` scans are faster than any
+regex, so the matcher only switches to the regex from REGEX_MIN_KEYWORDS
+keywords on (see benchmarks/bench_keywords.py).
+"""
+
+# Number of keywords from which the single regex pass beats separate `in` scans
+REGEX_MIN_KEYWORDS = 150
+
+
+def build_trie_pattern(keywords):
+
+    """Build a regex matching any of the keywords, factored by common prefixes."""
+
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A keyword ends here, the longer keywords continuing it are optional
+        return '(?:' + pattern + ')?' if '' in node else pattern
+
+    return build(trie)
+
+
+class KeywordMatcher:
+
+    def __init__(self, keywords, regex_min_keywords=REGEX_MIN_KEYWORDS):
+        self.keywords = list(dict.fromkeys(keywords))
+        # The empty keyword is in every text
+        self.always = {''} if '' in self.keywords else set()
+        searched = [keyword for keyword in self.keywords if keyword]
+
+        self.pattern = None
+        if len(searched) >= regex_min_keywords:
+            self.pattern = re.compile('(?=(' + build_trie_pattern(searched) + '))')
+            # The regex reports the longest keyword at each position, which
+            # implies every keyword it contains
+            self.implied = {keyword: {other for other in searched if other in keyword} for keyword in searched}
+        self.searched = searched
+
+    def find(self, text):
+
+        """Get the set of keywords occurring in the text."""
+
+        if self.pattern is None:
+            return {keyword for keyword in self.searched if keyword in text} | self.always
+
+        found = set(self.always)
+        for match in self.pattern.finditer(text):
+            keyword = match.group(1)
+            if keyword not in found:
+                found |= self.implied[keyword]
+                if len(found) == len(self.keywords):
+                    break
+        return found
@@ -0,0 +1,62 @@
+import time
+from config.constants import LABEL_CACHE_TTL
+
+"""
+The label name to ID map of a Gmail account, shared by the Gmail handlers
+so folders are resolved without listing the labels on every action.
+"""
+
+
+class LabelCache:
+
+    """Lowercased label names mapped to label IDs, expiring after a TTL.
+
+    Names missing from a fresh listing are remembered, so asking for them
+    again doesn't list the labels until the cache expires. The clock can be
+    swapped out, for tests."""
+
+    def __init__(self, ttl=LABEL_CACHE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.labels = None
+        self.loaded_at = 0
+        self.misses = set()
+
+    def needs_refresh(self, key):
+
+        """Check whether the labels must be listed again to look the key up."""
+
+        if self.labels is None or self.clock() - self.loaded_at > self.ttl:
+            return True
+        # The label may have been created since the cache was loaded
+        return key not in self.labels and key not in self.misses
+
+    def load(self, labels):
+
+        """Replace the cache with a listing of the labels."""
+
+        self.labels = {label['name'].lower(): label['id'] for label in labels}
+        self.loaded_at = self.clock()
+        self.misses = set()
+
+    def lookup(self, key, create=False):
+
+        """Get the label ID of a key, None if the label is missing and must be created or skipped.
+
+        A missing label that isn't going to be created is remembered, so the
+        labels aren't listed again for it until the cache expires."""
+
+        label_id = self.labels.get(key)
+        if label_id is None and not create:
+            self.misses.add(key)
+        return label_id
+
+    def add(self, key, label_id):
+        self.labels[key] = label_id
+        self.misses.discard(key)
+
+    def invalidate(self):
+
+        """Drop the cache, so the labels are listed again on next use."""
+
+        self.labels = None
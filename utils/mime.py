@@ -0,0 +1,100 @@
+import base64
+import codecs
+import html
+import re
+from config.constants import MAX_BODY_BYTES
+
+"""
+Extraction of the text body from the MIME tree of a Gmail message payload.
+
+The tree is walked iteratively, so deeply nested multiparts can't hit the
+recursion limit, and only the chosen part is decoded: the first text/plain
+part, or the first text/html part with its tags stripped when there's no
+plain text. Attachments are skipped. The part is decoded with its declared
+charset, and at most max_bytes of it are decoded, so a huge body can't
+blow up memory and CPU.
+"""
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+TAG_PATTERN = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]+>', re.IGNORECASE | re.DOTALL)
+
+
+def find_text_part(payload):
+
+    """Find the part holding the text body, preferring text/plain over text/html."""
+
+    html_part = None
+    stack = [payload]
+
+    while stack:
+        part = stack.pop()
+        mime_type = part.get('mimeType', '')
+
+        if mime_type.startswith('multipart/'):
+            # Reversed, so the parts are visited in their order
+            stack.extend(reversed(part.get('parts', [])))
+        elif part.get('filename'):
+            continue
+        elif mime_type == 'text/plain':
+            return part
+        elif mime_type == 'text/html' and html_part is None:
+            html_part = part
+
+    return html_part
+
+
+def get_charset(part):
+
+    """Get the charset declared by the Content-Type header of a part, UTF-8 by default."""
+
+    for header in part.get('headers', []):
+        if header.get('name', '').lower() == 'content-type':
+            match = CHARSET_PATTERN.search(header.get('value', ''))
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+    return 'utf-8'
+
+
+def decode_data(data, charset='utf-8', max_bytes=None):
+
+    """Decode base64url body data into text, keeping at most max_bytes of it."""
+
+    if max_bytes is not None:
+        # Every 4 base64 characters hold 3 bytes, only decode what is kept
+        data = data[:-(-max_bytes // 3) * 4]
+
+    raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    if max_bytes is not None:
+        raw = raw[:max_bytes]
+
+    # A cut multibyte character at the end is dropped rather than replaced
+    decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+    return decoder.decode(raw, final=max_bytes is None or len(raw) < max_bytes)
+
+
+def html_to_text(text):
+
+    """Strip the tags of an HTML body, good enough for matching rules against."""
+
+    return html.unescape(TAG_PATTERN.sub(' ', text))
+
+
+def extract_body(payload, max_bytes=MAX_BODY_BYTES):
+
+    """Get the text body of a message payload.
+
+    Returns None if the payload carries no body at all, as in the 'metadata'
+    format, and an empty string if it has no text part."""
+
+    if 'body' not in payload and 'parts' not in payload:
+        return None
+
+    part = find_text_part(payload)
+    if part is None or 'data' not in part.get('body', {}):
+        return ''
+
+    text = decode_data(part['body']['data'], get_charset(part), max_bytes)
+    return html_to_text(text) if part.get('mimeType') == 'text/html' else text
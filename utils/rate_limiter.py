@@ -0,0 +1,150 @@
+import asyncio
+import random
+import threading
+import time
+from config.constants import QUOTA_UNITS_PER_SECOND, RETRY_BACKOFF
+from utils.logging_config import logging
+
+"""
+Rate limiting of the Gmail API calls against the per-user quota.
+
+Gmail charges every method a number of quota units, and throttles a user
+going over QUOTA_UNITS_PER_SECOND. The RateLimiter is a token bucket over
+those units, shared by every thread or task making requests. It halves its
+rate whenever Gmail throttles a request anyway, and creeps back up to the
+configured rate as requests succeed.
+"""
+
+# Quota units charged per Gmail API method
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'labels.create': 5,
+    'history.list': 2,
+    'users.getProfile': 1
+}
+
+# Units charged for a method missing above
+DEFAULT_QUOTA_UNITS = 5
+
+# Share of the configured rate recovered after each successful request
+RECOVERY_STEP = 0.02
+
+
+class RateLimiter:
+
+    """A token bucket over Gmail quota units.
+
+    A rate of None disables the limit, the limiter then only keeps the metrics.
+    The clock and sleep functions can be swapped out, for tests."""
+
+    def __init__(self, rate=QUOTA_UNITS_PER_SECOND, burst=None, min_rate=None, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or (rate / 32 if rate else None)
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.started = self.updated
+        self.calls = 0
+        self.completed = 0
+        self.units = 0
+        self.throttle_count = 0
+        self.wait_time = 0.0
+
+    def reserve(self, units, calls=1):
+
+        """Take units from the bucket, returning the seconds to wait before spending them.
+
+        The bucket may go negative, so concurrent callers queue up behind each other."""
+
+        with self.lock:
+            self.calls += calls
+            self.units += units
+            if self.rate is None:
+                return 0.0
+
+            now = self.clock()
+            # Never refill on a clock going backwards
+            elapsed = max(0.0, now - self.updated)
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= units
+
+            wait = max(0.0, -self.tokens / self.rate)
+            self.wait_time += wait
+            return wait
+
+    def acquire(self, method, count=1):
+
+        """Block until the quota for count calls of the method is available."""
+
+        wait = self.reserve(QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) * count, count)
+        if wait:
+            self.sleep(wait)
+
+    async def acquire_async(self, method, count=1):
+
+        """Wait without blocking the event loop until the quota is available."""
+
+        wait = self.reserve(QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) * count, count)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def throttled(self):
+
+        """Slow down after Gmail rejected a request for going over the quota."""
+
+        with self.lock:
+            self.throttle_count += 1
+            if self.rate is not None:
+                self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self, count=1):
+
+        """Record completed calls, speeding back up towards the configured rate."""
+
+        with self.lock:
+            self.completed += count
+            if self.rate is not None and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_STEP)
+
+    def backoff(self, attempt):
+
+        """Get the delay before a retry: exponential, with jitter so retries don't line up."""
+
+        delay = RETRY_BACKOFF * (2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def metrics(self):
+
+        """Get the usage of the limiter since it was created."""
+
+        elapsed = max(self.clock() - self.started, 1e-9)
+        return {
+            'calls': self.calls,
+            'completed': self.completed,
+            'units': self.units,
+            'qps': self.completed / elapsed,
+            'units_per_second': self.units / elapsed,
+            'throttle_count': self.throttle_count,
+            'wait_time': self.wait_time,
+            'rate': self.rate
+        }
+
+    def log_metrics(self):
+
+        """Log the usage of the limiter."""
+
+        metrics = self.metrics()
+        logging.info("Gmail API Calls: " + str(metrics['completed']) + " completed of " + str(metrics['calls'])
+                     + ", QPS: " + str(round(metrics['qps'], 1)) + ", Throttled: " + str(metrics['throttle_count'])
+                     + ", Waited: " + str(round(metrics['wait_time'], 2)) + " seconds")